@@ -0,0 +1,460 @@
+# Whole-grammar analysis in one pass over the strongly connected components.
+#
+# Per-nonterminal statistics (derivation counts, shortest and longest
+# output, derivation depth, reachable terminals) all follow the same shape:
+# a nonterminal's value combines the values of its productions' symbols.
+# Computing them separately meant one traversal each, and the old longest-
+# sequence loop re-queued unresolved nonterminals until their children were
+# done, which is quadratic and never terminates on a cycle.
+#
+# Tarjan's algorithm yields the strongly connected components of the symbol
+# graph children-first, so visiting components in that order resolves every
+# statistic in a single sweep. A component with more than one member, or a
+# member that refers to itself, is a cycle: its members derive unboundedly
+# many strings (count, longest length and depth are None), while the
+# shortest length is still well defined and is settled inside the component
+# with Knuth's algorithm.
+#
+# Exact counts are Python ints that grow doubly exponentially with depth, so
+# counts are also kept in a scaled float form, m * 2**e with a float64
+# mantissa and an int exponent. Products and sums of those cost a few float
+# operations whatever the magnitude, never overflow, and carry a bound on
+# their relative error, which tells callers when the exact ints are needed.
+
+import heapq
+import math
+
+# Unit roundoff of float64.
+_EPSILON = 2.0 ** -53
+
+
+class GrammarAnalysis:
+    """Per-symbol statistics of a compiled grammar, indexed by symbol id.
+
+    Attributes:
+        counts: number of derivations, or None if a cycle is reachable.
+            Computed on first access.
+        min_lengths: shortest output, or None if no string is derivable.
+        max_lengths: longest output, or None if a cycle is reachable.
+        depths: height of the tallest derivation tree (0 for terminals),
+            or None if a cycle is reachable.
+        terminals: bitmask of the terminal ids reachable from the symbol.
+        nullable: whether the symbol derives the empty string.
+        recursive: whether the symbol lies on a cycle.
+        order: nonterminal ids, each after every nonterminal it refers to
+            (except those in its own cycle).
+        components: the strongly connected components as tuples of
+            nonterminal ids, each after every component it refers to.
+    """
+
+    def __init__(self, compiled) -> None:
+        self.compiled = compiled
+        T = compiled.num_terminals
+        N = compiled.num_nonterminals
+        prod_offsets = compiled.prod_offsets
+
+        # Distinct nonterminal indices referenced by each nonterminal.
+        children: list[list[int]] = []
+        for nt in range(N):
+            seen = set()
+            for p in range(prod_offsets[nt], prod_offsets[nt + 1]):
+                for sym in compiled.rhs(p):
+                    if sym >= T:
+                        seen.add(sym - T)
+            children.append(sorted(seen))
+
+        min_lengths: list[int | None] = [1] * T + [None] * N
+        max_lengths: list[int | None] = [1] * T + [0] * N
+        depths: list[int | None] = [0] * T + [0] * N
+        terminals = [1 << t for t in range(T)] + [0] * N
+        recursive = [False] * (T + N)
+        order = []
+        components = []
+
+        for component in self._components(children):
+            members = [T + nt for nt in component]
+            components.append(tuple(members))
+            cyclic = len(component) > 1 or component[0] in children[component[0]]
+
+            # Terminals reachable from any member are reachable from all.
+            reach = 0
+            for sym in members:
+                for p in range(prod_offsets[sym - T], prod_offsets[sym - T + 1]):
+                    for child in compiled.rhs(p):
+                        reach |= terminals[child]
+            for sym in members:
+                terminals[sym] = reach
+                recursive[sym] = cyclic
+                order.append(sym)
+
+            if cyclic:
+                for sym in members:
+                    max_lengths[sym] = depths[sym] = None
+                self._cyclic_min_lengths(members, min_lengths)
+                continue
+
+            # A single acyclic member: every child is already final.
+            sym = members[0]
+            shortest = None
+            longest = 0
+            depth = 0
+            for p in range(prod_offsets[sym - T], prod_offsets[sym - T + 1]):
+                rhs = compiled.rhs(p)
+                low = 0
+                high = 0
+                for child in rhs:
+                    low = None if low is None or min_lengths[child] is None else (
+                        low + min_lengths[child]
+                    )
+                    high = None if high is None or max_lengths[child] is None else (
+                        high + max_lengths[child]
+                    )
+                    if depth is not None:
+                        depth = None if depths[child] is None else max(
+                            depth, depths[child] + 1
+                        )
+                if low is not None and (shortest is None or low < shortest):
+                    shortest = low
+                longest = None if longest is None or high is None else max(longest, high)
+                if not rhs and depth is not None:
+                    depth = max(depth, 1)
+            min_lengths[sym] = shortest
+            max_lengths[sym] = longest
+            depths[sym] = depth
+
+        self._counts: tuple[int | None, ...] | None = None
+        self._scaled_counts: tuple[tuple[float, int] | None, ...] | None = None
+        self._count_errors: tuple[float | None, ...] | None = None
+        self.min_lengths = tuple(min_lengths)
+        self.max_lengths = tuple(max_lengths)
+        self.depths = tuple(depths)
+        self.terminals = tuple(terminals)
+        self.nullable = tuple(length == 0 for length in min_lengths)
+        self.recursive = tuple(recursive)
+        self.order = tuple(order)
+        self.components = tuple(components)
+
+    @property
+    def counts(self) -> tuple[int | None, ...]:
+        """Derivation counts per symbol id, None where a cycle is reachable.
+
+        Counts can grow doubly exponentially with depth, so unlike the
+        other statistics they are only computed, in one sweep over order,
+        the first time they are asked for.
+        """
+        if self._counts is None:
+            compiled = self.compiled
+            T = compiled.num_terminals
+            counts: list[int | None] = [1] * T + [0] * compiled.num_nonterminals
+            for sym in self.order:
+                if self.recursive[sym]:
+                    counts[sym] = None
+                    continue
+                total = 0
+                for p in range(
+                    compiled.prod_offsets[sym - T], compiled.prod_offsets[sym - T + 1]
+                ):
+                    product = 1
+                    for child in compiled.rhs(p):
+                        if counts[child] is None:
+                            product = None
+                            break
+                        product *= counts[child]
+                    if product is None:
+                        total = None
+                        break
+                    total += product
+                counts[sym] = total
+            self._counts = tuple(counts)
+        return self._counts
+
+    @property
+    def scaled_counts(self) -> tuple[tuple[float, int] | None, ...]:
+        """Derivation counts as (mantissa, exponent) pairs, None where cyclic.
+
+        The count of a symbol is approximately mantissa * 2**exponent, with
+        mantissa in [0.5, 1) (or 0.0 for no derivations). Relative errors
+        are bounded by count_errors. Computed on first access, without big
+        integers.
+        """
+        if self._scaled_counts is None:
+            self._scale_counts()
+        return self._scaled_counts
+
+    @property
+    def count_errors(self) -> tuple[float | None, ...]:
+        """Bound on the relative error of each of scaled_counts.
+
+        The bound is rigorous to first order in the unit roundoff: each
+        float operation adds at most one unit roundoff, and a product adds
+        up its factors' errors. It is pessimistic for deep grammars, whose
+        actual rounding errors mostly cancel.
+        """
+        if self._count_errors is None:
+            self._scale_counts()
+        return self._count_errors
+
+    @property
+    def log_counts(self) -> tuple[float | None, ...]:
+        """Base-2 logarithm of each derivation count, None where cyclic.
+
+        -inf for symbols with no derivations, inf where the logarithm
+        itself overflows a float.
+        """
+        return tuple(
+            None if scaled is None
+            else -math.inf if scaled[0] == 0.0
+            # Exponents of doubly exponential counts can exceed a float.
+            else math.inf if scaled[1].bit_length() > 1000
+            else math.log2(scaled[0]) + scaled[1]
+            for scaled in self.scaled_counts
+        )
+
+    def uniform_probabilities(
+        self, tolerance: float = 1e-12, max_exact_bits: int = 1 << 16
+    ) -> tuple[float | None, ...]:
+        """Production probabilities that make every derivation equally likely.
+
+        Entry p is the fraction of its nonterminal's derivations that start
+        with production p, or None if the nonterminal reaches a cycle.
+
+        Probabilities are computed from scaled_counts in float arithmetic.
+        Each is then within relative error err(p) + err(nt) + 2 unit
+        roundoffs of the exact ratio, where err is the count_errors bound.
+        For any nonterminal where that bound exceeds tolerance, the ratios
+        are instead computed from the exact integer counts and are
+        correctly rounded, unless those counts have more than
+        max_exact_bits bits; such grammars are too deep for exact
+        arithmetic and keep the float values.
+
+        Args:
+            tolerance: largest relative error accepted from the float path.
+            max_exact_bits: largest count, in bits, the exact path handles.
+        """
+        compiled = self.compiled
+        T = compiled.num_terminals
+        scaled = self.scaled_counts
+        errors = self.count_errors
+        probs: list[float | None] = [None] * compiled.num_productions
+        imprecise = []
+        for nt_index in range(compiled.num_nonterminals):
+            sym = T + nt_index
+            if scaled[sym] is None or scaled[sym][0] == 0.0:
+                continue
+            m, e = scaled[sym]
+            for p in range(
+                compiled.prod_offsets[nt_index], compiled.prod_offsets[nt_index + 1]
+            ):
+                children = compiled.rhs(p)
+                (pm, pe), error = _scaled_product(
+                    [scaled[child] for child in children],
+                    [errors[child] for child in children],
+                )
+                probs[p] = math.ldexp(pm / m, pe - e)
+                if error + errors[sym] + 2 * _EPSILON > tolerance:
+                    imprecise.append(nt_index)
+        if not imprecise:
+            return tuple(probs)
+
+        # Exact counts, for the symbols small enough to afford them.
+        exact: list[int | None] = [1] * T + [None] * compiled.num_nonterminals
+        for sym in self.order:
+            if scaled[sym] is None or scaled[sym][1] > max_exact_bits:
+                continue
+            total = 0
+            for p in range(
+                compiled.prod_offsets[sym - T], compiled.prod_offsets[sym - T + 1]
+            ):
+                product = 1
+                for child in compiled.rhs(p):
+                    if exact[child] is None:
+                        product = None
+                        break
+                    product *= exact[child]
+                if product is None:
+                    total = None
+                    break
+                total += product
+            exact[sym] = total
+        for nt_index in imprecise:
+            if exact[T + nt_index] is None:
+                continue
+            for p in range(
+                compiled.prod_offsets[nt_index], compiled.prod_offsets[nt_index + 1]
+            ):
+                count = 1
+                for child in compiled.rhs(p):
+                    count *= exact[child]
+                # int / int is correctly rounded, however large the ints.
+                probs[p] = count / exact[T + nt_index]
+        return tuple(probs)
+
+    def terminal_ids(self, symbol_id: int) -> list[int]:
+        """Terminal ids reachable from a symbol, in increasing order."""
+        mask = self.terminals[symbol_id]
+        return [t for t in range(self.compiled.num_terminals) if mask >> t & 1]
+
+    # ── Private helpers ─────────────────────────────────────────────────
+
+    def _scale_counts(self) -> None:
+        """Fill scaled_counts and count_errors in one sweep over order."""
+        compiled = self.compiled
+        T = compiled.num_terminals
+        scaled: list[tuple[float, int] | None] = [(0.5, 1)] * T + [
+            None
+        ] * compiled.num_nonterminals
+        errors: list[float | None] = [0.0] * T + [None] * compiled.num_nonterminals
+        for sym in self.order:
+            if self.max_lengths[sym] is None:
+                continue
+            total = (0.0, 0)
+            total_error = 0.0
+            for p in range(
+                compiled.prod_offsets[sym - T], compiled.prod_offsets[sym - T + 1]
+            ):
+                product, error = _scaled_product(
+                    [scaled[child] for child in compiled.rhs(p)],
+                    [errors[child] for child in compiled.rhs(p)],
+                )
+                if total[0] != 0.0:
+                    total_error += _EPSILON
+                total = _scaled_add(total, product)
+                total_error = max(total_error, error)
+            scaled[sym] = total
+            errors[sym] = total_error
+        self._scaled_counts = tuple(scaled)
+        self._count_errors = tuple(errors)
+
+    @staticmethod
+    def _components(children: list[list[int]]) -> list[list[int]]:
+        """Strongly connected components, children first (Tarjan).
+
+        Iterative, so grammars thousands of levels deep don't hit the Python
+        recursion limit.
+        """
+        N = len(children)
+        index = [-1] * N
+        low = [0] * N
+        on_stack = [False] * N
+        stack = []
+        components = []
+        counter = 0
+
+        for root in range(N):
+            if index[root] >= 0:
+                continue
+            index[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack[root] = True
+            # Each frame is a node and the position of its next child.
+            work = [(root, 0)]
+            while work:
+                v, i = work[-1]
+                if i < len(children[v]):
+                    work[-1] = (v, i + 1)
+                    w = children[v][i]
+                    if index[w] < 0:
+                        index[w] = low[w] = counter
+                        counter += 1
+                        stack.append(w)
+                        on_stack[w] = True
+                        work.append((w, 0))
+                    elif on_stack[w]:
+                        low[v] = min(low[v], index[w])
+                    continue
+
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[v])
+                if low[v] == index[v]:
+                    component = []
+                    while True:
+                        w = stack.pop()
+                        on_stack[w] = False
+                        component.append(w)
+                        if w == v:
+                            break
+                    components.append(component)
+
+        return components
+
+    def _cyclic_min_lengths(
+        self, members: list[int], min_lengths: list[int | None]
+    ) -> None:
+        """Shortest outputs inside one cycle (Knuth's algorithm).
+
+        Symbols outside the component are already final. A production's
+        length becomes known once all its in-component symbols are final,
+        and the smallest known candidate is always final.
+        """
+        compiled = self.compiled
+        T = compiled.num_terminals
+        inside = set(members)
+        pending = {}
+        partial = {}
+        uses: dict[int, list[int]] = {sym: [] for sym in members}
+        heap = []
+        for sym in members:
+            for p in range(compiled.prod_offsets[sym - T], compiled.prod_offsets[sym - T + 1]):
+                waiting = 0
+                length = 0
+                for child in compiled.rhs(p):
+                    if child in inside:
+                        waiting += 1
+                        uses[child].append(p)
+                    elif min_lengths[child] is None:
+                        length = None
+                        break
+                    else:
+                        length += min_lengths[child]
+                if length is None:
+                    continue
+                pending[p] = waiting
+                partial[p] = length
+                if waiting == 0:
+                    heap.append((length, sym))
+        heapq.heapify(heap)
+
+        while heap:
+            length, sym = heapq.heappop(heap)
+            if min_lengths[sym] is not None:
+                continue
+            min_lengths[sym] = length
+            for p in uses[sym]:
+                if p not in pending:
+                    continue
+                pending[p] -= 1
+                partial[p] += length
+                if pending[p] == 0:
+                    heapq.heappush(heap, (partial[p], T + compiled.prod_lhs[p]))
+
+
+def _scaled_product(
+    factors: list[tuple[float, int]], errors: list[float]
+) -> tuple[tuple[float, int], float]:
+    """Multiply scaled numbers; return the product and its error bound."""
+    m, e = 1.0, 0
+    error = 0.0
+    for (fm, fe), factor_error in zip(factors, errors):
+        m, shift = math.frexp(m * fm)
+        e += fe + shift
+        # Multiplying by a power of two (a terminal's count) is exact.
+        error += factor_error + (0.0 if fm == 0.5 else _EPSILON)
+    if m == 0.0:
+        return (0.0, 0), 0.0
+    m, shift = math.frexp(m)
+    return (m, e + shift), error
+
+
+def _scaled_add(a: tuple[float, int], b: tuple[float, int]) -> tuple[float, int]:
+    """Add two non-negative scaled numbers m * 2**e."""
+    if a[0] == 0.0:
+        return b
+    if b[0] == 0.0:
+        return a
+    if a[1] < b[1]:
+        a, b = b, a
+    m, shift = math.frexp(a[0] + math.ldexp(b[0], b[1] - a[1]))
+    return m, a[1] + shift
@@ -0,0 +1,258 @@
+# Minimal deterministic acyclic automata for finite grammar languages.
+#
+# An acyclic grammar derives a finite set of strings, and any finite
+# language is recognized by a minimal deterministic acyclic automaton
+# (a DAWG). Membership is then one table lookup per character with no
+# parsing, and the number of distinct strings is a sum over the automaton's
+# states. count_generations can't give that number: it counts derivations,
+# and an ambiguous grammar derives some strings more than once.
+#
+# Automata are built bottom-up, one nonterminal at a time, from the already
+# minimized automata of its right-hand-side symbols. A state of the new
+# automaton is a set of configurations (slot, q): "inside the production
+# slot's symbol, in state q of its automaton". Because the children are
+# already deterministic, the configuration sets stay small. The result is
+# then minimized by merging states with identical futures, processed
+# children first, as in Revuz's algorithm for acyclic automata.
+
+
+class Automaton:
+    """Minimal acyclic DFA over terminal ids.
+
+    transitions[q] maps a terminal id to the next state and final[q] says
+    whether q accepts. The start state is start. counts[q] is the number of
+    distinct strings accepted from q, so counts[start] is the size of the
+    language.
+    """
+
+    def __init__(
+        self, transitions: list[dict[int, int]], final: list[bool], start: int
+    ) -> None:
+        self.transitions = transitions
+        self.final = final
+        self.start = start
+
+        # States are numbered children-first (see _minimize), so one pass
+        # in index order sees every child before its parents.
+        counts = [0] * len(transitions)
+        for q, edges in enumerate(transitions):
+            counts[q] = int(final[q]) + sum(counts[r] for r in edges.values())
+        self.counts = counts
+
+    def __len__(self) -> int:
+        return len(self.transitions)
+
+    @property
+    def num_strings(self) -> int:
+        """Number of distinct strings in the language."""
+        return self.counts[self.start]
+
+    def accepts(self, tokens: list[int]) -> bool:
+        """Return True if the terminal ids spell a string of the language."""
+        transitions = self.transitions
+        q = self.start
+        for token in tokens:
+            q = transitions[q].get(token)
+            if q is None:
+                return False
+        return self.final[q]
+
+    def match_ends(self, tokens: list[int], start: int) -> list[int]:
+        """Offsets end such that tokens[start:end] is in the language."""
+        transitions = self.transitions
+        final = self.final
+        ends = [start] if final[self.start] else []
+        q = self.start
+        for end in range(start + 1, len(tokens) + 1):
+            q = transitions[q].get(tokens[end - 1])
+            if q is None:
+                break
+            if final[q]:
+                ends.append(end)
+        return ends
+
+
+# Automaton of a single terminal: start state 1, accepting state 0.
+def _terminal_automaton(terminal: int) -> Automaton:
+    return Automaton([{}, {terminal: 0}], [True, False], 1)
+
+
+def build_automata(
+    compiled,
+    symbol_ids: list[int],
+    max_states: int = 100_000,
+    known: dict[int, Automaton] | None = None,
+) -> dict[int, Automaton | None]:
+    """Compile minimal automata for some symbols and everything below them.
+
+    Args:
+        compiled: the CompiledGrammar. Symbols reachable from symbol_ids
+            must not be recursive.
+        symbol_ids: the symbols to compile.
+        max_states: limit on the number of states built for any one
+            nonterminal before minimization. Symbols over the limit, and
+            every symbol above them, map to None.
+        known: automata already built for some symbols, reused as is.
+
+    Returns:
+        A dict from every symbol reachable from symbol_ids to its automaton
+        (or None).
+    """
+    T = compiled.num_terminals
+    automata: dict[int, Automaton | None] = dict(known or {})
+    # 0 = unvisited, 1 = on the DFS stack, 2 = finished.
+    state = [0] * len(compiled.symbols)
+
+    # Iterative post-order DFS so children are compiled before parents.
+    stack = list(symbol_ids)
+    while stack:
+        sym = stack[-1]
+        if sym in automata:
+            stack.pop()
+            continue
+        if sym < T:
+            automata[sym] = _terminal_automaton(sym)
+            stack.pop()
+            continue
+        nt_index = sym - T
+        productions = range(
+            compiled.prod_offsets[nt_index], compiled.prod_offsets[nt_index + 1]
+        )
+        if state[sym] == 0:
+            state[sym] = 1
+            for p in productions:
+                for child in compiled.rhs(p):
+                    if state[child] == 1:
+                        raise ValueError(
+                            "Automata need an acyclic grammar; "
+                            f"{compiled.symbols[child]!r} is recursive."
+                        )
+                    if child not in automata:
+                        stack.append(child)
+            continue
+
+        stack.pop()
+        state[sym] = 2
+        children = [
+            automata[compiled.rhs_symbols[slot]]
+            for p in productions
+            for slot in range(compiled.rhs_offsets[p], compiled.rhs_offsets[p + 1])
+        ]
+        if any(child is None for child in children):
+            automata[sym] = None
+        else:
+            automata[sym] = _build(compiled, nt_index, automata, max_states)
+    return automata
+
+
+def _build(
+    compiled, nt_index: int, automata: dict, max_states: int
+) -> Automaton | None:
+    """Subset construction over (slot, child state) configurations."""
+    rhs_offsets = compiled.rhs_offsets
+    rhs_symbols = compiled.rhs_symbols
+
+    # slot_end[slot] is the end of the production containing slot.
+    slot_end = {}
+    first_slots = []
+    accepts_empty = False
+    for p in range(compiled.prod_offsets[nt_index], compiled.prod_offsets[nt_index + 1]):
+        if rhs_offsets[p] == rhs_offsets[p + 1]:
+            accepts_empty = True
+            continue
+        for slot in range(rhs_offsets[p], rhs_offsets[p + 1]):
+            slot_end[slot] = rhs_offsets[p + 1]
+        first_slots.append(rhs_offsets[p])
+
+    def close(configs):
+        """Enter the next slot wherever a child can end; return (set, final)."""
+        out = set()
+        final = False
+        work = list(configs)
+        while work:
+            slot, q = work.pop()
+            if (slot, q) in out:
+                continue
+            child = automata[rhs_symbols[slot]]
+            if child.transitions[q]:
+                out.add((slot, q))
+            if child.final[q]:
+                if slot + 1 == slot_end[slot]:
+                    final = True
+                else:
+                    nxt = slot + 1
+                    work.append((nxt, automata[rhs_symbols[nxt]].start))
+        return frozenset(out), final
+
+    start_configs, start_final = close(
+        (slot, automata[rhs_symbols[slot]].start) for slot in first_slots
+    )
+    # States are keyed by configuration set and finality: configurations
+    # that can only end are dropped from the set, so the set alone does not
+    # determine whether the state accepts.
+    subsets = {(start_configs, start_final): 0}
+    order = [start_configs]
+    transitions: list[dict[int, int]] = []
+    final = [start_final or accepts_empty]
+
+    # Breadth-first over reachable configuration sets.
+    i = 0
+    while i < len(order):
+        moves: dict[int, list] = {}
+        for slot, q in order[i]:
+            for token, r in automata[rhs_symbols[slot]].transitions[q].items():
+                moves.setdefault(token, []).append((slot, r))
+        edges = {}
+        for token, configs in moves.items():
+            target, is_final = close(configs)
+            index = subsets.get((target, is_final))
+            if index is None:
+                if len(order) >= max_states:
+                    return None
+                index = subsets[target, is_final] = len(order)
+                order.append(target)
+                final.append(is_final)
+            edges[token] = index
+        transitions.append(edges)
+        i += 1
+
+    return _minimize(transitions, final, 0)
+
+
+def _minimize(
+    transitions: list[dict[int, int]], final: list[bool], start: int
+) -> Automaton:
+    """Merge equivalent states of an acyclic DFA (Revuz).
+
+    Two states are equivalent if they agree on finality and their edges
+    lead to equivalent states. Visiting children before parents, each state
+    is looked up in a register of signatures already seen. The minimized
+    states are numbered in that children-first order.
+    """
+    register: dict[tuple, int] = {}
+    new_transitions: list[dict[int, int]] = []
+    new_final: list[bool] = []
+    canonical = [-1] * len(transitions)
+
+    # Iterative post-order DFS from the start state.
+    stack = [start]
+    while stack:
+        q = stack[-1]
+        if canonical[q] >= 0:
+            stack.pop()
+            continue
+        pending = [r for r in transitions[q].values() if canonical[r] < 0]
+        if pending:
+            stack.extend(pending)
+            continue
+        stack.pop()
+        edges = {token: canonical[r] for token, r in transitions[q].items()}
+        signature = (final[q], tuple(sorted(edges.items())))
+        index = register.get(signature)
+        if index is None:
+            index = register[signature] = len(new_transitions)
+            new_transitions.append(edges)
+            new_final.append(final[q])
+        canonical[q] = index
+
+    return Automaton(new_transitions, new_final, canonical[start])
@@ -0,0 +1,323 @@
+# This module defines CompiledGrammar, a flat integer-indexed form of a
+# CFGrammar, and the non-recursive generation engine that runs on it.
+# The dict[str, list[list[str]]] rules are convenient to write by hand but
+# slow to walk: every step is a string-keyed dict lookup and every
+# nonterminal becomes a Python call frame. Here symbols are interned to
+# integer ids and productions are packed into flat arrays with offsets,
+# so the expansion loop only does list indexing on small ints.
+
+import random
+
+import numpy as np
+
+from .cfg_analysis import GrammarAnalysis
+from .cfg_leaves import LeafCache
+from .cfg_sampling import SamplingTables
+
+# Longest output buffer expand() allocates up front.
+_MAX_PREALLOCATE = 1 << 20
+
+
+class CompiledGrammar:
+    """Flat, integer-indexed form of a context-free grammar.
+
+    Symbols are interned to integer ids. Terminals take ids 0..T-1 in
+    sorted order (matching CFGrammar.terminal_symbols) and nonterminals
+    take ids T..T+N-1 in the order they appear in the rules dict. A symbol
+    id is therefore a terminal exactly when it is below num_terminals.
+
+    Productions are stored in CSR layout:
+
+        prod_offsets[nt]..prod_offsets[nt + 1]
+            the production ids of nonterminal index nt (symbol id - T)
+        rhs_offsets[p]..rhs_offsets[p + 1]
+            the slice of rhs_symbols holding production p's symbol ids
+    """
+
+    def __init__(self, cfg_rules: dict[str, list[list[str]]]) -> None:
+        nonterminals = list(cfg_rules.keys())
+        nonterminal_set = set(nonterminals)
+
+        # Terminals are every RHS symbol that has no rules of its own.
+        terminal_set = set()
+        for productions in cfg_rules.values():
+            for production in productions:
+                for symbol in production:
+                    if symbol not in nonterminal_set:
+                        terminal_set.add(symbol)
+        terminals = sorted(terminal_set)
+
+        # Intern every symbol. Terminals come first so that a single
+        # comparison against num_terminals classifies a symbol id.
+        self.symbols = tuple(terminals + nonterminals)
+        self.symbol_ids = {sym: i for i, sym in enumerate(self.symbols)}
+        self.num_terminals = len(terminals)
+        self.num_nonterminals = len(nonterminals)
+
+        # Pack productions into the flat CSR arrays described above.
+        prod_offsets = [0]
+        rhs_offsets = [0]
+        rhs_symbols = []
+        prod_lhs = []
+        for nt_index, nonterminal in enumerate(nonterminals):
+            for production in cfg_rules[nonterminal]:
+                rhs_symbols.extend(self.symbol_ids[sym] for sym in production)
+                rhs_offsets.append(len(rhs_symbols))
+                prod_lhs.append(nt_index)
+            prod_offsets.append(len(prod_lhs))
+
+        self.prod_offsets = tuple(prod_offsets)
+        self.rhs_offsets = tuple(rhs_offsets)
+        self.rhs_symbols = tuple(rhs_symbols)
+        self.prod_lhs = tuple(prod_lhs)
+        self.num_productions = len(prod_lhs)
+
+        # Per-production RHS tuples in reverse order. The expansion loop
+        # pushes a production onto its stack in one extend() call, and the
+        # stack pops from the end, so the first symbol must be pushed last.
+        self._rhs_reversed = tuple(
+            self.rhs_symbols[rhs_offsets[p]:rhs_offsets[p + 1]][::-1]
+            for p in range(self.num_productions)
+        )
+
+        # Byte translation table for decode(), if the terminals allow it.
+        self._byte_table = None
+        if all(len(t) == 1 and ord(t) < 256 for t in terminals):
+            table = bytearray(range(256))
+            for i, t in enumerate(terminals):
+                table[i] = ord(t)
+            self._byte_table = bytes(table)
+
+        # Per-symbol statistics from one pass over the symbol graph.
+        self.analysis = GrammarAnalysis(self)
+
+        # Longest derivable output per symbol id, used to size the output
+        # buffer up front. None marks symbols that reach a cycle (unbounded).
+        self.max_lengths = self.analysis.max_lengths
+
+        # Shortest derivable output per symbol id. None marks nonterminals
+        # that cannot derive any terminal string at all.
+        self.min_lengths = self.analysis.min_lengths
+
+        # NumPy copies of the production tables for the batched engine.
+        # Built on first use by _numpy_tables().
+        self._np_tables = None
+
+    # ── Symbols ─────────────────────────────────────────────────────────
+
+    def symbol_id(self, symbol: str) -> int:
+        """Return the interned id of a symbol, raising KeyError if unknown."""
+        return self.symbol_ids[symbol]
+
+    def rhs(self, production: int) -> tuple[int, ...]:
+        """Return the symbol ids on the right-hand side of a production."""
+        return self.rhs_symbols[
+            self.rhs_offsets[production]:self.rhs_offsets[production + 1]
+        ]
+
+    def decode(self, symbol_ids: list[int]) -> str:
+        """Join a sequence of terminal ids back into a string."""
+        # When every terminal is a single Latin-1 character, the ids can be
+        # packed into bytes and mapped to characters in one C-level pass.
+        if self._byte_table is not None:
+            return bytes(symbol_ids).translate(self._byte_table).decode("latin-1")
+        symbols = self.symbols
+        return "".join([symbols[i] for i in symbol_ids])
+
+    # ── Generation ──────────────────────────────────────────────────────
+
+    def expand(
+        self,
+        symbol_id: int,
+        tables: SamplingTables | None = None,
+        rng=random,
+        leaves: LeafCache | None = None,
+    ) -> list[int]:
+        """Expand a symbol into a list of terminal ids without recursion.
+
+        Args:
+            symbol_id: interned id of the symbol to expand.
+            tables: optional alias tables for weighted production choice.
+                If None, productions are uniform.
+            rng: source of randomness with a random() method. Defaults to
+                the global random module.
+            leaves: optional LeafCache built for the same tables. Cached
+                nonterminals are emitted whole with a single draw.
+
+        Returns:
+            The terminal ids of the generated string, in order.
+        """
+        T = self.num_terminals
+        if symbol_id < T:
+            return [symbol_id]
+
+        # Bind everything the loop touches to locals; attribute lookups
+        # would otherwise dominate the per-symbol cost.
+        prod_offsets = self.prod_offsets
+        rhs_reversed = self._rhs_reversed
+        draw = rng.random
+        if tables is not None:
+            prob = tables.prob
+            alias = tables.alias
+        leaf_table = leaves.table if leaves is not None else None
+        used_leaves = []
+
+        # Preallocate the output buffer. For acyclic grammars the longest
+        # derivation bounds the output, so terminals are written by index
+        # and the buffer never grows. Recursive grammars have no bound, and
+        # deep grammars a bound too large to allocate; both fall back to
+        # appending.
+        capacity = self.max_lengths[symbol_id]
+        if capacity is not None and capacity > _MAX_PREALLOCATE:
+            capacity = None
+        out = [0] * capacity if capacity is not None else []
+        n = 0
+
+        # Leftmost derivation with an explicit stack of symbol ids. Popping
+        # a terminal emits it; popping a nonterminal pushes a production.
+        stack = [symbol_id]
+        pop = stack.pop
+        push = stack.extend
+        while stack:
+            sym = pop()
+            if sym < T:
+                if capacity is None:
+                    out.append(sym)
+                else:
+                    out[n] = sym
+                n += 1
+                continue
+
+            if leaf_table is not None:
+                entry = leaf_table[sym]
+                if entry is not None:
+                    # A cached nonterminal: draw one of its strings from
+                    # its alias table and copy it out whole.
+                    if not entry:
+                        entry = leaves.load(sym)
+                    strings, leaf_prob, leaf_alias = entry
+                    u = draw() * len(strings)
+                    column = int(u)
+                    if u - column >= leaf_prob[column]:
+                        column = leaf_alias[column]
+                    string = strings[column]
+                    if capacity is None:
+                        out.extend(string)
+                    else:
+                        out[n:n + len(string)] = string
+                    n += len(string)
+                    used_leaves.append(sym)
+                    continue
+
+            # One uniform draw picks both the alias column (integer part)
+            # and the accept/alias coin (fractional part).
+            first = prod_offsets[sym - T]
+            u = draw() * (prod_offsets[sym - T + 1] - first)
+            column = int(u)
+            production = first + column
+            if tables is not None and u - column >= prob[production]:
+                production = alias[production]
+            push(rhs_reversed[production])
+
+        del out[n:]
+        if used_leaves:
+            leaves.touch(used_leaves)
+        return out
+
+    def expand_batch(
+        self,
+        symbol_ids: np.ndarray,
+        tables: SamplingTables | None = None,
+        rng: np.random.Generator | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Expand a batch of symbols breadth-first with vectorized NumPy ops.
+
+        All sentences are held in one flat array of symbol ids. Each pass
+        replaces every nonterminal in the array with a sampled production,
+        so a layered grammar is fully expanded in one pass per layer rather
+        than one Python step per symbol.
+
+        Args:
+            symbol_ids: 1-D array of symbol ids, one per sentence.
+            tables: optional alias tables for weighted production choice.
+                If None, productions are uniform.
+            rng: NumPy random generator. If None, a fresh default_rng()
+                is used.
+
+        Returns:
+            A (tokens, offsets) pair. tokens is the flat array of terminal
+            ids of every sentence concatenated, and sentence i is
+            tokens[offsets[i]:offsets[i + 1]].
+        """
+        if rng is None:
+            rng = np.random.default_rng()
+
+        T = self.num_terminals
+        prod_offsets, prod_counts, rhs_offsets, rhs_lengths, rhs_symbols = (
+            self._numpy_tables()
+        )
+
+        seq = np.asarray(symbol_ids, dtype=np.int64)
+        offsets = np.arange(len(seq) + 1, dtype=np.int64)
+
+        while True:
+            nt_positions = np.flatnonzero(seq >= T)
+            if len(nt_positions) == 0:
+                break
+
+            # Pick a production for every nonterminal in the frontier.
+            nt_index = seq[nt_positions] - T
+            u = rng.random(len(nt_positions)) * prod_counts[nt_index]
+            columns = u.astype(np.int64)
+            chosen = prod_offsets[nt_index] + columns
+            if tables is not None:
+                # Vectorized alias lookup: keep the column where the
+                # fractional part passes its threshold, else take the alias.
+                reject = (u - columns) >= tables.prob_array[chosen]
+                chosen[reject] = tables.alias_array[chosen[reject]]
+
+            # Every terminal keeps length 1; every nonterminal grows to the
+            # length of its chosen production. The exclusive prefix sum
+            # gives each old position its start in the new array.
+            lengths = np.ones(len(seq), dtype=np.int64)
+            lengths[nt_positions] = rhs_lengths[chosen]
+            starts = np.zeros(len(seq) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=starts[1:])
+
+            new_seq = np.empty(starts[-1], dtype=np.int64)
+            t_positions = np.flatnonzero(seq < T)
+            new_seq[starts[t_positions]] = seq[t_positions]
+
+            # Gather production bodies: position k of the production chosen
+            # at old position j is copied to starts[j] + k.
+            chosen_lengths = rhs_lengths[chosen]
+            total = int(chosen_lengths.sum())
+            run_starts = np.repeat(
+                np.cumsum(chosen_lengths) - chosen_lengths, chosen_lengths
+            )
+            within = np.arange(total, dtype=np.int64) - run_starts
+            src = np.repeat(rhs_offsets[chosen], chosen_lengths) + within
+            dst = np.repeat(starts[nt_positions], chosen_lengths) + within
+            new_seq[dst] = rhs_symbols[src]
+
+            # Sentence boundaries move with the positions they point at.
+            offsets = starts[offsets]
+            seq = new_seq
+
+        return seq, offsets
+
+    # ── Private helpers ─────────────────────────────────────────────────
+
+    def _numpy_tables(self) -> tuple[np.ndarray, ...]:
+        """NumPy views of the production tables, built once and cached."""
+        if self._np_tables is None:
+            prod_offsets = np.asarray(self.prod_offsets, dtype=np.int64)
+            rhs_offsets = np.asarray(self.rhs_offsets, dtype=np.int64)
+            self._np_tables = (
+                prod_offsets,
+                np.diff(prod_offsets),
+                rhs_offsets[:-1],
+                np.diff(rhs_offsets),
+                np.asarray(self.rhs_symbols, dtype=np.int64),
+            )
+        return self._np_tables
@@ -1,27 +1,124 @@
+import os
 import random
 import struct
+import sys
 from typing import Any
 
+import numpy as np
+
 from . import cfg_generator
 from .cfg_grammar import CFGrammar
+from .cfg_sampling import CounterRNG, IndexPermutation
+from .cfg_tokenfile import header_dtype, load_index, read_header, read_manifest
 
 import torch
 
+# Token files hold big-endian int32 ids (struct format "!i").
+_FILE_DTYPE = np.dtype(">i4")
+
+# Suffix of the native byte order copy made once for zero-copy loading.
+_NATIVE_SUFFIX = ".native"
+
+# Tokens converted per step when writing the native copy.
+_CONVERT_CHUNK = 1 << 22
+
 
 class CFGFileDataset(torch.utils.data.Dataset):
     """Dataset to load a cfg from a file.
 
-    The file needs to already contain token ids.
+    The file needs to already contain token ids, either in the version 2
+    format of cfg_tokenfile or in the legacy headerless format.
+
+    Version 2 files are always memory-mapped. Their header supplies the
+    window length, and is checked against window_length and grammar when
+    those are given. Windows are returned as int32 tensors.
+
+    Legacy files are windows of big-endian int32s, window_length (default
+    512) tokens each. By default the whole file is parsed into Python
+    lists up front. With mmap=True it is memory-mapped instead:
+    construction is instant, the pages are shared by every DataLoader
+    worker through the page cache, and each window is returned as a tensor
+    view of the mapping, without a copy. These tensors are int32 rather
+    than int64. The mapping is copy-on-write, so writes to a tensor stay
+    private to the process.
+
+    Legacy big-endian int32s can't be viewed by tensors directly. On
+    little-endian machines mmap mode converts the file once into a
+    native byte order copy next to it (filename + ".native") and maps
+    that; with native_copy=False it maps the original file and converts
+    each window as it is read.
+
+    filename may also be a directory of version 2 shards or its manifest
+    (see cfg_tokenfile.ShardedTokenWriter). The manifest's window counts
+    index every window of every shard; a shard is only memory-mapped when
+    one of its windows is first read.
 
+    For DistributedDataParallel, rank and world_size split the windows into
+    world_size equal, contiguous parts (dropping the last few windows if
+    they don't divide evenly) and the dataset serves part rank. With
+    shuffle=True the windows are visited in a pseudorandom order keyed on
+    seed and the epoch, the same on every rank, so the parts stay disjoint;
+    call set_epoch at the start of each epoch for a new order.
     """
 
-    def __init__(self, filename, device, window_length: int = 512):
+    def __init__(
+        self,
+        filename,
+        device,
+        window_length: int | None = None,
+        mmap: bool = False,
+        native_copy: bool = True,
+        grammar: CFGrammar | None = None,
+        rank: int = 0,
+        world_size: int = 1,
+        shuffle: bool = False,
+        seed: int = 0,
+    ):
         super().__init__()
+        if not 0 <= rank < world_size:
+            raise ValueError(f"rank {rank} out of range for world_size {world_size}.")
         self.device = device
         self.filename = filename
-        self.window_length = window_length
+        self.mmap = mmap
+        self.rank = rank
+        self.world_size = world_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
 
         self.dataset = []
+        self._windows = None
+        self._offset = 0
+        self._permutation = None
+
+        # Shards of a sharded dataset as (path, num_windows), None otherwise.
+        self.shards = None
+        # Header of a version 2 file or manifest, None for the legacy format.
+        self.header = None
+        if os.path.isdir(filename) or str(filename).endswith(".json"):
+            self._open_shards(window_length, grammar)
+            return
+
+        info = read_header(filename)
+        if info is not None:
+            self.header, self._offset = info
+            self._check_header(window_length, grammar)
+            self.window_length = self.header["window_length"]
+            self.mmap = True
+            self._mapped_path = filename
+            self._mapped_dtype = header_dtype(self.header)
+            self._num_windows = self._check_size(filename)
+            self.set_epoch(0)
+            return
+
+        self.window_length = 512 if window_length is None else window_length
+        if mmap:
+            # The mapping is opened on first access, and again in each
+            # worker after unpickling, so it is never pickled itself.
+            self._mapped_path, self._mapped_dtype = self._mapping_source(native_copy)
+            self._num_windows = self._check_size(self._mapped_path)
+            self.set_epoch(0)
+            return
 
         with open(self.filename, "rb") as f:
             while True:
@@ -39,15 +136,290 @@ class CFGFileDataset(torch.utils.data.Dataset):
 
                 token_list = list(struct.unpack(format_string, binary_chunk))
                 self.dataset.append(token_list)
+        self.set_epoch(0)
 
     def __getitem__(self, index):
-        return torch.tensor(self.dataset[index], device=self.device)
+        index = self._window_index(index)
+        if self.shards is not None:
+            shard = int(np.searchsorted(self._shard_starts, index, side="right")) - 1
+            window = self.shard_windows(shard)[index - self._shard_starts[shard]]
+        elif self.mmap:
+            window = self.windows[index]
+        else:
+            return torch.tensor(self.dataset[index], device=self.device)
+        if window.dtype != np.int32:
+            window = window.astype(np.int32)
+        return torch.from_numpy(window).to(self.device)
 
     def __len__(self):
+        if self.world_size > 1:
+            return self._num_items() // self.world_size
+        return self._num_items()
+
+    def set_epoch(self, epoch: int) -> None:
+        """Select the window order of an epoch when shuffling.
+
+        Every rank must use the same seed and epoch so that their parts of
+        the shuffled order don't overlap.
+        """
+        self.epoch = epoch
+        num_items = self._num_items()
+        self._permutation = None
+        if self.shuffle and num_items:
+            self._permutation = IndexPermutation(num_items, f"{self.seed}:{epoch}")
+
+    @property
+    def windows(self) -> np.ndarray:
+        """The memory-mapped (num_windows, window_length) token array."""
+        if self.shards is not None:
+            raise ValueError(
+                "A sharded dataset has no single window array; use shard_windows."
+            )
+        if self._windows is None:
+            self._windows = np.memmap(
+                self._mapped_path,
+                dtype=self._mapped_dtype,
+                mode="c",
+                offset=self._offset,
+                shape=(self._num_windows, self.window_length),
+            )
+        return self._windows
+
+    def shard_windows(self, shard: int) -> np.ndarray:
+        """The memory-mapped window array of one shard, mapped on first use."""
+        windows = self._shard_windows.get(shard)
+        if windows is None:
+            path, num_windows = self.shards[shard]
+            info = read_header(path)
+            if info is None:
+                raise ValueError(f"Shard {path!r} is not a version 2 token file.")
+            header, offset = info
+            if (
+                header["window_length"] != self.window_length
+                or header["dtype"] != self.header["dtype"]
+            ):
+                raise ValueError(f"Shard {path!r} doesn't match its manifest.")
+            windows = np.memmap(
+                path,
+                dtype=header_dtype(header),
+                mode="c",
+                offset=offset,
+                shape=(num_windows, self.window_length),
+            )
+            self._shard_windows[shard] = windows
+        return windows
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_windows"] = None
+        if self.shards is not None:
+            state["_shard_windows"] = {}
+        return state
+
+    # ── Private helpers ─────────────────────────────────────────────────
+
+    def _num_items(self) -> int:
+        """Number of windows before partitioning across ranks."""
+        if self.shards is not None:
+            return int(self._shard_starts[-1])
+        if self.header is not None:
+            return self._num_windows
+        # Legacy files have always left out their last window.
+        if self.mmap:
+            return self._num_windows - 1
         return len(self.dataset) - 1
 
+    def _window_index(self, index: int) -> int:
+        """Map an index into this rank's part to a window of the dataset."""
+        if self.world_size == 1 and self._permutation is None:
+            if self.shards is not None and index < 0:
+                index += self._num_items()
+            return index
+        length = len(self)
+        if not -length <= index < length:
+            raise IndexError(f"Window {index} out of range.")
+        position = self.rank * length + index % length
+        if self._permutation is not None:
+            position = self._permutation[position]
+        return position
+
+    def _open_shards(self, window_length: int | None, grammar: CFGrammar | None) -> None:
+        """Read the manifest of a sharded dataset and index its windows."""
+        self.header = read_manifest(self.filename)
+        self._check_header(window_length, grammar)
+        self.window_length = self.header["window_length"]
+        self.mmap = True
+        self.shards = [
+            (shard["path"], shard["num_windows"]) for shard in self.header["shards"]
+        ]
+        # First global window index of each shard; searchsorted finds the
+        # shard of a window.
+        self._shard_starts = np.cumsum(
+            [0] + [num_windows for _, num_windows in self.shards], dtype=np.int64
+        )
+        self._shard_windows: dict[int, np.memmap] = {}
+        self.set_epoch(0)
+
+    def _check_size(self, path) -> int:
+        """Number of whole windows in a token file; raise on a partial one."""
+        window_bytes = self.window_length * self._mapped_dtype.itemsize
+        size = os.path.getsize(path) - self._offset
+        if size % window_bytes:
+            raise ValueError(
+                f"Unexpected end of file or corrupted data. Expected a multiple "
+                f"of {window_bytes} bytes, got {size}."
+            )
+        return size // window_bytes
+
+    def _check_header(self, window_length: int | None, grammar: CFGrammar | None) -> None:
+        """Raise if a version 2 header contradicts the caller's settings."""
+        header = self.header
+        if window_length is not None and window_length != header["window_length"]:
+            raise ValueError(
+                f"{self.filename!r} has windows of {header['window_length']} "
+                f"tokens, not {window_length}."
+            )
+        if grammar is not None and grammar.digest != header["grammar_digest"]:
+            raise ValueError(
+                f"{self.filename!r} was generated from grammar "
+                f"{header['grammar']!r} with a different digest."
+            )
+
+    def _mapping_source(self, native_copy: bool) -> tuple[str, np.dtype]:
+        """File and dtype to map, converting to native byte order if asked."""
+        if sys.byteorder == "big" or not native_copy:
+            return self.filename, _FILE_DTYPE
+        native_path = str(self.filename) + _NATIVE_SUFFIX
+        if not (
+            os.path.exists(native_path)
+            and os.path.getsize(native_path) == os.path.getsize(self.filename)
+            and os.path.getmtime(native_path) >= os.path.getmtime(self.filename)
+        ):
+            convert_to_native(self.filename, native_path)
+        return native_path, np.dtype(np.int32)
+
+
+class CFGSentenceDataset(CFGFileDataset):
+    """Per-sentence access to a token file through its sentence index.
+
+    Instead of fixed windows, item i is either sentence i, from its BOS to
+    its EOS token (mode="sentence"), or the window_length tokens starting
+    at sentence i's BOS (mode="window"), so windows always begin on a
+    sentence boundary. Both are a lookup in the memory-mapped index and a
+    slice of the memory-mapped tokens; nothing is scanned at read time.
+
+    The index is the filename + ".idx" sidecar written by TokenFileWriter
+    (or by cfg_tokenfile.build_index for older files).
+    """
+
+    def __init__(
+        self,
+        filename,
+        device,
+        mode: str = "sentence",
+        window_length: int | None = None,
+        include_special: bool = True,
+        native_copy: bool = True,
+    ):
+        """Map the token file and its sentence index.
+
+        Args:
+            filename: the token file, in either format.
+            device: device the returned tensors are moved to.
+            mode: "sentence" for whole sentences, "window" for
+                sentence-aligned windows.
+            window_length: window size of the file (legacy files only,
+                default 512). Also the size of sentence-aligned windows.
+            include_special: whether sentences keep their BOS and EOS
+                tokens. Ignored in window mode.
+            native_copy: as for CFGFileDataset.
+        """
+        if mode not in ("sentence", "window"):
+            raise ValueError(f"Unknown mode {mode!r}; expected 'sentence' or 'window'.")
+        super().__init__(
+            filename, device, window_length, mmap=True, native_copy=native_copy
+        )
+        if self.shards is not None:
+            raise ValueError("CFGSentenceDataset reads a single token file, not shards.")
+        self.mode = mode
+        self.include_special = include_special
+        self._sentences = None
+        num_tokens = self._num_windows * self.window_length
+        self._num_sentences = len(self.sentences)
+        if self._num_sentences and int(self.sentences[-1, 1]) >= num_tokens:
+            raise ValueError(f"Sentence index of {filename!r} is past the end of the file.")
+        if mode == "window":
+            # Only sentences with a whole window of tokens after their start.
+            starts = np.asarray(self.sentences[:, 0])
+            self._num_sentences = int(np.searchsorted(
+                starts, num_tokens - self.window_length, side="right"
+            ))
+
+    @property
+    def sentences(self) -> np.ndarray:
+        """The memory-mapped (num_sentences, 2) array of BOS/EOS positions."""
+        if self._sentences is None:
+            self._sentences = load_index(self.filename)
+        return self._sentences
+
+    @property
+    def tokens(self) -> np.ndarray:
+        """Every token of the file as one flat memory-mapped array."""
+        return self.windows.reshape(-1)
+
+    def __getitem__(self, index):
+        if not -self._num_sentences <= index < self._num_sentences:
+            raise IndexError(f"Sentence {index} out of range.")
+        start, end = (int(x) for x in self.sentences[index])
+        if self.mode == "window":
+            end = start + self.window_length
+        elif self.include_special:
+            end += 1
+        else:
+            start += 1
+        tokens = self.tokens[start:end]
+        if tokens.dtype != np.int32:
+            tokens = tokens.astype(np.int32)
+        return torch.from_numpy(tokens).to(self.device)
+
+    def __len__(self):
+        return self._num_sentences
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["_sentences"] = None
+        return state
+
+
+def convert_to_native(filename, output_path) -> None:
+    """Write a copy of a big-endian token file in native byte order.
+
+    Converts in fixed-size chunks, so memory use doesn't grow with the file.
+    The copy is written to a temporary name and renamed into place, so a
+    concurrent reader never maps a half-written file.
+    """
+    source = np.memmap(filename, dtype=_FILE_DTYPE, mode="r")
+    tmp_path = f"{output_path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        for start in range(0, len(source), _CONVERT_CHUNK):
+            source[start:start + _CONVERT_CHUNK].astype(np.int32).tofile(f)
+    del source
+    os.replace(tmp_path, output_path)
+
 
 class CFGRandomGenerationDataset(torch.utils.data.IterableDataset):
+    """Windows of freshly generated sentences, window_length tokens each.
+
+    num_generations is a token budget: iteration yields
+    ceil(num_generations / window_length) windows. In a DataLoader with
+    several workers the windows are divided between the workers, and each
+    worker generates from its own CounterRNG stream: (seed, worker id) when
+    a seed is given, so the data is reproducible for a fixed number of
+    workers, else the per-worker seed PyTorch assigns. A seeded dataset
+    outside a DataLoader worker uses stream 0, matching a single worker.
+    Without a seed or workers, the global random module is used.
+    """
+
     def __init__(
         self,
         cfg_rules: dict[str, list[list[str]]] | CFGrammar,
@@ -55,6 +427,7 @@ class CFGRandomGenerationDataset(torch.utils.data.IterableDataset):
         tokenizer: Any,
         device: torch.device = torch.device("cpu"),
         window_length: int = 512,
+        seed: int | None = None,
     ):
         """Each CFG could be drawn from infinite times. To satisfy PyTorch Dataset, we ask for the length."""
         super().__init__()
@@ -75,6 +448,12 @@ class CFGRandomGenerationDataset(torch.utils.data.IterableDataset):
         self.window_length = window_length
         self.tokenizer = tokenizer
         self.device = device
+        self.seed = seed
+
+        # Token budget of the current iteration and its random source
+        # (None for the global random module); set by __iter__.
+        self._stop = num_generations
+        self._rng = None
 
         # Make the first token the Eos token as it's the divider token between datasets.
         self.generation_buffer = []
@@ -85,11 +464,26 @@ class CFGRandomGenerationDataset(torch.utils.data.IterableDataset):
     def __iter__(self):
         # Reset our internal count when we're asked to iterate again.
         self.idx = 0
+        self._stop = len(self)
+        self._rng = None
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            # This worker's share of the windows, from its own stream.
+            num_windows = -(-len(self) // self.window_length)
+            share, extra = divmod(num_windows, worker_info.num_workers)
+            share += worker_info.id < extra
+            self._stop = share * self.window_length
+            seed = worker_info.seed if self.seed is None else self.seed
+            self._rng = CounterRNG(seed, worker_info.id)
+            self.generation_buffer = []
+        elif self.seed is not None:
+            self._rng = CounterRNG(self.seed, 0)
+            self.generation_buffer = []
         return self
 
     def __next__(self):
         # Exit if we've completed all iterations.
-        if self.idx >= len(self):
+        if self.idx >= self._stop:
             raise StopIteration
 
         # Fill our generation buffer up to our widow length.
@@ -97,7 +491,7 @@ class CFGRandomGenerationDataset(torch.utils.data.IterableDataset):
             self.generation_buffer.extend(self.tokenizer.bos_token)
             self.generation_buffer.extend(
                 self.tokenizer.encode(c)[0]
-                for c in self.grammar.generate()
+                for c in self.grammar.generate(rng=self._rng)
             )
             self.generation_buffer.extend(self.tokenizer.eos_token)
 
@@ -0,0 +1,306 @@
+# Grammar-constrained decoding masks.
+#
+# A language model sampling from a grammar needs, at every step and for
+# every row of the batch, the set of tokens that keep the row's prefix
+# valid. Recomputing that set per row in Python means one parser step and
+# one Python-built mask per row per step. Here each distinct parser
+# configuration is computed once: configurations are interned as integer
+# states whose transitions and masks live in NumPy arrays, so a decoding
+# step is two array gathers, and the parser only runs for (state, token)
+# pairs that have never been seen before.
+#
+# A state is an Earley set (see cfg_parser) in which each item refers to
+# the state of its origin set instead of to a position. Every later set is
+# built from the current set's items and, through completions, from the
+# sets their origins name, so two prefixes whose current sets intern to the
+# same state allow exactly the same continuations, however they got there.
+# Different prefixes therefore share states, within a batch and across
+# batches, and no per-prefix chart is kept.
+
+import numpy as np
+
+from .cfg_grammar import CFGrammar
+from .cfg_tokenizers import CFGCharacterTokenizer
+
+# Reserved states. A dead row has fed an illegal token and allows nothing;
+# a finished row has fed eos after a complete sentence and allows only eos,
+# so it can keep padding while the rest of the batch decodes. The root
+# state is the Earley set of the empty prefix.
+DEAD_STATE = 0
+FINISHED_STATE = 1
+ROOT_STATE = 2
+
+# reset() starts the state tables over once they hold more states than this.
+_MAX_STATES = 1 << 16
+
+
+class GrammarMask:
+    """Per-row parser state and next-token masks for a batch of prefixes.
+
+    Masks are in the id space of a CFGCharacterTokenizer: mask[row, t] is
+    True if token t may come next in that row. eos_token is allowed once a
+    row's prefix is a complete sentence; bos_token is never allowed.
+
+    Example:
+        masker = GrammarMask(grammar, tokenizer, return_tensors="pt")
+        mask = masker.reset(batch_size)
+        while not masker.finished.all():
+            logits[~mask] = -inf
+            tokens = sample(logits)
+            mask = masker.step(tokens)
+    """
+
+    def __init__(
+        self,
+        grammar: CFGrammar,
+        tokenizer: CFGCharacterTokenizer,
+        start_symbol: str | None = None,
+        return_tensors: str = "np",
+        device=None,
+        max_states: int = _MAX_STATES,
+    ) -> None:
+        """Set up the state tables.
+
+        Args:
+            grammar: the grammar prefixes must follow.
+            tokenizer: tokenizer whose vocabulary contains every terminal.
+            start_symbol: as for CFGrammar.validate.
+            return_tensors: "np" for NumPy arrays or "pt" for torch tensors.
+            device: torch device for returned masks when return_tensors is
+                "pt".
+            max_states: bound on the state tables. States are kept across
+                batches, and reset() discards them all once there are more
+                than this many.
+        """
+        if return_tensors not in ("np", "pt"):
+            raise ValueError(
+                f'return_tensors must be "np" or "pt", got {return_tensors!r}.'
+            )
+        self.grammar = grammar
+        self.tokenizer = tokenizer
+        self.return_tensors = return_tensors
+        self.device = device
+        self.vocab_size = len(tokenizer)
+        self.eos_id = tokenizer.eos_token[0]
+
+        # Map tokenizer ids to grammar terminal ids. Tokens that are not
+        # terminals (eos, bos, unused characters) map to None.
+        compiled = grammar.compiled
+        self._terminal_of: list[int | None] = [None] * self.vocab_size
+        self._token_of = np.empty(compiled.num_terminals, dtype=np.int64)
+        for t in range(compiled.num_terminals):
+            symbol = compiled.symbols[t]
+            if symbol not in tokenizer.encode_vocab:
+                raise ValueError(
+                    f"Terminal {symbol!r} is not in the tokenizer vocabulary."
+                )
+            token = tokenizer.encode_vocab[symbol]
+            self._terminal_of[token] = t
+            self._token_of[t] = token
+
+        self._parser = grammar.parser
+        symbols = grammar.start_symbols if start_symbol is None else [start_symbol]
+        self._start_ids = frozenset(compiled.symbol_id(s) for s in symbols)
+        self.max_states = max_states
+        self._clear()
+
+        self.states = np.empty(0, dtype=np.int64)
+
+    # ── Decoding ────────────────────────────────────────────────────────
+
+    def reset(self, batch_size: int):
+        """Start batch_size empty prefixes and return their first mask."""
+        if self.num_states > self.max_states:
+            self._clear()
+        self.states = np.full(batch_size, ROOT_STATE, dtype=np.int64)
+        return self.mask()
+
+    def step(self, token_ids):
+        """Append one token to every row and return the new [batch, vocab] mask.
+
+        Args:
+            token_ids: one token id per row, as a sequence, NumPy array or
+                torch tensor.
+        """
+        if hasattr(token_ids, "cpu"):
+            token_ids = token_ids.cpu().numpy()
+        tokens = np.asarray(token_ids, dtype=np.int64).reshape(-1)
+        if tokens.shape != self.states.shape:
+            raise ValueError(
+                f"Expected {len(self.states)} token ids, got {len(tokens)}."
+            )
+
+        next_states = self._transitions[self.states, tokens]
+        # Only (state, token) pairs never seen before go through the parser.
+        unknown = np.flatnonzero(next_states < 0)
+        if len(unknown):
+            pairs = np.unique(
+                np.stack([self.states[unknown], tokens[unknown]], axis=1), axis=0
+            )
+            for state, token in pairs.tolist():
+                self._expand(state, token)
+            next_states = self._transitions[self.states, tokens]
+
+        self.states = next_states
+        return self.mask()
+
+    def mask(self):
+        """Return the current [batch, vocab] mask of legal next tokens."""
+        return self._output(self._masks[self.states])
+
+    @property
+    def complete(self) -> np.ndarray:
+        """Per-row flag: the prefix is a complete sentence (or finished)."""
+        return self._complete[self.states] | (self.states == FINISHED_STATE)
+
+    @property
+    def finished(self) -> np.ndarray:
+        """Per-row flag: the row has fed eos after a complete sentence."""
+        return self.states == FINISHED_STATE
+
+    @property
+    def viable(self) -> np.ndarray:
+        """Per-row flag: no illegal token has been fed."""
+        return self.states != DEAD_STATE
+
+    # ── Private helpers ─────────────────────────────────────────────────
+
+    def _clear(self) -> None:
+        """Empty the state tables, leaving the reserved and root states."""
+        # _transitions[state, token] is the successor state, or -1 if it
+        # has not been computed yet. _masks[state] is the state's mask.
+        capacity = 64
+        self._transitions = np.full((capacity, self.vocab_size), -1, dtype=np.int64)
+        self._masks = np.zeros((capacity, self.vocab_size), dtype=bool)
+        self._complete = np.zeros(capacity, dtype=bool)
+        # The Earley set of each state: non-predicted items by next symbol,
+        # packed as origin state * num_dotted + dotted rule, and the
+        # predicted items table.
+        self._waiting: list[dict | None] = [None] * capacity
+        self._predicted: list[dict | None] = [None] * capacity
+        # State ids of interned sets, keyed by their contents.
+        self._ids: dict[tuple, int] = {}
+
+        self._transitions[DEAD_STATE] = DEAD_STATE
+        self._transitions[FINISHED_STATE] = DEAD_STATE
+        self._transitions[FINISHED_STATE, self.eos_id] = FINISHED_STATE
+        self._masks[FINISHED_STATE, self.eos_id] = True
+        self.num_states = ROOT_STATE
+
+        # The root is never interned, so no later set can stand in for it
+        # as the origin of a complete sentence.
+        parser = self._parser
+        T = parser.compiled.num_terminals
+        roots = 0
+        for start_id in self._start_ids:
+            roots |= parser.closure[start_id - T]
+        accepted = any(parser.nullable[start_id] for start_id in self._start_ids)
+        self._add_state({}, roots, accepted)
+
+    def _expand(self, state: int, token: int) -> None:
+        """Compute and record the successor of state on token."""
+        if not self._masks[state, token]:
+            self._transitions[state, token] = DEAD_STATE
+            return
+        if token == self.eos_id:
+            self._transitions[state, token] = FINISHED_STATE
+            return
+
+        # Scan, as EarleyParser.scan, then close the new set as
+        # EarleyParser._process does, with origins named by state.
+        parser = self._parser
+        T = parser.compiled.num_terminals
+        D = parser.num_dotted
+        next_symbol = parser.next_symbol
+        item_lhs = parser.item_lhs
+        nullable = parser.nullable
+        closure = parser.closure
+        terminal = self._terminal_of[token]
+        work = [key + 1 for key in self._waiting[state].get(terminal, ())]
+        base = state * D + 1
+        work.extend(base + d for d in self._predicted[state].get(terminal, ()))
+
+        seen = set()
+        waiting: dict[int, list[int]] = {}
+        roots = 0
+        accepted = False
+        while work:
+            key = work.pop()
+            if key in seen:
+                continue
+            seen.add(key)
+            origin, d = divmod(key, D)
+            sym = next_symbol[d]
+            if sym < 0:
+                lhs = item_lhs[d]
+                if origin == ROOT_STATE and lhs in self._start_ids:
+                    accepted = True
+                parents = self._waiting[origin].get(lhs)
+                if parents:
+                    work.extend([k + 1 for k in parents])
+                predicted = self._predicted[origin].get(lhs)
+                if predicted:
+                    base = origin * D + 1
+                    work.extend([base + p for p in predicted])
+                continue
+            waiting.setdefault(sym, []).append(key)
+            if sym >= T:
+                roots |= closure[sym - T]
+                if nullable[sym]:
+                    work.append(key + 1)
+
+        key = (
+            frozenset(k for keys in waiting.values() for k in keys),
+            roots,
+            accepted,
+        )
+        successor = self._ids.get(key)
+        if successor is None:
+            successor = self._add_state(waiting, roots, accepted)
+            self._ids[key] = successor
+        self._transitions[state, token] = successor
+
+    def _add_state(self, waiting: dict, roots: int, accepted: bool) -> int:
+        """Add an Earley set as a new state and return its id."""
+        state = self.num_states
+        if state == len(self._waiting):
+            self._grow()
+        self.num_states += 1
+
+        parser = self._parser
+        T = parser.compiled.num_terminals
+        predicted = parser.prediction_table(roots)
+        self._waiting[state] = waiting
+        self._predicted[state] = predicted
+        mask = self._masks[state]
+        allowed = [t for t in waiting if t < T] + [t for t in predicted if t < T]
+        if allowed:
+            mask[self._token_of[allowed]] = True
+        if accepted:
+            mask[self.eos_id] = True
+            self._complete[state] = True
+        # Illegal tokens lead straight to the dead state.
+        self._transitions[state, ~mask] = DEAD_STATE
+        return state
+
+    def _grow(self) -> None:
+        """Double the capacity of the state tables."""
+        capacity = len(self._waiting)
+        self._transitions = np.concatenate(
+            [self._transitions, np.full_like(self._transitions, -1)]
+        )
+        self._masks = np.concatenate([self._masks, np.zeros_like(self._masks)])
+        self._complete = np.concatenate(
+            [self._complete, np.zeros_like(self._complete)]
+        )
+        self._waiting.extend([None] * capacity)
+        self._predicted.extend([None] * capacity)
+
+    def _output(self, mask: np.ndarray):
+        """Convert a NumPy mask to the requested tensor type."""
+        if self.return_tensors == "pt":
+            import torch
+
+            tensor = torch.from_numpy(mask)
+            return tensor if self.device is None else tensor.to(self.device)
+        return mask
@@ -0,0 +1,169 @@
+# Immutable, normalized grammar rules.
+#
+# CFGrammar keeps the caller's rules dict by reference, so every lazy cache
+# is only as fresh as the caller's promise not to mutate it, and a dict can
+# be neither hashed nor used as a cache key. FrozenRules is a read-only
+# Mapping over tuples that hashes by content and pickles cheaply, so a
+# frozen grammar can key caches and be shipped to worker processes.
+#
+# Freezing also normalizes the rules. Unproductive symbols (which derive no
+# string) and the productions that use them are dropped, then everything
+# not reachable from the roots, then repeated productions are merged.
+# Pruning leaves the language and the derivations unchanged; merging
+# changes derivation counts and rule-uniform sampling, so for every kept
+# production the original production indices it stands for are recorded,
+# and weights written for the original rules can be carried over.
+#
+# FrozenWeights does the same for production weights: CFGrammar keys its
+# per-weights tables on a frozen copy, so equal weights share tables and a
+# dict changed in place is never served tables built from its old values.
+
+import sys
+from collections.abc import Mapping
+
+
+class FrozenRules(Mapping):
+    """Read-only grammar rules: nonterminal -> tuple of production tuples.
+
+    Equal rules (same nonterminals in the same order with the same
+    productions) compare equal and hash alike.
+    """
+
+    def __init__(self, cfg_rules: Mapping) -> None:
+        # Interned strings make the many repeated symbol names share
+        # storage and compare by identity first.
+        self._rules = {
+            sys.intern(nt): tuple(
+                tuple(sys.intern(sym) for sym in production)
+                for production in productions
+            )
+            for nt, productions in cfg_rules.items()
+        }
+        self._hash = hash(tuple(self._rules.items()))
+
+    def __getitem__(self, nonterminal: str) -> tuple[tuple[str, ...], ...]:
+        return self._rules[nonterminal]
+
+    def __iter__(self):
+        return iter(self._rules)
+
+    def __len__(self) -> int:
+        return len(self._rules)
+
+    def __hash__(self) -> int:
+        return self._hash
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, FrozenRules):
+            return self._hash == other._hash and (
+                list(self._rules.items()) == list(other._rules.items())
+            )
+        return Mapping.__eq__(self, other)
+
+    def __reduce__(self):
+        return (FrozenRules, (self._rules,))
+
+    def __repr__(self) -> str:
+        return f"FrozenRules({self._rules!r})"
+
+
+class FrozenWeights(Mapping):
+    """Read-only production weights: nonterminal -> tuple of weights.
+
+    Equal weights compare equal and hash alike. The hash is computed once,
+    so passing the same FrozenWeights to CFGrammar.generate repeatedly
+    looks its tables up in O(1); a plain dict is frozen on every call.
+    """
+
+    def __init__(self, weights: Mapping) -> None:
+        self._weights = {nt: tuple(w) for nt, w in weights.items()}
+        self._hash = hash(tuple(self._weights.items()))
+
+    def __getitem__(self, nonterminal: str) -> tuple:
+        return self._weights[nonterminal]
+
+    def __iter__(self):
+        return iter(self._weights)
+
+    def __len__(self) -> int:
+        return len(self._weights)
+
+    def __hash__(self) -> int:
+        return self._hash
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, FrozenWeights):
+            return self._hash == other._hash and self._weights == other._weights
+        return Mapping.__eq__(self, other)
+
+    def __reduce__(self):
+        return (FrozenWeights, (self._weights,))
+
+    def __repr__(self) -> str:
+        return f"FrozenWeights({self._weights!r})"
+
+
+def freeze_weights(weights: Mapping | None) -> "FrozenWeights | None":
+    """Return weights as FrozenWeights, without copying ones that already are."""
+    if weights is None or isinstance(weights, FrozenWeights):
+        return weights
+    return FrozenWeights(weights)
+
+
+def normalize_rules(
+    cfg_rules: Mapping, compiled, roots: list[str], merge: bool = True
+) -> tuple[dict[str, list[list[str]]], dict[str, list[list[int]]]]:
+    """Prune and deduplicate grammar rules.
+
+    Args:
+        cfg_rules: the original rules.
+        compiled: the CompiledGrammar of cfg_rules.
+        roots: the nonterminals to keep everything reachable from.
+        merge: whether to merge repeated productions. Without merging,
+            every kept production stands for exactly one original one.
+
+    Returns:
+        A (rules, sources) pair. rules is the normalized rules dict, in
+        the original order of nonterminals and productions. sources[nt][j]
+        lists the indices, among nt's original productions, that
+        production j of the normalized rules stands for.
+    """
+    min_lengths = compiled.analysis.min_lengths
+    productive = {
+        nt for nt in cfg_rules if min_lengths[compiled.symbol_id(nt)] is not None
+    }
+
+    # Productions that only use productive symbols, duplicates merged
+    # unless merge is off.
+    kept: dict[str, list[tuple[tuple[str, ...], list[int]]]] = {}
+    for nt in cfg_rules:
+        if nt not in productive:
+            continue
+        productions: dict[tuple[str, ...], list[int]] = {}
+        unmerged = []
+        for i, production in enumerate(cfg_rules[nt]):
+            if all(sym in productive or sym not in cfg_rules for sym in production):
+                if merge:
+                    productions.setdefault(tuple(production), []).append(i)
+                else:
+                    unmerged.append((tuple(production), [i]))
+        kept[nt] = list(productions.items()) if merge else unmerged
+
+    # Reachability from the roots over the kept productions.
+    reachable = set()
+    stack = [nt for nt in roots if nt in kept]
+    while stack:
+        nt = stack.pop()
+        if nt in reachable:
+            continue
+        reachable.add(nt)
+        for production, _ in kept[nt]:
+            stack.extend(sym for sym in production if sym in kept)
+
+    rules = {}
+    sources = {}
+    for nt, productions in kept.items():
+        if nt in reachable:
+            rules[nt] = [list(production) for production, _ in productions]
+            sources[nt] = [group for _, group in productions]
+    return rules, sources
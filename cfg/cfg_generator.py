@@ -3,9 +3,13 @@
 # operations, prefer the CFGrammar class in cfg_grammar.py which caches
 # derived state like terminal symbols, start symbols, and generation counts.
 
+import functools
 import random
 from typing import Any
 
+from .cfg_frozen import FrozenRules
+from .cfg_grammar import CFGrammar
+
 
 def generate_from_cfg(
     symbol: str,
@@ -84,93 +88,34 @@ def get_start_symbols(cfg_rules) -> list[str]:
     return list(start_symbols)
 
 
-# Only works with no cyclic dependencies. I forget if this is a pretense of CFGs.
 def get_longest_sequence(start_symbol, cfg_rules):
-    terminal_symbols = set(get_terminal_symbols(cfg_rules))
-    cfg_lengths = {ts: 1 for ts in terminal_symbols}
-    rules = list(cfg_rules.keys())
+    # Delegates to a cached CFGrammar, whose analysis pass resolves every
+    # nonterminal in one sweep and raises ValueError on recursive grammars
+    # instead of looping forever.
+    return _cached_grammar(cfg_rules).get_longest_sequence(start_symbol)
 
-    while rules:
-        next_rule = rules.pop()
-        nts_set = set(_flatten_symbols(cfg_rules[next_rule]))
-        calculate_length = True
-        for nts in nts_set:
-            # if we don't find all the symbols we need in our lengths, skip for now.
-            if nts not in cfg_lengths:
-                calculate_length = False
-                break
-
-        if calculate_length:
-            generation_lengths = []
-            for generation_list in cfg_rules[next_rule]:
-                list_length = 0
-                for generation_rule in generation_list:
-                    list_length += cfg_lengths[generation_rule]
-                generation_lengths.append(list_length)
-            cfg_lengths[next_rule] = max(generation_lengths)
-        else:
-            rules.append(next_rule)
 
-    return cfg_lengths[start_symbol]
+def validate_string(
+    input: str, start_symbol: str, cfg_rules: dict[str, str] | CFGrammar
+):
+    # Delegates to a cached CFGrammar so the parser tables are built once per
+    # grammar rather than on every call. Passing a CFGrammar skips the cache
+    # lookup altogether.
+    return _cached_grammar(cfg_rules).validate(input, start_symbol)
 
 
-def validate_string(input: str, start_symbol: str, cfg_rules: dict[str, str]):
-    # TODO: derive the start symbol(s)
+# Grammars built by _cached_grammar, keyed by their rules' content: freezing
+# a rules dict costs one pass over it, so a mutated dict gets a fresh grammar
+# and the cache never holds on to the caller's dicts.
+_GRAMMAR_CACHE_SIZE = 8
 
-    # Reverse dictionary.
-    reverse_cfg_rules = {}
-    for k, values in cfg_rules.items():
-        for v in values:
-            reverse_cfg_rules[tuple(v)] = k
 
-    # Find all terminal symbols in cfg.
-    terminal_symbols = get_terminal_symbols(cfg_rules)
-
-    # Split input string into array of terminal symbols.
-    # WARNING: this won't work if terminal symbols overlap ('1' and '11').
-    #   We can adopt a DP approach like parse_cfg if this is needed.
-    max_t = max(len(t) for t in terminal_symbols)
-    start = 0
-    stop = 1
-    tape = []
-    while stop <= len(input):
-        found_t = False
-        while stop - start <= max_t and not found_t:
-            if input[start:stop] in terminal_symbols:
-                tape.append(input[start:stop])
-                start = stop
-                found_t = True
-            stop += 1
-        # If there is a non-terminal symbol then it's not a valid cfg.
-        if not found_t:
-            return False
-
-    max_symbol_len = max([len(key) for key in reverse_cfg_rules.keys()])
-
-    def parse_cfg(input_tape, output_tape):
-        # If our input tape is empty and we still have an output tape:
-        if not input_tape and output_tape:
-            # Check if the output tape is the start symbol.
-            if output_tape == [start_symbol]:
-                return True
-            # Otherwise parse the output tokens.
-            else:
-                return parse_cfg(output_tape, [])
-        # If there is no valid input or output tape exit.
-        elif not input_tape and not output_tape:
-            return False
-
-        # Try matching every window length from the input to the rules.
-        for window in range(1, max_symbol_len + 1):
-            next_tuple = tuple(input_tape[:window])
-            # If we get a window match, continue parsing.
-            if next_tuple in reverse_cfg_rules and parse_cfg(
-                input_tape[window:], output_tape + [reverse_cfg_rules[next_tuple]]
-            ):
-                return True
-
-        # If there are no true matches, return false.
-        return False
-
-    # return parse_cfg(tape, [start_symbol], reverse_cfg_rules)
-    return parse_cfg(tape, [])
+def _cached_grammar(cfg_rules) -> CFGrammar:
+    if isinstance(cfg_rules, CFGrammar):
+        return cfg_rules
+    return _grammar_for(FrozenRules(cfg_rules))
+
+
+@functools.lru_cache(maxsize=_GRAMMAR_CACHE_SIZE)
+def _grammar_for(rules: FrozenRules) -> CFGrammar:
+    return CFGrammar(rules)
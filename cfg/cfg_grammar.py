@@ -4,7 +4,38 @@
 # counts, sampling weights) so they are computed once rather than re-derived
 # on every call.
 
+import hashlib
+import json
 import random
+from collections.abc import Iterable, Iterator
+
+import numpy as np
+
+from .cfg_analysis import GrammarAnalysis
+from .cfg_automaton import Automaton, build_automata
+from .cfg_compiled import CompiledGrammar
+from .cfg_frozen import FrozenRules, FrozenWeights, freeze_weights, normalize_rules
+from .cfg_leaves import LeafCache
+from .cfg_lengths import LengthTables
+from .cfg_lexer import TerminalLexer
+from .cfg_parser import EarleyParser, PrefixRecognizer
+from .cfg_partition import expected_lengths, partition_functions
+from .cfg_ranking import DerivationRanker
+from .cfg_sampling import IndexPermutation, SamplingTables
+from .cfg_statistics import SentenceStatistics, production_probabilities
+
+# Number of distinct weights dicts whose alias tables are kept per grammar.
+_SAMPLER_CACHE_SIZE = 8
+
+# Default leaf cache limits: nonterminals with at most this many derivations
+# are expanded from cached string tables, holding at most this many tokens
+# per set of weights.
+_LEAF_MAX_STRINGS = 4096
+_LEAF_MAX_TOKENS = 1 << 20
+
+# Compiled forms of frozen rules, shared by every CFGrammar with equal rules.
+_compiled_cache: dict[FrozenRules, CompiledGrammar] = {}
+_COMPILED_CACHE_SIZE = 8
 
 
 class CFGrammar:
@@ -14,16 +45,24 @@ class CFGrammar:
     production rules, where each rule is a list of symbols (terminals or
     nonterminals). This is the same dict[str, list[list[str]]] format used
     throughout the cfg package.
+
+    The dict is kept by reference, so it must not be mutated once cached
+    state has been computed. freeze() returns a normalized grammar over
+    immutable FrozenRules instead; frozen grammars are hashable, compare by
+    their rules, and share one compiled form per distinct set of rules.
     """
 
     def __init__(
         self,
-        cfg_rules: dict[str, list[list[str]]],
+        cfg_rules: dict[str, list[list[str]]] | FrozenRules,
         name: str | None = None,
     ) -> None:
         # Store the raw grammar dict and optional name for display.
         self.rules = cfg_rules
         self.name = name
+        # For grammars made by freeze(): per nonterminal, the indices of the
+        # original productions each production stands for.
+        self.sources: dict[str, list[list[int]]] | None = None
 
         # Nonterminal symbols are exactly the keys of the grammar dict.
         # Every key has at least one production rule.
@@ -57,9 +96,32 @@ class CFGrammar:
         # Lazy caches. These are computed on first access because they
         # require a full traversal of the grammar and are not always needed.
         self._uniform_weights = None
-        self._generation_counts = {}
-        self._longest_sequences = {}
-        self._reverse_rules = None
+        self._uniform_probabilities = None
+        # Pruned rules behind the two above; see _used_grammar.
+        self._used = None
+        # Frozen copies of uniform_probabilities and of equal weights, the
+        # weights generate uses by itself.
+        self._frozen_uniform = None
+        self._equal_weights = None
+        self._compiled = None
+        self._sampler_cache = {}
+        self._leaf_caches = {}
+        self.leaf_max_strings = _LEAF_MAX_STRINGS
+        self.leaf_max_tokens = _LEAF_MAX_TOKENS
+        self._ranker = None
+        self._length_tables = None
+        # Bounded (recursive or weighted) length tables, keyed like the
+        # sampler cache by frozen weights.
+        self._bounded_tables = {}
+        # SentenceStatistics, keyed like the sampler cache plus exactness.
+        self._statistics = {}
+        self._parser = None
+        self._lexer = None
+        # Automata by nonterminal id, and the state budget each failed
+        # nonterminal exceeded, filled in by compile_automata.
+        self._automata: dict[int, Automaton] = {}
+        self._automaton_failures: dict[int, int] = {}
+        self._automaton_parser = None
 
     @classmethod
     def from_name(cls, name: str) -> "CFGrammar":
@@ -75,65 +137,313 @@ class CFGrammar:
         self,
         symbol: str | None = None,
         weights: dict[str, list[float]] | None = None,
+        rng=None,
+        length: int | None = None,
+        min_len: int | None = None,
+        max_len: int | None = None,
+        rule_uniform: bool = False,
     ) -> str:
-        """Generate a random string from the grammar by recursive expansion.
+        """Generate a random string from the grammar.
+
+        Expansion runs on the compiled form of the grammar with an explicit
+        stack, so it is not limited by the Python recursion depth.
+
+        If length, min_len or max_len is given, the string is instead drawn
+        exactly uniformly over all derivations whose output length lies in
+        the requested range, using the tables from count_by_length. No
+        draws are rejected, however narrow the range. With weights, it is
+        drawn from the weighted distribution conditioned on the length.
+        With rule_uniform=True and no weights, it is drawn from the
+        distribution of plain generate() (every production equally likely)
+        conditioned on the length. Recursive grammars need max_len (or
+        length).
 
         Args:
             symbol: the nonterminal to start expanding from. If None, a
                 random start symbol is chosen.
             weights: optional dict mapping each nonterminal to a list of
                 floats (one per production rule) used to bias selection.
-                If None, all productions are equally likely.
+                If None, all productions are equally likely. Tables are
+                cached by the weights' contents; pass FrozenWeights to
+                skip freezing a copy on every call.
+            rng: optional source of randomness with random() and
+                randrange() methods, e.g. a random.Random instance. If
+                None, the global random module is used.
+            length: exact output length, in terminal symbols.
+            min_len: minimum output length (inclusive).
+            max_len: maximum output length (inclusive).
+            rule_uniform: condition rule-uniform sampling on the length
+                instead of sampling uniformly over derivations. Can't be
+                combined with weights.
 
         Returns:
             A string composed entirely of terminal symbols.
         """
+        if rng is None:
+            rng = random
+        if rule_uniform and weights is not None:
+            raise ValueError("Give weights or rule_uniform=True, not both.")
+        weights = freeze_weights(weights)
+
         # If no start symbol was given, pick one at random from the
         # grammar's start symbols.
         if symbol is None:
-            symbol = random.choice(self.start_symbols)
-
-        # Recursively expand the symbol into a string of terminals.
-        return self._expand(symbol, weights)
+            symbol = self.start_symbols[rng.randrange(len(self.start_symbols))]
+
+        compiled = self.compiled
+
+        if length is not None or min_len is not None or max_len is not None:
+            if length is not None:
+                min_len = max_len = length
+            # Without weights the length tables count derivations, which is
+            # uniform sampling; equal weights keep choices rule-uniform.
+            if rule_uniform:
+                if self._equal_weights is None:
+                    self._equal_weights = FrozenWeights({
+                        nt: [1.0] * len(productions)
+                        for nt, productions in self.rules.items()
+                    })
+                weights = self._equal_weights
+            ids = self._generate_by_length(symbol, min_len, max_len, rng, weights)
+            return compiled.decode(ids)
+
+        # Weights are turned into cached alias tables so each weighted
+        # choice is O(1). Note: without weights this is uniform over
+        # *rules*, not over *sentences* — branches with fewer downstream
+        # sentences will be overrepresented.
+        tables = None
+        if weights is not None:
+            tables = self._sampling_tables(weights)
+
+        ids = compiled.expand(
+            compiled.symbol_id(symbol), tables, rng, self._leaf_cache(tables)
+        )
+        return compiled.decode(ids)
 
-    def _expand(
+    def generate_batch(
         self,
-        symbol: str,
-        weights: dict[str, list[float]] | None,
-    ) -> str:
-        """Recursive helper for generate. Expands a single symbol."""
-        # If the symbol is a terminal, return it directly. Terminals are
-        # the base case of the recursion.
-        if symbol not in self.rules:
-            return symbol
-
-        productions = self.rules[symbol]
-
-        # If weights are provided for this nonterminal, use them to bias
-        # the selection. random.choices handles normalization internally,
-        # so raw counts (e.g. from uniform_weights) work directly.
-        if weights is not None and symbol in weights:
-            production = random.choices(
-                productions, weights=weights[symbol]
-            )[0]
-        # Otherwise, pick uniformly among the production rules.
-        # Note: this is uniform over *rules*, not over *sentences* —
-        # branches with fewer downstream sentences will be overrepresented.
+        n: int,
+        weights: dict[str, list[float]] | None = None,
+        rng: np.random.Generator | int | None = None,
+        symbol: str | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Generate n strings at once with level-synchronous NumPy expansion.
+
+        Samples from the same distribution as generate(), but expands the
+        whole batch breadth-first one grammar level at a time.
+
+        Args:
+            n: number of strings to generate.
+            weights: optional per-production weights, as for generate().
+            rng: a NumPy Generator, or a seed passed to
+                np.random.default_rng(). If None, a fresh generator is used.
+            symbol: the nonterminal to start every string from. If None,
+                each string picks a random start symbol.
+
+        Returns:
+            A (tokens, offsets) pair. tokens is a flat array of terminal
+            ids (indices into terminal_symbols) and string i is
+            tokens[offsets[i]:offsets[i + 1]].
+        """
+        rng = np.random.default_rng(rng)
+        compiled = self.compiled
+
+        if symbol is None:
+            start_ids = np.array(
+                [compiled.symbol_id(s) for s in self.start_symbols]
+            )
+            roots = start_ids[rng.integers(len(start_ids), size=n)]
         else:
-            production = random.choice(productions)
+            roots = np.full(n, compiled.symbol_id(symbol))
+
+        tables = None
+        if weights is not None:
+            tables = self._sampling_tables(weights)
+
+        return compiled.expand_batch(roots, tables, rng)
+
+    def generate_parallel(
+        self,
+        n: int,
+        seed: int,
+        workers: int | None = None,
+        offset: int = 0,
+        symbol: str | None = None,
+        weights: dict[str, list[float]] | None = None,
+    ) -> list[str]:
+        """Generate n strings reproducibly across a pool of processes.
 
-        # Recursively expand each symbol in the chosen production and
-        # concatenate the results into a single string.
-        return "".join(self._expand(sym, weights) for sym in production)
+        Sentence i draws all of its randomness from a counter-based stream
+        keyed by (seed, i), so the output is bit-identical for any number of
+        workers and any shard [offset, offset + n) can be regenerated on its
+        own. See cfg_parallel.generate_parallel for the details.
+        """
+        # Deferred import: cfg_parallel imports this module.
+        from . import cfg_parallel
+        return cfg_parallel.generate_parallel(
+            self, n, seed, workers=workers, offset=offset,
+            symbol=symbol, weights=weights,
+        )
 
     def generate_uniform(self, symbol: str | None = None) -> str:
         """Generate a string with uniform probability over all sentences.
 
         This uses weights proportional to the number of sentences each
         production rule can generate, so every possible sentence in the
-        language is equally likely to be sampled.
+        language is equally likely to be sampled. The float probabilities
+        of uniform_probabilities are used, so no big integers are touched.
+        """
+        return self.generate(symbol, weights=self._uniform_sampling_weights())
+
+    def _generate_by_length(
+        self,
+        symbol: str,
+        min_len: int | None,
+        max_len: int | None,
+        rng,
+        weights: dict[str, list[float]] | None = None,
+    ) -> list[int]:
+        """Sample terminal ids from derivations in a length range.
+
+        Uniform over derivations, or weighted if weights are given.
+        """
+        symbol_id = self.compiled.symbol_id(symbol)
+        if weights is None and self.analysis.max_lengths[symbol_id] is not None:
+            tables = self.length_tables
+        else:
+            bound = max_len
+            if bound is None:
+                bound = self.analysis.max_lengths[symbol_id]
+            if bound is None:
+                raise ValueError(
+                    f"{symbol!r} derives unboundedly long strings; "
+                    "give max_len or length."
+                )
+            tables = self._length_tables_up_to(bound, weights)
+        table = tables.counts(symbol_id)
+        lo = 0 if min_len is None else max(min_len, 0)
+        hi = len(table) - 1 if max_len is None else min(max_len, len(table) - 1)
+
+        # First choose the length in proportion to its derivation count
+        # (or weight), then sample among derivations of that length.
+        total = sum(table[lo:hi + 1])
+        if total == 0:
+            raise ValueError(
+                f"{symbol!r} has no derivations with length in "
+                f"[{min_len}, {max_len}]."
+            )
+        k = rng.randrange(total) if weights is None else rng.random() * total
+        for length in range(lo, hi + 1):
+            if k < table[length]:
+                break
+            k -= table[length]
+        # Float rounding can leave k just past the last nonzero entry.
+        while table[length] == 0:
+            length -= 1
+        return tables.sample(symbol_id, length, rng)
+
+    # ── Ranking ─────────────────────────────────────────────────────────
+
+    def sentence_at(self, index: int, symbol: str | None = None) -> str:
+        """Return the string produced by derivation number index.
+
+        Derivations of a symbol are numbered 0..count_generations(symbol)-1
+        (see cfg_ranking.DerivationRanker for the order). This makes every
+        training sample addressable by a single integer:
+
+            - grammar.sentence_at(random.randrange(count)) is an exactly
+              uniform draw over derivations, using one big-int draw.
+            - workers handed disjoint index ranges generate disjoint,
+              reproducible shards with O(1) memory.
+
+        Args:
+            index: derivation number, in [0, count_generations(symbol)).
+            symbol: the nonterminal to derive from. If None, uses the first
+                start symbol.
+
+        Returns:
+            A string composed entirely of terminal symbols.
         """
-        return self.generate(symbol, weights=self.uniform_weights)
+        if symbol is None:
+            symbol = self.start_symbols[0]
+        count = self.count_generations(symbol)
+        if count is None:
+            raise ValueError("Derivations of recursive grammars can't be ranked.")
+        if not 0 <= index < count:
+            raise IndexError(f"Derivation index {index} out of range [0, {count}).")
+
+        compiled = self.compiled
+        return compiled.decode(
+            self.ranker.unrank(compiled.symbol_id(symbol), index)
+        )
+
+    def index_of(self, sentence: str, symbol: str | None = None) -> int:
+        """Return the derivation number of a string; inverse of sentence_at.
+
+        If the grammar derives the string in more than one way, the smallest
+        derivation number is returned.
+
+        Raises:
+            ValueError: if the string is not in the language of symbol.
+        """
+        if symbol is None:
+            symbol = self.start_symbols[0]
+        if self.count_generations(symbol) is None:
+            raise ValueError("Derivations of recursive grammars can't be ranked.")
+
+        symbol_id = self.compiled.symbol_id(symbol)
+        lexer = self.lexer
+        if lexer.prefix_free:
+            tape = lexer.segment(sentence)
+            index = None if tape is None else self.ranker.rank(symbol_id, tape)
+        else:
+            # With overlapping terminals every segmentation is ranked at
+            # once over the lattice, and the smallest index wins.
+            index = self.ranker.rank_lattice(symbol_id, lexer.lattice(sentence))
+        if index is None:
+            raise ValueError(f"{sentence!r} is not derivable from {symbol!r}.")
+        return index
+
+    def sample_without_replacement(
+        self,
+        count: int,
+        seed: int | str | bytes,
+        offset: int = 0,
+        symbol: str | None = None,
+    ) -> Iterator[str]:
+        """Yield count strings for distinct derivations, uniformly at random.
+
+        Derivation indices are visited in the order of a keyed pseudorandom
+        permutation of [0, count_generations(symbol)) and each is unranked
+        with sentence_at. Memory stays O(1) however many are drawn, and for
+        a fixed seed the sequence is fully reproducible. Disjoint splits are
+        disjoint offset ranges of the same permutation, e.g. train takes
+        offset=0, count=N and eval takes offset=N, count=M.
+
+        Derivations are distinct; for an ambiguous grammar two distinct
+        derivations can still spell the same string.
+
+        Args:
+            count: number of strings to yield.
+            seed: key of the permutation.
+            offset: position in the permutation to start from.
+            symbol: the nonterminal to derive from. If None, uses the first
+                start symbol.
+        """
+        if symbol is None:
+            symbol = self.start_symbols[0]
+        total = self.count_generations(symbol)
+        if total is None:
+            raise ValueError("Derivations of recursive grammars can't be ranked.")
+        if offset < 0 or count < 0 or offset + count > total:
+            raise ValueError(
+                f"Requested positions [{offset}, {offset + count}) but only "
+                f"{total} derivations exist."
+            )
+
+        permutation = IndexPermutation(total, seed)
+        for position in range(offset, offset + count):
+            yield self.sentence_at(permutation[position], symbol)
 
     # ── Validation ──────────────────────────────────────────────────────
 
@@ -155,80 +465,314 @@ class CFGrammar:
         """
         # If no start symbol specified, try each one. The string is valid
         # if it can be derived from any start symbol.
-        if start_symbol is None:
+        compiled = self.compiled
+        symbols = self.start_symbols if start_symbol is None else [start_symbol]
+        start_ids = [compiled.symbol_id(s) for s in symbols]
+
+        lexer = self.lexer
+        if not lexer.prefix_free:
+            # Overlapping terminals: let the parser pick the segmentation.
+            edges = lexer.lattice(input_string)
             return any(
-                self.validate(input_string, s) for s in self.start_symbols
+                self.parser.recognize_lattice(start_id, edges)
+                for start_id in start_ids
             )
 
-        # Lazily build the reverse lookup table on first validation call.
-        # This maps tuples of symbols back to the nonterminal they came
-        # from, enabling bottom-up parsing.
-        if self._reverse_rules is None:
-            self._reverse_rules = {}
-            for nonterminal, productions in self.rules.items():
-                for production in productions:
-                    self._reverse_rules[tuple(production)] = nonterminal
-
-        # Split the input string into a list of terminal symbols.
-        # WARNING: this won't work if terminal symbols overlap ('1' and '11').
-        #   A DP approach like parse_cfg below could be adopted if needed.
-        max_t = max(len(t) for t in self.terminal_symbols)
-        start = 0
-        stop = 1
-        tape = []
-        while stop <= len(input_string):
-            found_t = False
-            while stop - start <= max_t and not found_t:
-                if input_string[start:stop] in self.terminal_symbols:
-                    tape.append(input_string[start:stop])
-                    start = stop
-                    found_t = True
-                stop += 1
-            # If we can't find a terminal symbol, the string contains
-            # characters outside the grammar's alphabet.
-            if not found_t:
-                return False
-
-        # Maximum number of symbols in any reverse rule key. This bounds
-        # the sliding window in the bottom-up parser below.
-        max_symbol_len = max(
-            len(key) for key in self._reverse_rules.keys()
+        # Split the input string into terminal ids. If we can't, the string
+        # contains characters outside the alphabet.
+        tokens = lexer.segment(input_string)
+        if tokens is None:
+            return False
+        if self._automata:
+            return any(self._recognize_fast(start_id, tokens) for start_id in start_ids)
+        return any(
+            self.parser.recognize(start_id, tokens) for start_id in start_ids
         )
 
-        def parse_cfg(input_tape, output_tape):
-            """Bottom-up parser that reduces terminal sequences to nonterminals.
-
-            Reads symbols from input_tape, tries to match windows against
-            reverse_rules, and pushes reductions onto output_tape. When the
-            input tape is empty, the output tape becomes the new input and
-            we repeat. Success is reaching a single start symbol.
-            """
-            # If our input tape is empty and we still have an output tape:
-            if not input_tape and output_tape:
-                # Check if the output tape is the start symbol.
-                if output_tape == [start_symbol]:
-                    return True
-                # Otherwise parse the output tokens.
-                else:
-                    return parse_cfg(output_tape, [])
-            # If there is no valid input or output tape exit.
-            elif not input_tape and not output_tape:
-                return False
-
-            # Try matching every window length from the input to the rules.
-            for window in range(1, max_symbol_len + 1):
-                next_tuple = tuple(input_tape[:window])
-                # If we get a window match, continue parsing.
-                if next_tuple in self._reverse_rules and parse_cfg(
-                    input_tape[window:],
-                    output_tape + [self._reverse_rules[next_tuple]],
-                ):
-                    return True
-
-            # If there are no true matches, return false.
-            return False
+    def validate_many(
+        self,
+        strings: Iterable[str],
+        start_symbol: str | None = None,
+        workers: int | None = 1,
+    ) -> np.ndarray:
+        """Validate a batch of strings, optionally across processes.
+
+        The parser is built once and each worker receives one copy of the
+        grammar, not one per string. See cfg_parallel.validate_many.
+
+        Returns:
+            A boolean array with one entry per input string.
+        """
+        # Deferred import: cfg_parallel imports this module.
+        from . import cfg_parallel
+        return cfg_parallel.validate_many(
+            self, strings, start_symbol, workers=workers
+        )
+
+    def validate_iter(
+        self,
+        strings: Iterable[str],
+        start_symbol: str | None = None,
+        workers: int | None = 1,
+    ) -> Iterator[bool]:
+        """Streaming validate_many: yields results in order, bounded memory."""
+        from . import cfg_parallel
+        return cfg_parallel.validate_iter(
+            self, strings, start_symbol, workers=workers
+        )
+
+    def recognizer(self, start_symbol: str | None = None) -> PrefixRecognizer:
+        """Return an incremental recognizer for prefixes of the language.
+
+        Feed it terminal symbols one at a time with feed(); after each it
+        reports is_viable(), is_complete() and allowed_next() without
+        reparsing the prefix.
+
+        Args:
+            start_symbol: the nonterminal sentences must derive from.
+                If None, any start symbol will do.
+        """
+        symbols = self.start_symbols if start_symbol is None else [start_symbol]
+        compiled = self.compiled
+        return PrefixRecognizer(
+            self.parser, [compiled.symbol_id(s) for s in symbols]
+        )
+
+    def first_error(
+        self,
+        input_string: str,
+        start_symbol: str | None = None,
+    ) -> int | None:
+        """Return the offset where a string stops being a valid prefix.
+
+        The string is parsed as a lattice of terminal occurrences, so
+        every segmentation is considered at once, and the result is where
+        the longest viable prefix ends.
+
+        Args:
+            input_string: the string to check.
+            start_symbol: as for validate.
+
+        Returns:
+            None if the string is valid. Otherwise the character offset
+            just past the longest valid prefix: where the first terminal
+            that cannot continue it (or the first character that starts
+            no terminal) begins, or len(input_string) if the whole string
+            is a valid prefix that is not yet a complete sentence.
+        """
+        compiled = self.compiled
+        symbols = self.start_symbols if start_symbol is None else [start_symbol]
+        edges = self.lexer.lattice(input_string)
+        furthest = 0
+        for symbol in symbols:
+            chart = self.parser.parse_lattice(compiled.symbol_id(symbol), edges)
+            if chart.position == len(input_string) and chart.accepted[chart.position]:
+                return None
+            furthest = max(furthest, chart.position)
+        return furthest
+
+    # ── Compilation ─────────────────────────────────────────────────────
+
+    @property
+    def compiled(self) -> CompiledGrammar:
+        """Integer-indexed form of the grammar used by the generation engine.
+
+        Computed lazily on first access and cached for subsequent calls.
+        """
+        if self._compiled is None:
+            if self.frozen:
+                compiled = _compiled_cache.get(self.rules)
+                if compiled is None:
+                    compiled = CompiledGrammar(self.rules)
+                    if len(_compiled_cache) >= _COMPILED_CACHE_SIZE:
+                        _compiled_cache.pop(next(iter(_compiled_cache)))
+                    _compiled_cache[self.rules] = compiled
+                self._compiled = compiled
+            else:
+                self._compiled = CompiledGrammar(self.rules)
+        return self._compiled
+
+    @property
+    def frozen(self) -> bool:
+        """Whether the rules are immutable FrozenRules."""
+        return isinstance(self.rules, FrozenRules)
+
+    @property
+    def digest(self) -> str:
+        """SHA-256 hex digest of the rules, identifying the grammar in files.
+
+        Depends on the nonterminals, their order and their productions, not
+        on the name. Not cached, since unfrozen rules may change.
+        """
+        canonical = json.dumps(
+            [[nt, [list(p) for p in productions]] for nt, productions in self.rules.items()],
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def freeze(self, symbols: list[str] | None = None) -> "CFGrammar":
+        """Return a normalized, immutable copy of the grammar.
+
+        Unproductive symbols and the productions using them are removed,
+        then every nonterminal not reachable from symbols, and repeated
+        productions of a nonterminal are merged into one. Symbols are
+        interned. The language of every kept nonterminal is unchanged.
+
+        Merging duplicates changes derivation-level results (counts,
+        rule-uniform generation); translate_weights maps weights written
+        for this grammar onto the frozen one, and passing
+        frozen.translate_weights(None) as weights reproduces this grammar's
+        rule-uniform sampling.
+
+        Args:
+            symbols: the roots to keep. If None, the start symbols.
+
+        Returns:
+            A CFGrammar over FrozenRules, with sources set.
+        """
+        if symbols is None:
+            symbols = self.start_symbols
+        rules, sources = normalize_rules(self.rules, self.compiled, symbols)
+        grammar = CFGrammar(FrozenRules(rules), name=self.name)
+        grammar.sources = sources
+        return grammar
+
+    def translate_weights(
+        self, weights: dict[str, list[float]] | None
+    ) -> dict[str, list[float]]:
+        """Carry production weights of the original grammar over to freeze()'s.
+
+        Each production's weight is the sum of the weights of the original
+        productions it stands for; removed productions are dropped. None
+        stands for equal weights, so the result then counts duplicates.
+        """
+        if self.sources is None:
+            raise ValueError("Only grammars made by freeze() have sources.")
+        out = {}
+        for nt, groups in self.sources.items():
+            original = None if weights is None else weights.get(nt)
+            out[nt] = [
+                len(group) if original is None else sum(original[i] for i in group)
+                for group in groups
+            ]
+        return out
+
+    @property
+    def parser(self) -> EarleyParser:
+        """Earley parser used by validate, built once and cached."""
+        if self._parser is None:
+            self._parser = EarleyParser(self.compiled)
+        return self._parser
+
+    def configure_leaf_cache(
+        self, max_strings: int = _LEAF_MAX_STRINGS, max_tokens: int = _LEAF_MAX_TOKENS
+    ) -> None:
+        """Set the limits of the leaf cache used by generate.
 
-        return parse_cfg(tape, [])
+        Nonterminals with at most max_strings derivations are generated by
+        drawing a whole string from a cached table instead of expanding
+        them symbol by symbol; draws follow the same distribution. Cached
+        strings are held per weights dict, up to max_tokens tokens each,
+        with least recently used nonterminals evicted first.
+
+        Args:
+            max_strings: derivation count threshold. 0 disables the cache.
+            max_tokens: memory budget per weights dict, in tokens.
+        """
+        self.leaf_max_strings = max_strings
+        self.leaf_max_tokens = max_tokens
+        self._leaf_caches = {}
+
+    def compile_automata(
+        self, symbol: str | None = None, max_states: int = 100_000
+    ) -> Automaton | None:
+        """Compile minimal acyclic automata for a nonterminal and those below it.
+
+        Every nonterminal whose automaton fits in max_states states is kept.
+        From then on validate checks strings of a compiled start symbol with
+        one automaton run, and otherwise parses only the layers above the
+        compiled nonterminals, matching those with their automata.
+
+        Args:
+            symbol: the nonterminal to compile. If None, uses the first
+                start symbol.
+            max_states: state budget per nonterminal; see
+                cfg_automaton.build_automata.
+
+        Returns:
+            The automaton of symbol, or None if it is over budget.
+
+        Raises:
+            ValueError: if symbol is recursive.
+        """
+        if symbol is None:
+            symbol = self.start_symbols[0]
+        compiled = self.compiled
+        symbol_id = compiled.symbol_id(symbol)
+        if symbol_id in self._automata:
+            return self._automata[symbol_id]
+        if self._automaton_failures.get(symbol_id, -1) >= max_states:
+            return None
+
+        # Reuse automata compiled earlier so only new symbols are built.
+        automata = build_automata(compiled, [symbol_id], max_states, self._automata)
+        for sym, automaton in automata.items():
+            if sym < compiled.num_terminals:
+                continue
+            if automaton is None:
+                self._automaton_failures[sym] = max(
+                    max_states, self._automaton_failures.get(sym, 0)
+                )
+            else:
+                self._automata[sym] = automaton
+        self._automaton_parser = None
+        return self._automata.get(symbol_id)
+
+    @property
+    def analysis(self) -> GrammarAnalysis:
+        """Per-symbol statistics, computed in one pass when compiling.
+
+        Derivation counts, min/max lengths, depths, reachable terminals and
+        nullable/recursive flags for every symbol, indexed by symbol id.
+        """
+        return self.compiled.analysis
+
+    @property
+    def lexer(self) -> TerminalLexer:
+        """Terminal trie used to split input strings, built once and cached."""
+        if self._lexer is None:
+            self._lexer = TerminalLexer(self.compiled)
+        return self._lexer
+
+    @property
+    def length_tables(self) -> LengthTables:
+        """Per-length derivation count tables, filled in lazily per symbol."""
+        if self._length_tables is None:
+            self._length_tables = LengthTables(self.compiled)
+        return self._length_tables
+
+    @property
+    def ranker(self) -> DerivationRanker:
+        """Ranking tables for sentence_at and index_of.
+
+        Built from per-production derivation counts on first access and
+        cached for subsequent calls. Productions that reach a cycle count
+        0; they never occur under a symbol that can be ranked.
+        """
+        if self._ranker is None:
+            compiled = self.compiled
+            counts = self.analysis.counts
+            production_counts = []
+            for p in range(compiled.num_productions):
+                count = 1
+                for sym in compiled.rhs(p):
+                    if count is None or counts[sym] is None:
+                        count = None
+                    else:
+                        count *= counts[sym]
+                production_counts.append(0 if count is None else count)
+            self._ranker = DerivationRanker(compiled, production_counts)
+        return self._ranker
 
     # ── Analysis ────────────────────────────────────────────────────────
 
@@ -241,30 +785,76 @@ class CFGrammar:
         sentences. By weighting each rule in proportion to how many sentences
         it leads to, every sentence becomes equally likely.
 
+        Only the nonterminals that some start symbol's sentences use are
+        covered (all of them if there are no start symbols). Nonterminals that derive no string, or that no start
+        symbol reaches, are left out (generate gives missing nonterminals
+        equal weights), and productions that can't derive a string weigh 0.
+
         Computed lazily on first access and cached for subsequent calls.
+        These are exact, possibly huge, ints; sampling should prefer the
+        float form in uniform_probabilities.
+
+        Raises:
+            ValueError: if a used nonterminal derives infinitely many
+                sentences.
         """
         if self._uniform_weights is None:
-            # First compute the total generation count for each nonterminal.
-            nt_counts = self._count_per_nonterminal()
+            # First compute the total generation count for each used
+            # nonterminal, on the rules pruned down to what can be used.
+            used, sources = self._used_grammar()
+            T = used.num_terminals
+            self._check_finite(used)
+            counts = used.analysis.counts
 
             # Then for each nonterminal, compute how many sentences each
             # individual production rule generates. This is the product of
             # the counts of each symbol in the rule.
             prod_counts = {}
-            for nt, productions in self.rules.items():
-                counts = []
-                for production in productions:
+            for nt_index, nt in enumerate(used.symbols[T:]):
+                weights = [0] * len(self.rules[nt])
+                first = used.prod_offsets[nt_index]
+                for j, group in enumerate(sources[nt]):
                     prod_count = 1
-                    for sym in production:
-                        # Terminals aren't in nt_counts, so default to 1.
-                        prod_count *= nt_counts.get(sym, 1)
-                    counts.append(prod_count)
-                prod_counts[nt] = counts
+                    for sym in used.rhs(first + j):
+                        prod_count *= counts[sym]
+                    weights[group[0]] = prod_count
+                prod_counts[nt] = weights
 
             self._uniform_weights = prod_counts
 
         return self._uniform_weights
 
+    @property
+    def uniform_probabilities(self) -> dict[str, list[float]]:
+        """Normalized float64 form of uniform_weights.
+
+        Maps each nonterminal to its production probabilities, which sum to
+        1. They are computed from the scaled float counts of the analysis,
+        without big-integer arithmetic, and each is within a relative
+        error of 1e-12 of the exact ratio of uniform_weights. Nonterminals
+        whose float error bound is looser (very deep grammars) fall back
+        to exact integer counts. See GrammarAnalysis.uniform_probabilities.
+        Nonterminals are covered as in uniform_weights.
+
+        Raises:
+            ValueError: if a used nonterminal derives infinitely many
+                sentences.
+        """
+        if self._uniform_probabilities is None:
+            used, sources = self._used_grammar()
+            T = used.num_terminals
+            self._check_finite(used)
+            probs = used.analysis.uniform_probabilities()
+            out = {}
+            for nt_index, nt in enumerate(used.symbols[T:]):
+                nt_probs = [0.0] * len(self.rules[nt])
+                first = used.prod_offsets[nt_index]
+                for j, group in enumerate(sources[nt]):
+                    nt_probs[group[0]] = probs[first + j]
+                out[nt] = nt_probs
+            self._uniform_probabilities = out
+        return self._uniform_probabilities
+
     def count_generations(self, start_symbol: str | None = None) -> int | None:
         """Count the total number of sentences the grammar can produce.
 
@@ -278,55 +868,231 @@ class CFGrammar:
         # Default to the first start symbol if none specified.
         if start_symbol is None:
             start_symbol = self.start_symbols[0]
+        return self.analysis.counts[self.compiled.symbol_id(start_symbol)]
 
-        # Return cached result if we've already computed this start symbol.
-        if start_symbol in self._generation_counts:
-            return self._generation_counts[start_symbol]
-
-        # Sentinel to detect cycles. If we encounter a symbol that is
-        # currently being computed, we've found a recursive rule which
-        # means the grammar produces infinite sentences.
-        COMPUTING = object()
-        counts = {}
-
-        def compute(symbol):
-            # If the symbol isn't a key in the grammar, it's a terminal.
-            # Terminals contribute exactly 1 to the count.
-            if symbol not in self.rules:
-                return 1
-
-            # If we've already computed or started computing this symbol:
-            if symbol in counts:
-                # If we see the sentinel, we've found a cycle.
-                if counts[symbol] is COMPUTING:
-                    return None
-                # Otherwise return the cached count.
-                return counts[symbol]
-
-            # Mark this symbol as in-progress before recursing.
-            counts[symbol] = COMPUTING
-
-            # For each production rule, the number of sentences it generates
-            # is the product of the counts of each symbol in the rule.
-            # The total for the nonterminal is the sum across all its rules.
-            total = 0
-            for production in self.rules[symbol]:
-                prod_count = 1
-                for sym in production:
-                    sym_count = compute(sym)
-                    # Propagate cycle detection upward.
-                    if sym_count is None:
-                        counts[symbol] = None
-                        return None
-                    prod_count *= sym_count
-                total += prod_count
-
-            counts[symbol] = total
-            return total
-
-        result = compute(start_symbol)
-        self._generation_counts[start_symbol] = result
-        return result
+    def count_by_length(
+        self, symbol: str | None = None, max_length: int | None = None
+    ) -> tuple[int, ...]:
+        """Count the sentences the grammar can produce, broken down by length.
+
+        Args:
+            symbol: the nonterminal to count from. If None, uses the first
+                start symbol.
+            max_length: if given, only lengths up to max_length are
+                counted. Required for recursive grammars.
+
+        Returns:
+            A tuple whose entry L is the number of derivations of output
+            length L. Without max_length it sums to
+            count_generations(symbol), and its last index is
+            get_longest_sequence(symbol). Tables are cached.
+
+        Raises:
+            ValueError: if the symbol is recursive and max_length is None,
+                or if some length has infinitely many derivations.
+        """
+        if symbol is None:
+            symbol = self.start_symbols[0]
+        symbol_id = self.compiled.symbol_id(symbol)
+        if max_length is None:
+            return self.length_tables.counts(symbol_id)
+        return self._length_tables_up_to(max_length).counts(symbol_id)[:max_length + 1]
+
+    def partition_function(
+        self,
+        symbol: str | None = None,
+        weights: dict[str, list[float]] | None = None,
+    ) -> float:
+        """Probability that expanding a symbol terminates.
+
+        Productions are chosen with probability proportional to weights
+        (uniformly if None), as in generate(). For acyclic grammars this is
+        1.0; for recursive ones it is the least fixpoint of the grammar's
+        polynomial system, found by Newton iteration.
+
+        Args:
+            symbol: the nonterminal to start from. If None, uses the first
+                start symbol.
+            weights: optional per-production weights, as for generate().
+        """
+        if symbol is None:
+            symbol = self.start_symbols[0]
+        Z = partition_functions(self.compiled, self._production_weights(weights))
+        return Z[self.compiled.symbol_id(symbol)]
+
+    def expected_length(
+        self,
+        symbol: str | None = None,
+        weights: dict[str, list[float]] | None = None,
+    ) -> float:
+        """Expected length of the strings generate() produces.
+
+        Args:
+            symbol: the nonterminal to start from. If None, uses the first
+                start symbol.
+            weights: optional per-production weights, as for generate().
+
+        Returns:
+            The mean output length over terminating expansions, or inf if
+            the grammar is critical or supercritical under these weights
+            (the mean diverges).
+        """
+        if symbol is None:
+            symbol = self.start_symbols[0]
+        lengths = expected_lengths(self.compiled, self._production_weights(weights))
+        return lengths[self.compiled.symbol_id(symbol)]
+
+    def length_distribution(
+        self,
+        symbol: str | None = None,
+        weights: dict[str, list[float]] | None = None,
+        uniform: bool = False,
+        exact: bool = False,
+    ) -> tuple:
+        """Exact distribution of the length of generated strings.
+
+        Args:
+            symbol: the nonterminal to start from. If None, uses the first
+                start symbol.
+            weights: production weights, as for generate(). None means
+                uniform over rules, like generate().
+            uniform: describe generate_uniform() instead (uniform over
+                sentences); overrides weights.
+            exact: return Fractions instead of floats.
+
+        Returns:
+            A tuple whose entry L is the probability of output length L,
+            up to the longest possible length.
+
+        Raises:
+            ValueError: if the symbol reaches a recursive rule.
+        """
+        if symbol is None:
+            symbol = self.start_symbols[0]
+        stats = self._sentence_statistics(weights, uniform, exact)
+        return stats.distribution(self.compiled.symbol_id(symbol))
+
+    def sentence_stats(
+        self,
+        symbol: str | None = None,
+        weights: dict[str, list[float]] | None = None,
+        uniform: bool = False,
+        exact: bool = False,
+    ) -> dict:
+        """Analytic statistics of the strings generate() produces.
+
+        Computed from the production probabilities in one pass over the
+        grammar, with no sampling. Arguments are as for
+        length_distribution.
+
+        Returns:
+            A dict with the mean and variance of the output length, its
+            min_length and max_length, the expected number of occurrences
+            of each terminal (terminal_counts), the expected number of
+            times each nonterminal is expanded (expansions) and the entropy
+            of the derivation in bits.
+
+        Raises:
+            ValueError: if the symbol reaches a recursive rule; see
+                expected_length for recursive grammars.
+        """
+        if symbol is None:
+            symbol = self.start_symbols[0]
+        compiled = self.compiled
+        T = compiled.num_terminals
+        sym = compiled.symbol_id(symbol)
+        stats = self._sentence_statistics(weights, uniform, exact)
+        if stats.means[sym] is None:
+            raise ValueError(
+                f"{symbol!r} reaches a recursive rule; use expected_length()."
+            )
+        expansions = stats.expansions(sym)
+        return {
+            "mean": stats.means[sym],
+            "variance": stats.variances[sym],
+            "min_length": self.analysis.min_lengths[sym],
+            "max_length": self.analysis.max_lengths[sym],
+            "terminal_counts": {
+                compiled.symbols[t]: stats.terminal_counts[sym][t] for t in range(T)
+            },
+            "expansions": {
+                compiled.symbols[s]: expansions[s]
+                for s in range(T, len(compiled.symbols))
+                if expansions[s]
+            },
+            "entropy": stats.entropies[sym],
+        }
+
+    def kgram_distribution(
+        self,
+        k: int,
+        symbol: str | None = None,
+        weights: dict[str, list[float]] | None = None,
+        uniform: bool = False,
+        exact: bool = False,
+    ) -> dict[tuple[str, ...], float]:
+        """Exact k-gram frequencies of the strings generate() produces.
+
+        The frequency of a k-gram is its expected number of occurrences in
+        a sentence divided by the expected number of k-grams, which is the
+        limit of the frequencies counted over many sampled sentences.
+        Other arguments are as for length_distribution.
+
+        Returns:
+            A dict from tuples of k terminals to their frequency. k-grams
+            that never occur are absent.
+
+        Raises:
+            ValueError: if the symbol reaches a recursive rule.
+        """
+        if symbol is None:
+            symbol = self.start_symbols[0]
+        compiled = self.compiled
+        stats = self._sentence_statistics(weights, uniform, exact)
+        counts = stats.kgram_counts(compiled.symbol_id(symbol), k)
+        total = sum(counts.values())
+        return {
+            tuple(compiled.symbols[t] for t in gram): count / total
+            for gram, count in counts.items()
+            if count
+        }
+
+    def entropy_rate(
+        self,
+        symbol: str | None = None,
+        weights: dict[str, list[float]] | None = None,
+        uniform: bool = False,
+    ) -> float:
+        """Entropy of generated sentences in bits per terminal.
+
+        The entropy of the derivation distribution divided by the expected
+        sentence length, the per-token figure to compare a model's loss
+        with. Exact for unambiguous grammars; ambiguity makes it an upper
+        bound on the string entropy. Other arguments are as for
+        length_distribution.
+        """
+        stats = self.sentence_stats(symbol, weights, uniform)
+        return stats["entropy"] / stats["mean"]
+
+    def count_distinct(
+        self, symbol: str | None = None, max_states: int = 100_000
+    ) -> int:
+        """Count the distinct strings a nonterminal derives.
+
+        Unlike count_generations, which counts derivations, a string with
+        several derivations is counted once. Computed from the minimal
+        automaton of the language (see compile_automata).
+
+        Raises:
+            ValueError: if the grammar is recursive or the automaton needs
+                more than max_states states.
+        """
+        automaton = self.compile_automata(symbol, max_states)
+        if automaton is None:
+            raise ValueError(
+                f"The automaton of {symbol!r} needs more than {max_states} states."
+            )
+        return automaton.num_strings
 
     def get_longest_sequence(self, start_symbol: str | None = None) -> int:
         """Compute the length of the longest terminal string derivable.
@@ -339,84 +1105,198 @@ class CFGrammar:
 
         Returns:
             The length in terminal symbols of the longest derivation.
+
+        Raises:
+            ValueError: if a recursive nonterminal is reachable, so there
+                is no longest string.
         """
         # Default to the first start symbol if none specified.
         if start_symbol is None:
             start_symbol = self.start_symbols[0]
+        length = self.analysis.max_lengths[self.compiled.symbol_id(start_symbol)]
+        if length is None:
+            raise ValueError(
+                f"{start_symbol!r} reaches a recursive rule; its strings are "
+                "unbounded."
+            )
+        return length
 
-        # Return cached result if available.
-        if start_symbol in self._longest_sequences:
-            return self._longest_sequences[start_symbol]
-
-        # Build a length table bottom-up. Start with terminals at length 1,
-        # then compute each nonterminal by taking the max production length.
-        cfg_lengths = {ts: 1 for ts in self.terminal_symbols}
-        rules = list(self.rules.keys())
+    def symbol_stats(self, symbol: str | None = None) -> dict:
+        """Return every analysis statistic of one symbol.
 
-        while rules:
-            next_rule = rules.pop()
+        Args:
+            symbol: the symbol to describe. If None, uses the first start
+                symbol.
 
-            # Collect all symbols referenced by this nonterminal's productions.
-            all_syms = set()
-            for production in self.rules[next_rule]:
-                for sym in production:
-                    all_syms.add(sym)
+        Returns:
+            A dict with the symbol's derivation count, min_length,
+            max_length and depth (None where unbounded), the sorted list of
+            reachable terminals, and the nullable and recursive flags.
+        """
+        if symbol is None:
+            symbol = self.start_symbols[0]
+        analysis = self.analysis
+        sym = self.compiled.symbol_id(symbol)
+        return {
+            "count": analysis.counts[sym],
+            "min_length": analysis.min_lengths[sym],
+            "max_length": analysis.max_lengths[sym],
+            "depth": analysis.depths[sym],
+            "terminals": [self.compiled.symbols[t] for t in analysis.terminal_ids(sym)],
+            "nullable": analysis.nullable[sym],
+            "recursive": analysis.recursive[sym],
+        }
 
-            # Check if we have lengths for all referenced symbols.
-            # If not, defer this rule and try again later.
-            if not all(sym in cfg_lengths for sym in all_syms):
-                rules.insert(0, next_rule)
-                continue
+    # ── Private helpers ─────────────────────────────────────────────────
 
-            # Compute the length of each production (sum of child lengths)
-            # and take the maximum across all productions.
-            generation_lengths = []
-            for production in self.rules[next_rule]:
-                list_length = sum(cfg_lengths[sym] for sym in production)
-                generation_lengths.append(list_length)
-            cfg_lengths[next_rule] = max(generation_lengths)
+    def _recognize_fast(self, start_id: int, tokens: list[int]) -> bool:
+        """recognize using whatever automata compile_automata has built."""
+        automaton = self._automata.get(start_id)
+        if automaton is not None:
+            return automaton.accepts(tokens)
+        if self._automaton_parser is None:
+            self._automaton_parser = EarleyParser(self.compiled, self._automata)
+        return self._automaton_parser.recognize(start_id, tokens)
+
+    def _sampling_tables(self, weights: dict[str, list]) -> SamplingTables:
+        """Return alias tables for a weights dict, building them on first use.
+
+        Tables are cached by the weights' contents: the key is a frozen copy
+        (FrozenWeights are used as they are), so a dict changed in place
+        since the last call is looked up under its new values. Looking up
+        the same FrozenWeights again only compares identities.
+        """
+        weights = freeze_weights(weights)
+        tables = self._sampler_cache.get(weights)
+        if tables is None:
+            tables = SamplingTables(self.compiled, weights)
+            # Keep the cache small; callers normally reuse one or two sets
+            # of weights (e.g. uniform_weights) for the lifetime of the
+            # grammar.
+            _cache_put(self._sampler_cache, weights, tables)
+        return tables
+
+    def _uniform_sampling_weights(self) -> FrozenWeights:
+        """uniform_probabilities, frozen once for generate."""
+        if self._frozen_uniform is None:
+            self._frozen_uniform = FrozenWeights(self.uniform_probabilities)
+        return self._frozen_uniform
+
+    def _production_weights(
+        self, weights: dict[str, list[float]] | None, exact: bool = False
+    ) -> list:
+        """Per-production-id probabilities, normalized per nonterminal."""
+        return production_probabilities(self.compiled, weights, exact)
+
+    def _sentence_statistics(
+        self,
+        weights: dict[str, list[float]] | None,
+        uniform: bool,
+        exact: bool,
+    ) -> SentenceStatistics:
+        """Return SentenceStatistics for a weights dict, cached like tables."""
+        if uniform:
+            weights = self.uniform_weights if exact else self.uniform_probabilities
+        key = (freeze_weights(weights), exact)
+        stats = self._statistics.get(key)
+        if stats is None:
+            stats = SentenceStatistics(
+                self.compiled, self._production_weights(weights, exact)
+            )
+            _cache_put(self._statistics, key, stats)
+        return stats
 
-        result = cfg_lengths[start_symbol]
-        self._longest_sequences[start_symbol] = result
-        return result
+    def _length_tables_up_to(
+        self, max_length: int, weights: dict[str, list[float]] | None = None
+    ) -> LengthTables:
+        """Bounded length tables covering max_length, built on first use.
 
-    # ── Private helpers ─────────────────────────────────────────────────
+        Cached by the weights' contents like the sampling tables, and
+        rebuilt with a larger bound when a longer length is asked for.
+        """
+        weights = freeze_weights(weights)
+        tables = self._bounded_tables.get(weights)
+        if tables is not None and tables.max_length >= max_length:
+            return tables
+
+        tables = LengthTables(
+            self.compiled,
+            max_length,
+            None if weights is None else self._production_weights(weights),
+        )
+        _cache_put(self._bounded_tables, weights, tables)
+        return tables
 
-    def _count_per_nonterminal(self) -> dict[str, int]:
-        """Return a dict mapping each nonterminal to its total generation count.
+    def _leaf_cache(self, tables: SamplingTables | None) -> LeafCache | None:
+        """Return the leaf cache for a set of sampling tables.
 
-        This computes counts for ALL nonterminals in the grammar, not just
-        those reachable from a given start symbol. It does not handle
-        recursive grammars (no cycle detection).
+        Caches are kept per tables object (None for uniform productions),
+        alongside the sampler cache that owns the tables.
         """
-        counts = {}
-
-        def compute(symbol):
-            # Terminals always count as 1.
-            if symbol not in self.rules:
-                return 1
-            # Return cached result if already computed.
-            if symbol in counts:
-                return counts[symbol]
+        if self.leaf_max_strings <= 0:
+            return None
+        key = None if tables is None else id(tables)
+        entry = self._leaf_caches.get(key)
+        if entry is not None and entry[0] is tables:
+            return entry[1]
+
+        leaves = LeafCache(
+            self.compiled, tables, self.leaf_max_strings, self.leaf_max_tokens
+        )
+        _cache_put(self._leaf_caches, key, (tables, leaves))
+        return leaves
 
-            # Sum over production rules, product within each rule.
-            total = 0
-            for production in self.rules[symbol]:
-                prod_count = 1
-                for sym in production:
-                    prod_count *= compute(sym)
-                total += prod_count
+    def _used_grammar(self) -> tuple[CompiledGrammar, dict[str, list[list[int]]]]:
+        """The rules the start symbols' sentences can use, compiled.
 
-            counts[symbol] = total
-            return total
+        Unproductive symbols, the productions that use them, and whatever
+        no start symbol then reaches are pruned (see normalize_rules), so
+        a cycle left in the result makes its symbols derive infinitely
+        many sentences. Returns the compiled rules and, per nonterminal,
+        the original index of each production.
+        """
+        if self._used is None:
+            # Without start symbols (every nonterminal is used by another)
+            # every nonterminal is a root.
+            roots = self.start_symbols or list(self.rules)
+            rules, sources = normalize_rules(
+                self.rules, self.compiled, roots, merge=False
+            )
+            # Most grammars lose nothing and keep their compiled form.
+            if all(len(rules.get(nt, ())) == len(p) for nt, p in self.rules.items()):
+                self._used = (self.compiled, sources)
+            else:
+                self._used = (CompiledGrammar(rules), sources)
+        return self._used
+
+    @staticmethod
+    def _check_finite(used: CompiledGrammar) -> None:
+        """Raise unless every nonterminal of used has finitely many sentences.
+
+        Every symbol of used is productive, so it derives infinitely many
+        sentences exactly when it reaches a cycle. The error names a
+        symbol on the cycle.
+        """
+        T = used.num_terminals
+        for sym, recursive in enumerate(used.analysis.recursive[T:], T):
+            if recursive:
+                nt = used.symbols[sym]
+                raise ValueError(
+                    f"{nt!r} derives infinitely many sentences, so there "
+                    "is no uniform distribution; use generate() with "
+                    "max_len instead."
+                )
 
-        # Compute for every nonterminal in the grammar.
-        for nt in self.rules:
-            compute(nt)
+    # ── Dunder methods ──────────────────────────────────────────────────
 
-        return counts
+    def __eq__(self, other) -> bool:
+        # Frozen grammars compare by rules; others by identity.
+        if self.frozen and isinstance(other, CFGrammar) and other.frozen:
+            return self.rules == other.rules
+        return self is other
 
-    # ── Dunder methods ──────────────────────────────────────────────────
+    def __hash__(self) -> int:
+        return hash(self.rules) if self.frozen else id(self)
 
     def __repr__(self) -> str:
         return (
@@ -427,3 +1307,10 @@ class CFGrammar:
             f"start_symbols={self.start_symbols}"
             f")"
         )
+
+
+def _cache_put(cache: dict, key, entry) -> None:
+    """Insert into a small cache, evicting the oldest entry when full."""
+    if key not in cache and len(cache) >= _SAMPLER_CACHE_SIZE:
+        cache.pop(next(iter(cache)))
+    cache[key] = entry
@@ -0,0 +1,189 @@
+# Cached languages of small nonterminals.
+#
+# In the cfg3 grammars the bottom nonterminals derive a handful of strings
+# each, yet the expansion loop re-derives them symbol by symbol every time
+# they are reached. A nonterminal with few enough derivations can instead be
+# expanded once, up front: keep every string it derives, with the
+# probability the sampler would produce it, and replace the whole subtree
+# with one alias-table draw and one slice copy.
+#
+# The probabilities depend on the production weights, so there is one
+# LeafCache per set of sampling tables. Entries are built on first use and
+# kept in least-recently-used order under a token budget, so a large grammar
+# caches whichever small nonterminals it actually spends its time in.
+
+from collections import OrderedDict
+
+from .cfg_sampling import SamplingTables, build_alias_table
+
+
+class LeafCache:
+    """Per-nonterminal string tables for the expansion loop.
+
+    table[sym] is the cached entry of symbol id sym, an empty tuple if sym
+    is eligible but not loaded, or None if sym is never cached (terminals,
+    recursive nonterminals and those with too many derivations). An entry
+    is a (strings, prob, alias) triple: the distinct strings sym derives,
+    packed as bytes when every terminal id fits in a byte, and the alias
+    table of their probabilities.
+    """
+
+    def __init__(
+        self,
+        compiled,
+        tables: SamplingTables | None = None,
+        max_strings: int = 256,
+        max_tokens: int = 1 << 20,
+    ) -> None:
+        """Decide which nonterminals are eligible; entries load lazily.
+
+        Args:
+            compiled: the CompiledGrammar the cache belongs to.
+            tables: the alias tables the expansion loop samples with, or
+                None for uniform productions.
+            max_strings: a nonterminal is cached only if it has at most
+                this many derivations.
+            max_tokens: budget on the total length of cached strings.
+                Least recently used entries are evicted past it.
+        """
+        self.compiled = compiled
+        self.tables = tables
+        self.max_strings = max_strings
+        self.max_tokens = max_tokens
+        T = compiled.num_terminals
+        self._packed = T <= 256
+
+        # Derivation counts, capped at max_strings + 1 so they stay small
+        # however deep the grammar. Symbols that reach a cycle have no
+        # finite count and are never cached.
+        analysis = compiled.analysis
+        cap = max_strings + 1
+        counts: list[int | None] = [1] * T + [None] * compiled.num_nonterminals
+        for sym in analysis.order:
+            if analysis.max_lengths[sym] is None:
+                continue
+            nt_index = sym - T
+            total = 0
+            for p in range(
+                compiled.prod_offsets[nt_index], compiled.prod_offsets[nt_index + 1]
+            ):
+                product = 1
+                for child in compiled.rhs(p):
+                    product = min(product * counts[child], cap)
+                total = min(total + product, cap)
+            counts[sym] = total
+        self.table: list[tuple | None] = [
+            () if sym >= T and counts[sym] is not None and 0 < counts[sym] <= max_strings
+            else None
+            for sym in range(len(compiled.symbols))
+        ]
+        # Loaded symbols in least-recently-used order, with their sizes.
+        self._entries: OrderedDict[int, int] = OrderedDict()
+        self.num_tokens = 0
+
+    def load(self, sym: int) -> tuple:
+        """Build the entry of an eligible symbol, evicting others if needed."""
+        strings, probs = self._distribution(sym)
+        prob, alias = build_alias_table(probs)
+        entry = (strings, prob, alias)
+
+        size = sum(len(s) for s in strings)
+        if size > self.max_tokens:
+            # Too big to ever fit: stop trying and expand it normally.
+            self.table[sym] = None
+            return entry
+        while self._entries and self.num_tokens + size > self.max_tokens:
+            evicted, evicted_size = self._entries.popitem(last=False)
+            self.table[evicted] = ()
+            self.num_tokens -= evicted_size
+        self.table[sym] = entry
+        self._entries[sym] = size
+        self.num_tokens += size
+        return entry
+
+    def touch(self, symbols: list[int]) -> None:
+        """Mark loaded symbols as recently used."""
+        entries = self._entries
+        for sym in set(symbols):
+            if sym in entries:
+                entries.move_to_end(sym)
+
+    # ── Private helpers ─────────────────────────────────────────────────
+
+    def _distribution(self, root: int) -> tuple[list, list[float]]:
+        """Distinct strings of a symbol and their sampling probabilities."""
+        compiled = self.compiled
+        T = compiled.num_terminals
+        empty = b"" if self._packed else ()
+
+        # Children first, reusing loaded entries where there are any.
+        dists: dict[int, list[tuple]] = {}
+        stack = [root]
+        while stack:
+            sym = stack[-1]
+            if sym in dists:
+                stack.pop()
+                continue
+            if sym < T:
+                dists[sym] = [(bytes([sym]) if self._packed else (sym,), 1.0)]
+                stack.pop()
+                continue
+            entry = self.table[sym]
+            if entry and sym != root:
+                strings, prob, alias = entry
+                dists[sym] = list(zip(strings, _alias_probabilities(prob, alias)))
+                stack.pop()
+                continue
+
+            nt_index = sym - T
+            productions = range(
+                compiled.prod_offsets[nt_index], compiled.prod_offsets[nt_index + 1]
+            )
+            missing = [
+                child
+                for p in productions
+                for child in compiled.rhs(p)
+                if child not in dists
+            ]
+            if missing:
+                stack.extend(missing)
+                continue
+
+            stack.pop()
+            production_probs = self._production_probabilities(nt_index)
+            total: dict = {}
+            for p in productions:
+                partial = [(empty, production_probs[p - productions.start])]
+                for child in compiled.rhs(p):
+                    partial = [
+                        (s + cs, q * cq) for s, q in partial for cs, cq in dists[child]
+                    ]
+                for s, q in partial:
+                    total[s] = total.get(s, 0.0) + q
+            dists[sym] = list(total.items())
+
+        strings = [s for s, _ in dists[root]]
+        probs = [q for _, q in dists[root]]
+        return strings, probs
+
+    def _production_probabilities(self, nt_index: int) -> list[float]:
+        """Probability the expansion loop picks each production of nt_index."""
+        compiled = self.compiled
+        first = compiled.prod_offsets[nt_index]
+        last = compiled.prod_offsets[nt_index + 1]
+        if self.tables is None:
+            return [1.0 / (last - first)] * (last - first)
+        return _alias_probabilities(
+            self.tables.prob[first:last],
+            [a - first for a in self.tables.alias[first:last]],
+        )
+
+
+def _alias_probabilities(prob: list[float], alias: list[int]) -> list[float]:
+    """Recover outcome probabilities from an alias table."""
+    n = len(prob)
+    out = [p / n for p in prob]
+    for column, p in enumerate(prob):
+        if p < 1.0:
+            out[alias[column]] += (1.0 - p) / n
+    return out
@@ -0,0 +1,450 @@
+# Per-length derivation counts and length-conditioned sampling.
+#
+# count_generations gives one number per nonterminal. Replacing that number
+# with a polynomial, where the coefficient of x^L is the number of
+# derivations of output length L, keeps the same sum-over-productions /
+# product-within-production structure: sums add coefficient-wise and
+# products become convolutions. With those tables a derivation of an exact
+# length can be sampled top-down, uniformly, with no rejection: choose the
+# production in proportion to how many derivations of that length it has,
+# then split the length among its children the same way.
+#
+# Recursive grammars have infinite tables, but every coefficient up to a
+# bound is finite as long as no cycle of unit or nullable productions lets a
+# symbol rederive itself at the same length. With a bound the tables are
+# filled one length at a time, which also handles cycles. Symbols that use
+# such a cycle get no table, and only reading one of theirs is an error.
+# Tables can carry production weights instead of counts; sampling then
+# follows the weighted distribution conditioned on the length.
+
+import random
+
+
+def _convolve(a: list[int], b: list[int]) -> list[int]:
+    """Multiply two count polynomials stored as coefficient lists."""
+    if not a or not b:
+        return []
+    out = [0] * (len(a) + len(b) - 1)
+    # Skip zero coefficients; length tables are zero below the minimum
+    # length of a symbol, which is most of a deep symbol's table.
+    nonzero_b = [(j, y) for j, y in enumerate(b) if y]
+    for i, x in enumerate(a):
+        if x:
+            for j, y in nonzero_b:
+                out[i + j] += x * y
+    return out
+
+
+def _add_into(total: list[int], poly: list[int]) -> None:
+    """Add poly into total in place, growing total as needed."""
+    if len(poly) > len(total):
+        total.extend([0] * (len(poly) - len(total)))
+    for i, x in enumerate(poly):
+        total[i] += x
+
+
+class LengthTables:
+    """Lazily built per-length derivation counts for a compiled grammar.
+
+    counts(sym)[L] is the number of derivations of symbol id sym whose
+    output has exactly L terminals. Without a bound, tables are computed on
+    demand for the requested symbol and everything below it, then cached,
+    and only acyclic grammars are supported. With max_length, every table
+    is built at once, truncated after that length, and recursive grammars
+    are supported too.
+
+    If production weights are given (a bound is then required), each
+    derivation counts as the product of its productions' weights, so
+    counts(sym)[L] is the total weight of the derivations of length L.
+    """
+
+    def __init__(
+        self,
+        compiled,
+        max_length: int | None = None,
+        weights: list[float] | None = None,
+    ) -> None:
+        """Set up the tables.
+
+        Args:
+            compiled: the CompiledGrammar to count.
+            max_length: if given, the longest length tabulated.
+            weights: optional weight per production id.
+        """
+        if weights is not None and max_length is None:
+            raise ValueError("Weighted length tables need a max_length.")
+        self.compiled = compiled
+        self.max_length = max_length
+        self.weights = weights
+        T = compiled.num_terminals
+
+        # Terminals derive exactly one string, of length 1.
+        self._symbol_counts: list[tuple[int, ...] | None] = (
+            [(0, 1)] * T + [None] * compiled.num_nonterminals
+        )
+        # _suffix_counts[slot] is the table of the symbol sequence from that
+        # RHS slot to the end of its production, so a production's table is
+        # the suffix table of its first slot.
+        self._suffix_counts: list[tuple[int, ...] | None] = [None] * len(
+            compiled.rhs_symbols
+        )
+        # Bounded tables only: symbol ids with infinitely many derivations
+        # of some length, each mapped to a symbol of the unit or nullable
+        # cycle responsible.
+        self._infinite: dict[int, int] = {}
+        if max_length is not None:
+            self._build_bounded()
+
+    def counts(self, symbol_id: int) -> tuple[int, ...]:
+        """Return the per-length derivation counts of a symbol."""
+        if symbol_id in self._infinite:
+            symbols = self.compiled.symbols
+            cycle = self._infinite[symbol_id]
+            via = "" if cycle == symbol_id else f"uses {symbols[cycle]!r}, which "
+            raise ValueError(
+                "Infinitely many derivations share one length: "
+                f"{symbols[symbol_id]!r} {via}can rederive itself without "
+                "adding terminals."
+            )
+        if self._symbol_counts[symbol_id] is None:
+            self._build(symbol_id)
+        return self._symbol_counts[symbol_id]
+
+    def production_counts(self, production: int) -> tuple[int, ...]:
+        """Return the per-length derivation counts of one production."""
+        compiled = self.compiled
+        self.counts(compiled.num_terminals + compiled.prod_lhs[production])
+        first = compiled.rhs_offsets[production]
+        if first == compiled.rhs_offsets[production + 1]:
+            # An empty production derives only the empty string.
+            return (1,)
+        return self._suffix_counts[first]
+
+    def sample(self, symbol_id: int, length: int, rng=random) -> list[int]:
+        """Sample a derivation of an exact length uniformly at random.
+
+        With weighted tables the derivation is drawn in proportion to its
+        weight instead.
+
+        Args:
+            symbol_id: the symbol to derive from.
+            length: the required number of output terminals.
+            rng: source of randomness with randrange() and random()
+                methods.
+
+        Returns:
+            The terminal ids of the sampled string.
+        """
+        table = self.counts(symbol_id)
+        if length >= len(table) or table[length] == 0:
+            raise ValueError(
+                f"{self.compiled.symbols[symbol_id]!r} has no derivations "
+                f"of length {length}."
+            )
+
+        compiled = self.compiled
+        T = compiled.num_terminals
+        rhs_offsets = compiled.rhs_offsets
+        rhs_symbols = compiled.rhs_symbols
+        symbol_counts = self._symbol_counts
+        suffix_counts = self._suffix_counts
+        weights = self.weights
+        # Exact integer draws for counts, float draws for weights.
+        draw = rng.randrange if weights is None else (lambda total: rng.random() * total)
+
+        out = []
+        # Explicit stack of (symbol id, required length) pairs.
+        stack = [(symbol_id, length)]
+        while stack:
+            sym, remaining = stack.pop()
+            if sym < T:
+                out.append(sym)
+                continue
+
+            # Choose a production in proportion to its derivations of
+            # exactly this length.
+            nt_index = sym - T
+            k = draw(symbol_counts[sym][remaining])
+            for q in range(
+                compiled.prod_offsets[nt_index],
+                compiled.prod_offsets[nt_index + 1],
+            ):
+                c = _coefficient(self.production_counts(q), remaining)
+                if weights is not None:
+                    c *= weights[q]
+                if c:
+                    # Float draws can overshoot by rounding; keep the last
+                    # production that has any weight.
+                    p = q
+                    if k < c:
+                        break
+                    k -= c
+
+            # Split the length among the children left to right: child
+            # length l is chosen in proportion to the child's derivations of
+            # length l times the rest of the production's derivations of
+            # the remaining length.
+            children = []
+            for slot in range(rhs_offsets[p], rhs_offsets[p + 1]):
+                child = rhs_symbols[slot]
+                if slot == rhs_offsets[p + 1] - 1:
+                    children.append((child, remaining))
+                    break
+                child_table = symbol_counts[child]
+                rest_table = suffix_counts[slot + 1]
+                total = _coefficient(suffix_counts[slot], remaining)
+                k = draw(total)
+                for m in range(min(len(child_table) - 1, remaining) + 1):
+                    c = child_table[m] * _coefficient(rest_table, remaining - m)
+                    if c:
+                        l = m
+                        if k < c:
+                            break
+                        k -= c
+                children.append((child, l))
+                remaining -= l
+            stack.extend(reversed(children))
+
+        return out
+
+    def _build(self, root: int) -> None:
+        """Fill tables for root and everything reachable from it."""
+        compiled = self.compiled
+        T = compiled.num_terminals
+        # 0 = unvisited, 1 = on the DFS stack, 2 = finished.
+        state = [0] * len(compiled.symbols)
+
+        # Iterative post-order DFS so children are built before parents.
+        stack = [root]
+        while stack:
+            sym = stack[-1]
+            if self._symbol_counts[sym] is not None:
+                stack.pop()
+                continue
+            nt_index = sym - T
+            productions = range(
+                compiled.prod_offsets[nt_index], compiled.prod_offsets[nt_index + 1]
+            )
+            if state[sym] == 0:
+                state[sym] = 1
+                for p in productions:
+                    for child in compiled.rhs(p):
+                        if state[child] == 1:
+                            raise ValueError(
+                                "Per-length counts need an acyclic grammar; "
+                                f"{compiled.symbols[child]!r} is recursive."
+                            )
+                        if self._symbol_counts[child] is None:
+                            stack.append(child)
+                continue
+
+            stack.pop()
+            state[sym] = 2
+            total = []
+            for p in productions:
+                # Suffix tables, right to left: each slot's table is its
+                # symbol's table convolved with the next slot's table.
+                poly = [1]
+                for slot in range(
+                    compiled.rhs_offsets[p + 1] - 1, compiled.rhs_offsets[p] - 1, -1
+                ):
+                    poly = _convolve(
+                        list(self._symbol_counts[compiled.rhs_symbols[slot]]), poly
+                    )
+                    self._suffix_counts[slot] = tuple(poly)
+                _add_into(total, poly)
+            self._symbol_counts[sym] = tuple(total)
+
+    def _build_bounded(self) -> None:
+        """Fill every table up to max_length, one length at a time.
+
+        The coefficient of length L of a symbol only depends on lengths up
+        to L, and on other symbols at length L only through productions
+        whose remaining symbols can all be empty. Those same-length
+        dependencies are ordered first. Where they form a cycle among
+        productive symbols, the symbols that use the cycle have infinitely
+        many derivations of some length; they are left out, and counts
+        raises for them.
+        """
+        compiled = self.compiled
+        T = compiled.num_terminals
+        analysis = compiled.analysis
+        bound = self.max_length
+        weights = self.weights
+        rhs_offsets = compiled.rhs_offsets
+        rhs_symbols = compiled.rhs_symbols
+        zero = 0 if weights is None else 0.0
+        productive = [length is not None for length in analysis.min_lengths]
+        nullable = analysis.nullable
+
+        # Same-length dependencies: X needs Y at length L if Y sits in a
+        # production of X whose other symbols are all nullable.
+        depends: list[set[int]] = [set() for _ in range(compiled.num_nonterminals)]
+        for p in range(compiled.num_productions):
+            rhs = compiled.rhs(p)
+            if not all(productive[sym] for sym in rhs):
+                continue
+            for i, sym in enumerate(rhs):
+                if sym >= T and all(
+                    nullable[other] for j, other in enumerate(rhs) if j != i
+                ):
+                    depends[compiled.prod_lhs[p]].add(sym - T)
+        self._infinite = self._infinite_symbols(depends)
+        order = self._same_length_order(depends)
+
+        tables = [
+            [1 if sym < T and L == 1 else zero for L in range(bound + 1)]
+            for sym in range(len(compiled.symbols))
+        ]
+        suffix = [[zero] * (bound + 1) for _ in rhs_symbols]
+
+        # A production's suffix values at L are computed while its lhs is
+        # filled in, when its lhs and the nonterminals after it in the order
+        # aren't done at L yet. Slots up to the last such symbol can be
+        # stale (the lhs total is still exact: the terms they spoil are
+        # multiplied by zero), so only those are redone once every symbol
+        # is done at L.
+        # Symbols left out of the order keep all-zero tables; they only
+        # occur in productions of other left-out symbols or in productions
+        # that also use an unproductive symbol.
+        position = {nt: i for i, nt in enumerate(order)}
+        stale_from = []
+        for p in range(compiled.num_productions):
+            lhs_position = position.get(compiled.prod_lhs[p])
+            stale_from.append(-1 if lhs_position is None else max(
+                (
+                    slot
+                    for slot in range(rhs_offsets[p], rhs_offsets[p + 1])
+                    if rhs_symbols[slot] >= T
+                    and position.get(rhs_symbols[slot] - T, -1) >= lhs_position
+                ),
+                default=-1,
+            ))
+        stale = [p for p in range(compiled.num_productions) if stale_from[p] >= 0]
+
+        def suffix_at(p: int, L: int, top: int) -> None:
+            # Slots right to left from top: slot s at length L sums over the
+            # length l its symbol takes and the rest of the production takes
+            # L - l.
+            last = rhs_offsets[p + 1] - 1
+            for slot in range(top, rhs_offsets[p] - 1, -1):
+                table = tables[rhs_symbols[slot]]
+                if slot == last:
+                    suffix[slot][L] = table[L]
+                else:
+                    rest = suffix[slot + 1]
+                    suffix[slot][L] = sum(table[l] * rest[L - l] for l in range(L + 1))
+
+        for L in range(bound + 1):
+            # Symbols in dependency order, so every symbol a production's
+            # total needs at L is done before the production.
+            for nt in order:
+                total = zero
+                for p in range(compiled.prod_offsets[nt], compiled.prod_offsets[nt + 1]):
+                    if rhs_offsets[p] == rhs_offsets[p + 1]:
+                        value = 1 if L == 0 else 0
+                    else:
+                        suffix_at(p, L, rhs_offsets[p + 1] - 1)
+                        value = suffix[rhs_offsets[p]][L]
+                    total += value if weights is None else weights[p] * value
+                tables[T + nt][L] = total
+            for p in stale:
+                suffix_at(p, L, stale_from[p])
+
+        self._symbol_counts = [tuple(table) for table in tables]
+        self._suffix_counts = [tuple(table) for table in suffix]
+
+    def _infinite_symbols(self, depends: list[set[int]]) -> dict[int, int]:
+        """Symbols that use a same-length dependency cycle.
+
+        Returns:
+            A dict mapping each such symbol id to the id of a symbol on
+            the cycle it uses.
+        """
+        compiled = self.compiled
+        T = compiled.num_terminals
+        N = compiled.num_nonterminals
+        productive = [length is not None for length in compiled.analysis.min_lengths]
+
+        # Peel off nonterminals whose dependencies are all peeled; what is
+        # left is on a cycle or depends on one.
+        waiting = [len(children) for children in depends]
+        dependents: list[list[int]] = [[] for _ in range(N)]
+        for nt, children in enumerate(depends):
+            for child in children:
+                dependents[child].append(nt)
+        ready = [nt for nt in range(N) if not waiting[nt]]
+        while ready:
+            nt = ready.pop()
+            for parent in dependents[nt]:
+                waiting[parent] -= 1
+                if not waiting[parent]:
+                    ready.append(parent)
+        infinite = {}
+        for nt in range(N):
+            if waiting[nt] and nt not in infinite:
+                # Every unpeeled symbol depends on another, so following
+                # dependencies from nt must come back round to a cycle.
+                seen = []
+                cur = nt
+                while cur not in seen:
+                    seen.append(cur)
+                    cur = next(child for child in depends[cur] if waiting[child])
+                infinite[nt] = cur
+
+        # Anything that uses an infinite symbol in a production that can
+        # derive a string is infinite too.
+        users: list[set[int]] = [set() for _ in range(N)]
+        for p in range(compiled.num_productions):
+            rhs = compiled.rhs(p)
+            if all(productive[sym] for sym in rhs):
+                for sym in rhs:
+                    if sym >= T:
+                        users[sym - T].add(compiled.prod_lhs[p])
+        stack = list(infinite)
+        while stack:
+            nt = stack.pop()
+            for user in users[nt]:
+                if user not in infinite:
+                    infinite[user] = infinite[nt]
+                    stack.append(user)
+        return {T + nt: T + cycle for nt, cycle in infinite.items()}
+
+    def _same_length_order(self, depends: list[set[int]]) -> list[int]:
+        """Nonterminal indices with same-length dependencies first.
+
+        Otherwise children come before parents where the grammar allows,
+        so few production suffixes need redoing in _build_bounded.
+        Symbols in _infinite are left out.
+        """
+        T = self.compiled.num_terminals
+        N = self.compiled.num_nonterminals
+        order = []
+        # 0 = unvisited, 1 = on the DFS stack, 2 = finished. Infinite
+        # symbols are marked finished up front; nothing else depends on
+        # them, so the rest has no same-length cycle.
+        state = [0] * N
+        for sym in self._infinite:
+            state[sym - T] = 2
+        for root in (sym - T for sym in self.compiled.analysis.order if sym >= T):
+            if state[root]:
+                continue
+            stack = [root]
+            while stack:
+                nt = stack[-1]
+                if state[nt] == 0:
+                    state[nt] = 1
+                    for child in depends[nt]:
+                        if state[child] == 0:
+                            stack.append(child)
+                    continue
+                stack.pop()
+                if state[nt] == 1:
+                    state[nt] = 2
+                    order.append(nt)
+        return order
+
+
+def _coefficient(table: tuple[int, ...], length: int) -> int:
+    """Coefficient of x^length, treating missing entries as zero."""
+    return table[length] if 0 <= length < len(table) else 0
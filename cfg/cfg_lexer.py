@@ -0,0 +1,142 @@
+# Splitting input strings into terminal symbols.
+#
+# Validation used to segment a string by probing substrings of growing
+# length against the sorted list of terminals, taking the first (shortest)
+# hit. Each probe was a linear scan of the list, and the shortest hit is the
+# wrong choice whenever one terminal is a prefix of another ('1' and '11'):
+# "11" could only ever be read as two '1's.
+#
+# TerminalLexer compiles the terminals into a trie once per grammar. When no
+# terminal is a prefix of another, at most one terminal can start at any
+# offset, so the segmentation is unique and found in one left-to-right
+# pass. Otherwise the lexer returns a lattice of every terminal occurrence,
+# which the Earley parser consumes directly, so the parse decides which
+# segmentation is meant.
+
+
+class TerminalLexer:
+    """Trie over the terminal symbols of a compiled grammar.
+
+    Trie nodes are numbered from 0 (the root). children[node] maps the next
+    character to a child node and terminal_at[node] is the terminal id
+    spelled by the path to node, or -1.
+    """
+
+    def __init__(self, compiled) -> None:
+        self.compiled = compiled
+        children: list[dict[str, int]] = [{}]
+        terminal_at = [-1]
+        for t in range(compiled.num_terminals):
+            node = 0
+            for ch in compiled.symbols[t]:
+                child = children[node].get(ch)
+                if child is None:
+                    child = len(children)
+                    children[node][ch] = child
+                    children.append({})
+                    terminal_at.append(-1)
+                node = child
+            terminal_at[node] = t
+        self.children = children
+        self.terminal_at = terminal_at
+
+        # Prefix-free: no terminal ends at a node that has children.
+        self.prefix_free = all(
+            terminal_at[node] < 0 or not children[node]
+            for node in range(1, len(children))
+        )
+
+        # Single-character terminals are looked up directly.
+        self._char_ids: dict[str, int] | None = None
+        if all(len(compiled.symbols[t]) == 1 for t in range(compiled.num_terminals)):
+            self._char_ids = {
+                compiled.symbols[t]: t for t in range(compiled.num_terminals)
+            }
+
+    def segment(self, string: str) -> list[int] | None:
+        """Split a string into terminal ids in one pass.
+
+        Only valid when the terminals are prefix-free, which makes the
+        segmentation unique.
+
+        Returns:
+            The terminal ids, or None if the string can't be segmented.
+        """
+        if not self.prefix_free:
+            raise ValueError(
+                "Overlapping terminals have no unique segmentation; use lattice()."
+            )
+        if self._char_ids is not None:
+            char_ids = self._char_ids
+            tokens = [char_ids.get(ch, -1) for ch in string]
+            return None if -1 in tokens else tokens
+
+        children = self.children
+        terminal_at = self.terminal_at
+        tokens = []
+        node = 0
+        for ch in string:
+            node = children[node].get(ch)
+            if node is None:
+                return None
+            if terminal_at[node] >= 0:
+                tokens.append(terminal_at[node])
+                node = 0
+        # A string ending partway through a terminal is not segmentable.
+        return tokens if node == 0 else None
+
+    def matches(self, string: str, start: int) -> list[tuple[int, int]]:
+        """Terminals occurring at an offset, as (terminal id, end) pairs.
+
+        Pairs are in order of increasing end.
+        """
+        children = self.children
+        terminal_at = self.terminal_at
+        found = []
+        node = 0
+        for end in range(start + 1, len(string) + 1):
+            node = children[node].get(string[end - 1])
+            if node is None:
+                break
+            if terminal_at[node] >= 0:
+                found.append((terminal_at[node], end))
+        return found
+
+    def lattice(self, string: str) -> list[list[tuple[int, int]]]:
+        """Every terminal occurrence in a string, grouped by start offset.
+
+        Returns:
+            A list with one entry per character offset; entry i holds the
+            (terminal id, end offset) pairs of the terminals that start at
+            i. Each segmentation of the string is a path of edges from
+            offset 0 to len(string).
+        """
+        return [self.matches(string, i) for i in range(len(string))]
+
+    def segmentations(self, string: str):
+        """Yield every segmentation of a string as a list of terminal ids.
+
+        There can be exponentially many; callers that only need to know
+        whether one parses should hand the lattice to the parser instead.
+        """
+        edges = self.lattice(string)
+        n = len(string)
+        # Offsets from which the end of the string is reachable, so the
+        # search never wanders into dead ends.
+        reaches_end = [False] * (n + 1)
+        reaches_end[n] = True
+        for i in range(n - 1, -1, -1):
+            reaches_end[i] = any(reaches_end[end] for _, end in edges[i])
+        if not reaches_end[0]:
+            return
+
+        # Depth-first search with an explicit stack of (offset, path).
+        stack = [(0, [])]
+        while stack:
+            i, path = stack.pop()
+            if i == n:
+                yield path
+                continue
+            for t, end in reversed(edges[i]):
+                if reaches_end[end]:
+                    stack.append((end, path + [t]))
@@ -0,0 +1,189 @@
+# Multi-process helpers built on CFGrammar.
+#
+# Work is split into contiguous chunks (index ranges for generation, runs of
+# input strings for validation) and fanned out to a process pool. The
+# grammar and any production weights are sent to each worker once, through
+# the pool initializer, rather than being pickled with every task. Results come back in input order, so
+# the output never depends on the number of workers.
+
+import os
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import numpy as np
+
+from .cfg_frozen import FrozenWeights, freeze_weights
+from .cfg_grammar import CFGrammar
+from .cfg_sampling import CounterRNG
+
+# Set in each worker process by _init_worker.
+_worker_grammar: CFGrammar | None = None
+_worker_weights: FrozenWeights | None = None
+
+
+def _init_worker(grammar: CFGrammar, weights: FrozenWeights | None = None) -> None:
+    """Pool initializer: keep one copy of the grammar and weights per worker."""
+    global _worker_grammar, _worker_weights
+    _worker_grammar = grammar
+    _worker_weights = weights
+
+
+def generate_range(
+    grammar: CFGrammar,
+    seed: int,
+    start: int,
+    stop: int,
+    symbol: str | None = None,
+    weights: dict[str, list[float]] | None = None,
+) -> list[str]:
+    """Generate sentences start..stop-1 of the stream defined by seed.
+
+    Sentence i is generated with CounterRNG(seed, i), so any range can be
+    regenerated in isolation and gives the same strings as the same indices
+    of any larger run.
+    """
+    # Freeze once so every sentence finds its tables by identity.
+    weights = freeze_weights(weights)
+    return [
+        grammar.generate(symbol, weights, rng=CounterRNG(seed, i))
+        for i in range(start, stop)
+    ]
+
+
+def _generate_range_in_worker(seed, start, stop, symbol):
+    return generate_range(_worker_grammar, seed, start, stop, symbol, _worker_weights)
+
+
+def generate_parallel(
+    grammar: CFGrammar,
+    n: int,
+    seed: int,
+    workers: int | None = None,
+    offset: int = 0,
+    symbol: str | None = None,
+    weights: dict[str, list[float]] | None = None,
+    chunk_size: int = 1024,
+) -> list[str]:
+    """Generate sentences offset..offset+n-1 of a seeded stream in parallel.
+
+    Args:
+        grammar: the grammar to generate from.
+        n: number of sentences.
+        seed: base seed of the stream.
+        workers: number of processes. If None, uses os.cpu_count(). With
+            one worker everything runs in the calling process.
+        offset: index of the first sentence, for regenerating a shard.
+        symbol: start symbol, as for CFGrammar.generate.
+        weights: production weights, as for CFGrammar.generate.
+        chunk_size: number of sentences per task.
+
+    Returns:
+        The sentences in index order. The result is bit-identical for any
+        number of workers and chunk size.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        return generate_range(grammar, seed, offset, offset + n, symbol, weights)
+
+    # Build the compiled tables before pickling so workers don't each
+    # recompile the grammar.
+    grammar.compiled
+
+    results = []
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(grammar, freeze_weights(weights)),
+    ) as pool:
+        futures = [
+            pool.submit(
+                _generate_range_in_worker,
+                seed,
+                start,
+                min(start + chunk_size, offset + n),
+                symbol,
+            )
+            for start in range(offset, offset + n, chunk_size)
+        ]
+        for future in futures:
+            results.extend(future.result())
+    return results
+
+
+def _validate_chunk_in_worker(strings, start_symbol):
+    return [_worker_grammar.validate(s, start_symbol) for s in strings]
+
+
+def validate_iter(
+    grammar: CFGrammar,
+    strings: Iterable[str],
+    start_symbol: str | None = None,
+    workers: int | None = 1,
+    chunk_size: int = 256,
+) -> Iterator[bool]:
+    """Validate a stream of strings, yielding results in input order.
+
+    The input is read lazily in chunks and at most two chunks per worker
+    are in flight at once, so memory stays bounded for arbitrarily long
+    (or infinite) iterators.
+
+    Args:
+        grammar: the grammar to validate against.
+        strings: any iterable of strings.
+        start_symbol: as for CFGrammar.validate.
+        workers: number of processes. If None, uses os.cpu_count(). With
+            one worker everything runs in the calling process.
+        chunk_size: number of strings per task.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        for s in strings:
+            yield grammar.validate(s, start_symbol)
+        return
+
+    # Build the parser tables before pickling so workers don't each rebuild
+    # them.
+    grammar.parser
+
+    it = iter(strings)
+    pending = deque()
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(grammar,)
+    ) as pool:
+
+        def submit_next() -> bool:
+            chunk = list(islice(it, chunk_size))
+            if not chunk:
+                return False
+            pending.append(
+                pool.submit(_validate_chunk_in_worker, chunk, start_symbol)
+            )
+            return True
+
+        # Prime the pool, then keep it topped up as results are consumed.
+        for _ in range(2 * workers):
+            if not submit_next():
+                break
+        while pending:
+            results = pending.popleft().result()
+            submit_next()
+            yield from results
+
+
+def validate_many(
+    grammar: CFGrammar,
+    strings: Iterable[str],
+    start_symbol: str | None = None,
+    workers: int | None = 1,
+    chunk_size: int = 256,
+) -> np.ndarray:
+    """Validate a batch of strings and return a NumPy boolean array.
+
+    See validate_iter for the arguments.
+    """
+    results = validate_iter(grammar, strings, start_symbol, workers, chunk_size)
+    return np.fromiter(results, dtype=bool)
@@ -0,0 +1,462 @@
+# Earley chart parser over a CompiledGrammar.
+#
+# validate used to reduce the input bottom-up with a backtracking search
+# over window lengths, which is exponential in the worst case and mapped
+# each right-hand side to a single nonterminal, so grammars where two
+# nonterminals share a production were validated incorrectly. An Earley
+# parser has neither problem: it runs in O(n^3) time in the worst case
+# (O(n^2) for unambiguous grammars) and tracks every nonterminal that can
+# cover a span.
+#
+# Items are packed into single ints, key = origin * D + d, where d numbers
+# the dotted rules (production, dot position) and D is how many there are.
+# Advancing the dot is key + 1. Predicted items, which all start at the
+# current position, are not stored individually: a position records the
+# set of nonterminals it predicts as a bitmask, and the items that set
+# implies are looked up in a cache shared by every position and input. The
+# cache is bounded; long-lived recognizers over large grammars can meet
+# many distinct predicted sets.
+#
+# Because a chart is built one Earley set at a time, the same machinery
+# serves as an incremental recognizer: PrefixRecognizer feeds terminals one
+# by one and can say after each whether the prefix is still extendable,
+# which terminals may follow, and whether it is already a full sentence.
+# parse_lattice runs the same loop over input offsets instead of token
+# counts, scanning every terminal occurrence the lexer found, so inputs
+# whose segmentation into terminals is ambiguous are parsed in one pass.
+
+
+# Most predicted-set tables kept by a parser; the oldest is evicted first.
+_PREDICTION_CACHE_SIZE = 4096
+
+
+class EarleyChart:
+    """Parse state for one input: one Earley set per position consumed.
+
+    Each position keeps what later positions need to look back at: the
+    non-predicted items waiting on each symbol, the predicted items (as a
+    shared table keyed by symbol), and whether the start symbol has been
+    completed over the whole prefix.
+    """
+
+    def __init__(self, start_id: int, capacity: int = 16) -> None:
+        self.start_id = start_id
+        # Chart arrays are allocated up front for the expected input length
+        # and only grow (by doubling) if the input turns out longer.
+        self.waiting: list[dict | None] = [None] * (capacity + 1)
+        self.predicted: list[dict | None] = [None] * (capacity + 1)
+        self.accepted: list[bool] = [False] * (capacity + 1)
+        # Index of the last processed Earley set.
+        self.position = -1
+
+    def _reserve(self, position: int) -> None:
+        """Make sure the chart arrays can hold the given position."""
+        size = len(self.waiting)
+        if position < size:
+            return
+        grow = max(size, position + 1 - size)
+        self.waiting.extend([None] * grow)
+        self.predicted.extend([None] * grow)
+        self.accepted.extend([False] * grow)
+
+    def copy(self) -> "EarleyChart":
+        """Return an independent chart with the same processed sets.
+
+        Processed sets are never modified, so they are shared; only the
+        per-position arrays are copied.
+        """
+        chart = EarleyChart.__new__(EarleyChart)
+        chart.start_id = self.start_id
+        chart.waiting = self.waiting.copy()
+        chart.predicted = self.predicted.copy()
+        chart.accepted = self.accepted.copy()
+        chart.position = self.position
+        return chart
+
+
+class EarleyParser:
+    """Earley recognizer for a CompiledGrammar, built once and reused.
+
+    All tables depend only on the grammar, so one parser can check any
+    number of inputs against any of its nonterminals.
+
+    If automata are given, the nonterminals they cover are opaque: they are
+    never predicted, and recognize matches them against the input with
+    their automata instead. Such a parser only supports recognize.
+    """
+
+    def __init__(self, compiled, automata: dict | None = None) -> None:
+        """Build the parse tables.
+
+        Args:
+            compiled: the CompiledGrammar to parse with.
+            automata: optional map from nonterminal id to the Automaton of
+                its language, as built by cfg_automaton.build_automata.
+        """
+        self.compiled = compiled
+        self.automata = automata or {}
+        T = compiled.num_terminals
+        N = compiled.num_nonterminals
+        opaque = 0
+        for sym in self.automata:
+            if sym >= T:
+                opaque |= 1 << (sym - T)
+
+        # Dotted rules: production p with dot k is d = dot_base[p] + k,
+        # for k in 0..len(rhs). Completed rules have next symbol -1.
+        self.dot_base = [
+            compiled.rhs_offsets[p] + p for p in range(compiled.num_productions)
+        ]
+        self.num_dotted = len(compiled.rhs_symbols) + compiled.num_productions
+        next_symbol = []
+        item_lhs = []
+        for p in range(compiled.num_productions):
+            rhs = compiled.rhs(p)
+            next_symbol.extend(rhs)
+            next_symbol.append(-1)
+            item_lhs.extend([T + compiled.prod_lhs[p]] * (len(rhs) + 1))
+        self.next_symbol = next_symbol
+        self.item_lhs = item_lhs
+
+        # A symbol is nullable if it can derive the empty string.
+        self.nullable = [length == 0 for length in compiled.min_lengths]
+
+        # closure[nt] is the bitmask of nonterminal indices predicted when
+        # nt is predicted: nt itself plus every nonterminal that can start
+        # one of its productions, skipping over nullable prefixes.
+        left_corners = [0] * N
+        for p in range(compiled.num_productions):
+            if opaque >> compiled.prod_lhs[p] & 1:
+                continue
+            for sym in compiled.rhs(p):
+                if sym >= T:
+                    left_corners[compiled.prod_lhs[p]] |= 1 << (sym - T)
+                if not self.nullable[sym]:
+                    break
+        closure = []
+        for nt in range(N):
+            mask = 1 << nt
+            frontier = mask
+            while frontier:
+                low = frontier & -frontier
+                frontier ^= low
+                new = left_corners[low.bit_length() - 1] & ~mask
+                mask |= new
+                frontier |= new
+            # Opaque nonterminals are matched, not predicted.
+            closure.append(mask & ~opaque)
+        self.closure = closure
+
+        # Cache of predicted-item tables keyed by the predicted-set mask.
+        self._predictions: dict[int, dict[int, tuple[int, ...]]] = {}
+
+    # ── Parsing ─────────────────────────────────────────────────────────
+
+    def recognize(self, start_id: int, tokens: list[int]) -> bool:
+        """Return True if the terminal ids in tokens derive from start_id."""
+        if self.automata:
+            return self._recognize_with_automata(start_id, tokens)
+        chart = self.start(start_id, capacity=len(tokens))
+        for token in tokens:
+            if not self.scan(chart, token):
+                return False
+        return chart.accepted[chart.position]
+
+    def recognize_lattice(
+        self, start_id: int, edges: list[list[tuple[int, int]]]
+    ) -> bool:
+        """Return True if some path through a token lattice derives from start_id.
+
+        See parse_lattice for the lattice format.
+        """
+        chart = self.parse_lattice(start_id, edges)
+        return chart.position == len(edges) and chart.accepted[chart.position]
+
+    def parse_lattice(
+        self, start_id: int, edges: list[list[tuple[int, int]]]
+    ) -> EarleyChart:
+        """Build the chart for every path through a token lattice.
+
+        Args:
+            start_id: the symbol the input must derive from.
+            edges: per input offset i, the (terminal id, end offset) pairs
+                of the tokens starting at i, as built by
+                TerminalLexer.lattice. The input ends at offset len(edges).
+
+        Returns:
+            The chart, indexed by input offset. Offsets no viable prefix
+            reaches are never processed, so chart.position is the furthest
+            offset any viable prefix reaches. Every edge moves forward, so
+            each set is complete before any edge leaves it.
+        """
+        return self._parse_edges(start_id, len(edges), lambda i, chart: edges[i])
+
+    def start(self, start_id: int, capacity: int = 16) -> EarleyChart:
+        """Create a chart for start_id and process its first Earley set."""
+        chart = EarleyChart(start_id, capacity)
+        self._process(chart, 0, [], self.closure[start_id - self.compiled.num_terminals])
+        # The empty input is accepted only by a nullable start symbol.
+        chart.accepted[0] = self.nullable[start_id]
+        return chart
+
+    def scan(self, chart: EarleyChart, token: int) -> bool:
+        """Consume one terminal id, returning False if no parse survives.
+
+        After a False return the chart is left unchanged.
+        """
+        i = chart.position
+        D = self.num_dotted
+        seeds = [key + 1 for key in chart.waiting[i].get(token, ())]
+        predicted = chart.predicted[i].get(token)
+        if predicted:
+            base = i * D + 1
+            seeds.extend(base + d for d in predicted)
+        if not seeds:
+            return False
+        self._process(chart, i + 1, seeds, 0)
+        return True
+
+    def prediction_table(self, roots: int) -> dict[int, tuple[int, ...]]:
+        """Predicted items for a set of predicted nonterminals, by next symbol.
+
+        Every predicted item starts at the current position, so only its
+        dotted rule needs storing. Items whose prefix is nullable are
+        included with the dot advanced past it.
+        """
+        table = self._predictions.get(roots)
+        if table is not None:
+            return table
+
+        compiled = self.compiled
+        grouped: dict[int, list[int]] = {}
+        remaining = roots
+        while remaining:
+            low = remaining & -remaining
+            nt = low.bit_length() - 1
+            remaining ^= low
+            for p in range(compiled.prod_offsets[nt], compiled.prod_offsets[nt + 1]):
+                d = self.dot_base[p]
+                while True:
+                    sym = self.next_symbol[d]
+                    if sym < 0:
+                        break
+                    grouped.setdefault(sym, []).append(d)
+                    if not self.nullable[sym]:
+                        break
+                    d += 1
+
+        table = {sym: tuple(ds) for sym, ds in grouped.items()}
+        if len(self._predictions) >= _PREDICTION_CACHE_SIZE:
+            self._predictions.pop(next(iter(self._predictions)))
+        self._predictions[roots] = table
+        return table
+
+    # ── Private helpers ─────────────────────────────────────────────────
+
+    def _recognize_with_automata(self, start_id: int, tokens: list[int]) -> bool:
+        """recognize for a parser with opaque nonterminals.
+
+        At each offset the parser reaches, every opaque nonterminal some
+        item is waiting on is matched against the input by running its
+        automaton, and each match becomes one edge spanning it.
+        """
+        n = len(tokens)
+        automata = self.automata
+
+        def edges_at(i, chart):
+            edges = [(tokens[i], i + 1)]
+            expected = chart.waiting[i].keys() | chart.predicted[i].keys()
+            for sym in expected & automata.keys():
+                edges.extend(
+                    (sym, end)
+                    for end in automata[sym].match_ends(tokens, i)
+                    if end > i
+                )
+            return edges
+
+        chart = self._parse_edges(start_id, n, edges_at)
+        return chart.position == n and chart.accepted[n]
+
+    def _parse_edges(self, start_id: int, n: int, edges_at) -> EarleyChart:
+        """Parse a lattice over n offsets whose edges come from edges_at(i, chart)."""
+        D = self.num_dotted
+        chart = self.start(start_id, capacity=n)
+        seeds: list[list[int] | None] = [None] * (n + 1)
+        for i in range(n + 1):
+            if i > 0:
+                if not seeds[i]:
+                    continue
+                self._process(chart, i, seeds[i], 0)
+                seeds[i] = None
+            if i == n:
+                break
+            waiting = chart.waiting[i]
+            predicted = chart.predicted[i]
+            base = i * D + 1
+            for token, end in edges_at(i, chart):
+                scanned = [key + 1 for key in waiting.get(token, ())]
+                scanned.extend(base + d for d in predicted.get(token, ()))
+                if scanned:
+                    if seeds[end] is None:
+                        seeds[end] = scanned
+                    else:
+                        seeds[end].extend(scanned)
+        return chart
+
+    def _process(
+        self, chart: EarleyChart, i: int, seeds: list[int], roots: int
+    ) -> None:
+        """Close Earley set i under completion and prediction.
+
+        Args:
+            chart: the chart being built.
+            i: position of the set.
+            seeds: keys of the items produced by scanning into this set.
+            roots: bitmask of nonterminals already known to be predicted.
+        """
+        T = self.compiled.num_terminals
+        D = self.num_dotted
+        next_symbol = self.next_symbol
+        item_lhs = self.item_lhs
+        nullable = self.nullable
+        closure = self.closure
+        chart_waiting = chart.waiting
+        chart_predicted = chart.predicted
+        start_id = chart.start_id
+
+        seen = set()
+        waiting: dict[int, list[int]] = {}
+        accepted = False
+        work = seeds
+        while work:
+            key = work.pop()
+            if key in seen:
+                continue
+            seen.add(key)
+            origin, d = divmod(key, D)
+            sym = next_symbol[d]
+
+            if sym < 0:
+                # Completer: every item at the origin that was waiting on
+                # this nonterminal moves its dot past it. Seeded items
+                # always start before i, so the origin set is final.
+                lhs = item_lhs[d]
+                if origin == 0 and lhs == start_id:
+                    accepted = True
+                parents = chart_waiting[origin].get(lhs)
+                if parents:
+                    work.extend([k + 1 for k in parents])
+                predicted = chart_predicted[origin].get(lhs)
+                if predicted:
+                    base = origin * D + 1
+                    work.extend([base + p for p in predicted])
+                continue
+
+            bucket = waiting.get(sym)
+            if bucket is None:
+                waiting[sym] = [key]
+            else:
+                bucket.append(key)
+            if sym >= T:
+                # Predictor: record the nonterminal (and its left-corner
+                # closure) as predicted here. A nullable symbol can also be
+                # skipped right away (Aycock & Horspool).
+                roots |= closure[sym - T]
+                if nullable[sym]:
+                    work.append(key + 1)
+
+        chart._reserve(i)
+        chart_waiting[i] = waiting
+        chart_predicted[i] = self.prediction_table(roots)
+        chart.accepted[i] = accepted
+        chart.position = i
+
+
+class PrefixRecognizer:
+    """Incremental recognizer: feed terminals one at a time.
+
+    Each feed() adds one Earley set to the chart instead of reparsing the
+    prefix, so its cost depends on the size of the current set, not on how
+    many terminals came before. With several start symbols one chart is
+    kept per start symbol and charts whose prefix dies are dropped.
+
+    Once a terminal is rejected the recognizer stays dead: is_viable()
+    returns False and error_position records how many terminals were
+    accepted before the failure.
+    """
+
+    def __init__(self, parser: EarleyParser, start_ids: list[int]) -> None:
+        self.parser = parser
+        self.charts = [parser.start(start_id) for start_id in start_ids]
+        # Number of terminals accepted so far.
+        self.position = 0
+        # Index of the rejected terminal, or None while viable.
+        self.error_position: int | None = None
+
+    def feed(self, terminal: str) -> bool:
+        """Consume one terminal symbol.
+
+        Returns:
+            True if the prefix can still be extended to a valid sentence,
+            False if the terminal was rejected (or the recognizer was
+            already dead).
+        """
+        if self.error_position is not None:
+            return False
+        compiled = self.parser.compiled
+        token = compiled.symbol_ids.get(terminal)
+        if token is not None and token < compiled.num_terminals:
+            # scan() leaves a chart unchanged when it fails, so only the
+            # surviving charts have advanced.
+            charts = [chart for chart in self.charts if self.parser.scan(chart, token)]
+        else:
+            charts = []
+        if not charts:
+            self.error_position = self.position
+            return False
+        self.charts = charts
+        self.position += 1
+        return True
+
+    def is_viable(self) -> bool:
+        """Whether the terminals fed so far are a prefix of some sentence."""
+        return self.error_position is None
+
+    def is_complete(self) -> bool:
+        """Whether the terminals fed so far form a complete sentence."""
+        return self.error_position is None and any(
+            chart.accepted[chart.position] for chart in self.charts
+        )
+
+    def allowed_next(self) -> set[str]:
+        """Terminal symbols that keep the prefix viable if fed next."""
+        symbols = self.parser.compiled.symbols
+        return {symbols[t] for t in self.allowed_next_ids()}
+
+    def allowed_next_ids(self) -> set[int]:
+        """Terminal ids that keep the prefix viable if fed next."""
+        if self.error_position is not None:
+            return set()
+        T = self.parser.compiled.num_terminals
+        allowed = set()
+        for chart in self.charts:
+            i = chart.position
+            # Symbol ids below T are terminals; the rest are nonterminals
+            # some item is waiting on.
+            allowed.update(t for t in chart.waiting[i] if t < T)
+            allowed.update(t for t in chart.predicted[i] if t < T)
+        return allowed
+
+    def copy(self) -> "PrefixRecognizer":
+        """Return an independent recognizer in the same state.
+
+        Useful for trying a terminal without committing to it. Costs
+        O(position): the processed Earley sets are shared, but each chart's
+        per-position arrays are copied.
+        """
+        other = PrefixRecognizer.__new__(PrefixRecognizer)
+        other.parser = self.parser
+        other.charts = [chart.copy() for chart in self.charts]
+        other.position = self.position
+        other.error_position = self.error_position
+        return other
@@ -0,0 +1,183 @@
+# Partition functions and expected lengths of weighted grammars.
+#
+# With a weight on every production, the partition function Z[X] of a
+# nonterminal is the total weight of its derivations: the sum over its
+# productions of the production weight times the product of the children's
+# Z (terminals have Z = 1). For an acyclic grammar that is one children-
+# first sweep. A recursive grammar has infinitely many derivations and Z is
+# the least fixpoint of the polynomial system Z = P(Z); with normalized
+# production probabilities it is the probability that expansion from X
+# terminates.
+#
+# The system is solved one strongly connected component at a time,
+# children first, so every component only sees already-final values from
+# below. Inside a cyclic component Newton's method started at 0 converges
+# monotonically to the least fixpoint (Etessami and Yannakakis), quadratically
+# except at the critical point where it still gains about a bit per step.
+#
+# Expected lengths come from the same Jacobian. G[X], the weighted sum of
+# output lengths over X's derivations, is linear in the children's G:
+# G = b + J(Z) G inside a component, with b collecting the terms from below.
+# The expected length of a terminating derivation is G[X] / Z[X], infinite
+# when the linear system has no non-negative solution (a critical or
+# supercritical component).
+
+import math
+
+import numpy as np
+
+# Newton stops once no value moves by more than this, or after this many
+# steps.
+_TOLERANCE = 1e-12
+_MAX_ITERATIONS = 100
+
+# At the critical point P(Z) - Z is quadratic in the error, so in floating
+# point Z is only found to about the square root of the machine epsilon and
+# the Jacobian's spectral radius falls short of 1 by as much. Radii this
+# close to 1 are treated as critical.
+_CRITICAL = 1e-6
+
+
+def partition_functions(compiled, weights: list[float]) -> list[float]:
+    """Total derivation weight of every symbol.
+
+    Args:
+        compiled: the CompiledGrammar.
+        weights: one non-negative weight per production id. Normalized
+            per-nonterminal probabilities give termination probabilities.
+
+    Returns:
+        Z per symbol id: 1.0 for terminals, and for a nonterminal the least
+        non-negative solution of Z = P(Z) (possibly inf when the weights
+        are not normalized and the series diverges).
+    """
+    T = compiled.num_terminals
+    Z = [1.0] * T + [0.0] * compiled.num_nonterminals
+    for members in compiled.analysis.components:
+        if not compiled.analysis.recursive[members[0]]:
+            Z[members[0]] = _evaluate(compiled, weights, members[0], Z)
+            continue
+        _newton(compiled, weights, members, Z)
+    return Z
+
+
+def expected_lengths(
+    compiled, weights: list[float], Z: list[float] | None = None
+) -> list[float]:
+    """Expected output length of every symbol's terminating derivations.
+
+    Args:
+        compiled: the CompiledGrammar.
+        weights: one non-negative weight per production id.
+        Z: the partition functions, if already computed.
+
+    Returns:
+        Per symbol id, the weighted mean number of terminals a derivation
+        produces (1.0 for terminals), nan where Z is 0 and inf where the
+        mean diverges.
+    """
+    if Z is None:
+        Z = partition_functions(compiled, weights)
+    T = compiled.num_terminals
+    analysis = compiled.analysis
+    # G[X] is the derivative of X's length generating function at x = 1.
+    G = [1.0] * T + [0.0] * compiled.num_nonterminals
+    for members in analysis.components:
+        index = {sym: i for i, sym in enumerate(members)}
+        b, J = _linearize(compiled, weights, members, index, Z, G)
+        if not analysis.recursive[members[0]]:
+            G[members[0]] = b[0]
+            continue
+        A = np.eye(len(members)) - J
+        try:
+            solution = np.linalg.solve(A, b)
+        except np.linalg.LinAlgError:
+            solution = None
+        # At or past criticality the spectral radius of J reaches 1 and
+        # the mean is infinite.
+        radius = max(abs(np.linalg.eigvals(J)))
+        if solution is None or radius >= 1.0 - _CRITICAL or np.any(solution < 0):
+            solution = np.full(len(members), math.inf)
+        for sym, value in zip(members, solution):
+            G[sym] = float(value)
+
+    return [math.nan if z == 0 else g / z for g, z in zip(G, Z)]
+
+
+# ── Private helpers ─────────────────────────────────────────────────────
+
+
+def _evaluate(compiled, weights: list[float], sym: int, Z: list[float]) -> float:
+    """P(Z) for one nonterminal: sum of weight times product of children."""
+    T = compiled.num_terminals
+    total = 0.0
+    for p in range(compiled.prod_offsets[sym - T], compiled.prod_offsets[sym - T + 1]):
+        value = weights[p]
+        for child in compiled.rhs(p):
+            value *= Z[child]
+        total += value
+    return total
+
+
+def _newton(compiled, weights: list[float], members: tuple, Z: list[float]) -> None:
+    """Least fixpoint of one cyclic component, written into Z."""
+    index = {sym: i for i, sym in enumerate(members)}
+    x = np.zeros(len(members))
+    for _ in range(_MAX_ITERATIONS):
+        for sym, value in zip(members, x):
+            Z[sym] = float(value)
+        P = np.array([_evaluate(compiled, weights, sym, Z) for sym in members])
+        J = _linearize(compiled, weights, members, index, Z, None)[1]
+        A = np.eye(len(members)) - J
+        try:
+            step = np.linalg.solve(A, P - x)
+        except np.linalg.LinAlgError:
+            step = np.linalg.lstsq(A, P - x, rcond=None)[0]
+        # Newton iterates stay below the least fixpoint; rounding must not
+        # push them past it or below the previous iterate.
+        new = np.maximum(x + step, P)
+        if not np.all(np.isfinite(new)):
+            x = np.where(np.isfinite(new), new, math.inf)
+            break
+        done = np.max(np.abs(new - x)) <= _TOLERANCE * max(1.0, np.max(np.abs(new)))
+        x = new
+        if done:
+            break
+    for sym, value in zip(members, x):
+        Z[sym] = float(value)
+
+
+def _linearize(
+    compiled,
+    weights: list[float],
+    members: tuple,
+    index: dict,
+    Z: list[float],
+    G: list[float] | None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Jacobian J of P at Z inside a component, plus the outside terms b.
+
+    Each occurrence of a symbol in a production contributes the weight
+    times the product of the other symbols' Z: to J if the symbol is a
+    member, else (times its G) to b. b is only computed when G is given.
+    """
+    T = compiled.num_terminals
+    n = len(members)
+    J = np.zeros((n, n))
+    b = np.zeros(n)
+    for row, sym in enumerate(members):
+        for p in range(
+            compiled.prod_offsets[sym - T], compiled.prod_offsets[sym - T + 1]
+        ):
+            rhs = compiled.rhs(p)
+            for i, child in enumerate(rhs):
+                others = weights[p]
+                for j, other in enumerate(rhs):
+                    if j != i:
+                        others *= Z[other]
+                column = index.get(child)
+                if column is not None:
+                    J[row, column] += others
+                elif G is not None:
+                    b[row] += others * G[child]
+    return b, J
@@ -0,0 +1,305 @@
+# Exact ranking and unranking of derivations.
+#
+# count_generations counts derivations by summing over a nonterminal's
+# productions and multiplying within each production. The same arithmetic
+# gives every derivation a unique number: pick a production by which block
+# of the sum the number falls in, then split the remainder into one digit
+# per child in a mixed-radix system whose radices are the children's
+# counts. Reading a number back out of a string runs the same arithmetic in
+# reverse over a chart of spans. With overlapping terminals the spans are
+# character offsets and the terminals come from the lexer's lattice, so
+# every segmentation is ranked in the same chart.
+
+from bisect import bisect_right
+
+
+class DerivationRanker:
+    """Bijection between the derivations of a symbol and integers in [0, count).
+
+    Derivations of a nonterminal are ordered first by production, in rule
+    order, and then by the indices of the children's derivations with the
+    leftmost child most significant. Index 0 is therefore the derivation
+    that always takes the first production.
+
+    Only acyclic grammars have finite counts, so only they can be ranked.
+    """
+
+    def __init__(self, compiled, production_counts: list[int]) -> None:
+        """Build the ranking tables.
+
+        Args:
+            compiled: the CompiledGrammar to rank derivations of.
+            production_counts: number of derivations of each production,
+                indexed by production id.
+        """
+        self.compiled = compiled
+        T = compiled.num_terminals
+
+        # Total derivations per symbol id. Terminals derive only themselves.
+        counts = [1] * T + [0] * compiled.num_nonterminals
+
+        # prod_starts[p] is the index of the first derivation that uses
+        # production p, relative to its nonterminal's index space.
+        prod_starts = [0] * compiled.num_productions
+        for nt_index in range(compiled.num_nonterminals):
+            total = 0
+            for p in range(
+                compiled.prod_offsets[nt_index],
+                compiled.prod_offsets[nt_index + 1],
+            ):
+                prod_starts[p] = total
+                total += production_counts[p]
+            counts[T + nt_index] = total
+
+        # strides[slot] is the place value of the RHS symbol at that slot of
+        # rhs_symbols: the product of the counts of every symbol to its
+        # right in the same production.
+        strides = [1] * len(compiled.rhs_symbols)
+        for p in range(compiled.num_productions):
+            stride = 1
+            for slot in range(
+                compiled.rhs_offsets[p + 1] - 1, compiled.rhs_offsets[p] - 1, -1
+            ):
+                strides[slot] = stride
+                stride *= counts[compiled.rhs_symbols[slot]]
+
+        self.counts = counts
+        self.prod_starts = prod_starts
+        self.strides = strides
+        # Character lengths for rank_lattice, computed on first use.
+        self._chars = None
+
+    def unrank(self, symbol_id: int, index: int) -> list[int]:
+        """Return the terminal ids of derivation number index of a symbol."""
+        compiled = self.compiled
+        T = compiled.num_terminals
+        prod_offsets = compiled.prod_offsets
+        rhs_offsets = compiled.rhs_offsets
+        rhs_symbols = compiled.rhs_symbols
+        prod_starts = self.prod_starts
+        strides = self.strides
+
+        out = []
+        # Explicit stack of (symbol id, derivation index) pairs, expanded
+        # leftmost-first exactly like CompiledGrammar.expand.
+        stack = [(symbol_id, index)]
+        while stack:
+            sym, k = stack.pop()
+            if sym < T:
+                out.append(sym)
+                continue
+
+            # The production is the last one whose block starts at or below
+            # k. Productions with no derivations share their start with the
+            # next one, and bisect_right skips past them.
+            nt_index = sym - T
+            p = bisect_right(
+                prod_starts, k, prod_offsets[nt_index], prod_offsets[nt_index + 1]
+            ) - 1
+            k -= prod_starts[p]
+
+            # Peel off one mixed-radix digit per child, most significant
+            # (leftmost) first.
+            children = []
+            for slot in range(rhs_offsets[p], rhs_offsets[p + 1]):
+                digit, k = divmod(k, strides[slot])
+                children.append((rhs_symbols[slot], digit))
+            stack.extend(reversed(children))
+
+        return out
+
+    def rank(self, symbol_id: int, tape: list[int]) -> int | None:
+        """Return the smallest derivation index of symbol_id yielding tape.
+
+        Ambiguous grammars can derive one string in several ways; the
+        smallest index among them is returned so the result is canonical.
+
+        Args:
+            symbol_id: the symbol the string must derive from.
+            tape: terminal ids of the string.
+
+        Returns:
+            The derivation index, or None if the string is not derivable.
+        """
+        compiled = self.compiled
+        return self._best(
+            symbol_id,
+            len(tape),
+            lambda t, i, j: j == i + 1 and tape[i] == t,
+            compiled.min_lengths,
+            compiled.max_lengths,
+        )
+
+    def rank_lattice(
+        self, symbol_id: int, edges: list[list[tuple[int, int]]]
+    ) -> int | None:
+        """Return the smallest derivation index of symbol_id yielding any path.
+
+        Like rank, but over every segmentation of a string at once: spans
+        are character offsets and a terminal covers a span if the lattice
+        has that edge. The chart has one entry per span, so the cost is
+        polynomial in the string length however many segmentations there
+        are.
+
+        Args:
+            symbol_id: the symbol the string must derive from.
+            edges: the string's lattice, as from TerminalLexer.lattice.
+
+        Returns:
+            The derivation index, or None if no segmentation is derivable.
+        """
+        spans = {(t, i, end) for i, found in enumerate(edges) for t, end in found}
+        min_chars, max_chars = self._char_lengths()
+        return self._best(
+            symbol_id,
+            len(edges),
+            lambda t, i, j: (t, i, j) in spans,
+            min_chars,
+            max_chars,
+        )
+
+    def _best(self, symbol_id, n, covers, min_lengths, max_lengths) -> int | None:
+        """Smallest derivation index of symbol_id spanning positions 0..n.
+
+        Args:
+            symbol_id: the symbol to derive from.
+            n: number of positions.
+            covers: covers(t, i, j) tells whether terminal t spans i..j.
+            min_lengths: per-symbol shortest span, None if unproductive.
+            max_lengths: per-symbol longest span.
+        """
+        compiled = self.compiled
+        T = compiled.num_terminals
+        prod_offsets = compiled.prod_offsets
+        rhs_offsets = compiled.rhs_offsets
+        rhs_symbols = compiled.rhs_symbols
+        prod_starts = self.prod_starts
+        strides = self.strides
+
+        # Shortest and longest output of the symbols after each RHS slot,
+        # used to bound where the current symbol's span may end.
+        rest_min, rest_max = self._rest_lengths(min_lengths, max_lengths)
+
+        memo_symbol = {}
+        memo_slot = {}
+
+        def best_symbol(sym, i, j):
+            """Smallest index of a derivation of span i..j from sym."""
+            if sym < T:
+                return 0 if covers(sym, i, j) else None
+            # Unproductive nonterminals (min length None) derive nothing.
+            if min_lengths[sym] is None or not (
+                min_lengths[sym] <= j - i <= max_lengths[sym]
+            ):
+                return None
+
+            key = (sym, i, j)
+            if key in memo_symbol:
+                return memo_symbol[key]
+
+            # Productions are ordered, so the first one that matches holds
+            # the smallest index.
+            result = None
+            nt_index = sym - T
+            for p in range(prod_offsets[nt_index], prod_offsets[nt_index + 1]):
+                r = best_slot(rhs_offsets[p], rhs_offsets[p + 1], i, j)
+                if r is not None:
+                    result = prod_starts[p] + r
+                    break
+
+            memo_symbol[key] = result
+            return result
+
+        def best_slot(slot, end, i, j):
+            """Smallest offset for RHS slots slot..end deriving span i..j."""
+            if slot == end:
+                return 0 if i == j else None
+
+            key = (slot, i, j)
+            if key in memo_slot:
+                return memo_slot[key]
+
+            sym = rhs_symbols[slot]
+            stride = strides[slot]
+            result = None
+            if min_lengths[sym] is None or rest_min[slot] is None:
+                pass
+            elif slot == end - 1:
+                r = best_symbol(sym, i, j)
+                if r is not None:
+                    result = r * stride
+            else:
+                # Try every split point the length bounds allow.
+                lo = max(i + min_lengths[sym], j - rest_max[slot])
+                hi = min(i + max_lengths[sym], j - rest_min[slot])
+                for k in range(lo, hi + 1):
+                    head = best_symbol(sym, i, k)
+                    if head is None:
+                        continue
+                    tail = best_slot(slot + 1, end, k, j)
+                    if tail is None:
+                        continue
+                    value = head * stride + tail
+                    if result is None or value < result:
+                        result = value
+
+            memo_slot[key] = result
+            return result
+
+        return best_symbol(symbol_id, 0, n)
+
+    def _char_lengths(self) -> tuple[list[int | None], list[int | None]]:
+        """Per-symbol shortest and longest output in characters.
+
+        Both are None for symbols that are unproductive or recursive;
+        neither is reachable from a symbol that can be ranked.
+        """
+        if self._chars is None:
+            compiled = self.compiled
+            analysis = compiled.analysis
+            T = compiled.num_terminals
+            lo = [len(compiled.symbols[t]) for t in range(T)]
+            lo += [None] * compiled.num_nonterminals
+            hi = list(lo)
+            for sym in analysis.order:
+                if analysis.recursive[sym]:
+                    continue
+                nt_index = sym - T
+                for p in range(
+                    compiled.prod_offsets[nt_index], compiled.prod_offsets[nt_index + 1]
+                ):
+                    rhs = compiled.rhs(p)
+                    if any(lo[child] is None for child in rhs):
+                        continue
+                    low = sum(lo[child] for child in rhs)
+                    high = sum(hi[child] for child in rhs)
+                    if lo[sym] is None or low < lo[sym]:
+                        lo[sym] = low
+                    if hi[sym] is None or high > hi[sym]:
+                        hi[sym] = high
+            self._chars = (lo, hi)
+        return self._chars
+
+    def _rest_lengths(
+        self, min_lengths: list[int | None], max_lengths: list[int | None]
+    ) -> tuple[list[int], list[int]]:
+        """Per-slot min/max output length of the symbols to the slot's right."""
+        compiled = self.compiled
+        rest_min = [0] * len(compiled.rhs_symbols)
+        rest_max = [0] * len(compiled.rhs_symbols)
+        for p in range(compiled.num_productions):
+            lo = hi = 0
+            for slot in range(
+                compiled.rhs_offsets[p + 1] - 1, compiled.rhs_offsets[p] - 1, -1
+            ):
+                rest_min[slot] = lo
+                rest_max[slot] = hi
+                sym = compiled.rhs_symbols[slot]
+                # An unproductive symbol makes every slot left of it
+                # underivable; None propagates that.
+                if lo is None or min_lengths[sym] is None:
+                    lo = hi = None
+                else:
+                    lo += min_lengths[sym]
+                    hi += max_lengths[sym]
+        return rest_min, rest_max
@@ -0,0 +1,273 @@
+# Sampling primitives shared by the generation engines.
+#
+# Weighted production choice used to go through random.choices, which
+# rebuilds a cumulative-weight list on every call. For the uniform-over-
+# sentences weights those lists hold Python ints around 10^40, so each
+# choice paid for big-integer arithmetic. Here weights are turned once into
+# Walker/Vose alias tables: after that a weighted draw is one random float,
+# one multiply and one comparison, regardless of the weights' magnitude.
+#
+# IndexPermutation is the no-replacement counterpart: a keyed bijection on
+# [0, n) that lets callers visit derivation indices in pseudorandom order
+# without remembering which ones they have already drawn.
+#
+# CounterRNG gives every (seed, stream) pair its own random stream, where
+# the i-th value is a pure function of (seed, stream, i). Generating
+# sentence i with stream i makes the output independent of how the work is
+# split across processes.
+
+import hashlib
+
+import numpy as np
+
+
+def build_alias_table(weights: list) -> tuple[list[float], list[int]]:
+    """Build a Walker/Vose alias table for a list of non-negative weights.
+
+    Weights may be floats or arbitrarily large ints. Each weight is scaled
+    to w * n / total using exact int division where possible, so huge
+    integer weights lose no precision before being rounded to a float.
+
+    Args:
+        weights: one non-negative weight per outcome.
+
+    Returns:
+        A (prob, alias) pair of lists. To sample, draw i uniformly from
+        range(n) and a uniform u in [0, 1); the outcome is i if u < prob[i]
+        and alias[i] otherwise.
+    """
+    n = len(weights)
+    total = sum(weights)
+    if n == 0 or total <= 0:
+        raise ValueError("Alias table needs at least one positive weight.")
+
+    # Scale so the average weight is exactly 1. int / int is correctly
+    # rounded in Python even for ints far beyond the float range.
+    scaled = [w * n / total for w in weights]
+
+    prob = [1.0] * n
+    alias = list(range(n))
+    small = [i for i, s in enumerate(scaled) if s < 1.0]
+    large = [i for i, s in enumerate(scaled) if s >= 1.0]
+
+    # Pair each under-full column with an over-full one: the small outcome
+    # keeps its own mass and the large outcome fills the rest of the column.
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] = (scaled[l] + scaled[s]) - 1.0
+        if scaled[l] < 1.0:
+            small.append(l)
+        else:
+            large.append(l)
+
+    # Whatever is left is full up to rounding error; prob stays 1.0.
+    return prob, alias
+
+
+class SamplingTables:
+    """Per-production alias tables for every nonterminal of a compiled grammar.
+
+    Tables are stored flat and indexed by production id, in the same CSR
+    layout as CompiledGrammar. For nonterminal index nt with productions
+    first..last, a draw u * (last - first) picks a column first + i; the
+    production is that column if the fractional part is below prob[column]
+    and alias[column] otherwise. alias holds absolute production ids.
+    """
+
+    def __init__(self, compiled, weights: dict[str, list]) -> None:
+        T = compiled.num_terminals
+        prob = [1.0] * compiled.num_productions
+        alias = list(range(compiled.num_productions))
+
+        for nt_index in range(compiled.num_nonterminals):
+            first = compiled.prod_offsets[nt_index]
+            last = compiled.prod_offsets[nt_index + 1]
+            nonterminal = compiled.symbols[T + nt_index]
+
+            # Nonterminals missing from the dict keep equal weights, which
+            # the identity table above already encodes.
+            nt_weights = weights.get(nonterminal)
+            if nt_weights is None:
+                continue
+            if len(nt_weights) != last - first:
+                raise ValueError(
+                    f"Expected {last - first} weights for nonterminal "
+                    f"{nonterminal!r}, got {len(nt_weights)}."
+                )
+
+            nt_prob, nt_alias = build_alias_table(nt_weights)
+            prob[first:last] = nt_prob
+            alias[first:last] = [first + a for a in nt_alias]
+
+        self.prob = prob
+        self.alias = alias
+
+        # NumPy copies for the batched engine.
+        self.prob_array = np.asarray(prob, dtype=np.float64)
+        self.alias_array = np.asarray(alias, dtype=np.int64)
+
+
+class IndexPermutation:
+    """Keyed pseudorandom permutation of range(n), evaluated pointwise.
+
+    The permutation is a Feistel network over the smallest even-width bit
+    domain that covers n, restricted to [0, n) by cycle walking: values that
+    land outside the range are encrypted again until they fall inside. A
+    Feistel network is a bijection for any round function, so perm[i] never
+    repeats for distinct i, yet each lookup costs a few hashes and no
+    memory. n may be an arbitrarily large int.
+    """
+
+    def __init__(self, n: int, seed: int | str | bytes, rounds: int = 8) -> None:
+        if n <= 0:
+            raise ValueError("Permutation size must be positive.")
+        self.n = n
+        self.rounds = rounds
+
+        # Split the domain into two equal halves of half_bits each. The
+        # domain is at most 4n, so cycle walking takes <= 4 steps on average.
+        self.half_bits = max(1, ((n - 1).bit_length() + 1) // 2)
+        self._mask = (1 << self.half_bits) - 1
+        self._half_bytes = (self.half_bits + 7) // 8
+
+        if isinstance(seed, int):
+            seed = str(seed)
+        if isinstance(seed, str):
+            seed = seed.encode()
+        self._key = hashlib.sha256(seed).digest()
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __getitem__(self, index: int) -> int:
+        if not 0 <= index < self.n:
+            raise IndexError(f"Permutation index {index} out of range [0, {self.n}).")
+        x = self._encrypt(index)
+        while x >= self.n:
+            x = self._encrypt(x)
+        return x
+
+    def _encrypt(self, x: int) -> int:
+        """One pass of the Feistel network over the full bit domain."""
+        left = x >> self.half_bits
+        right = x & self._mask
+        for r in range(self.rounds):
+            left, right = right, left ^ self._round(r, right)
+        return (left << self.half_bits) | right
+
+    def _round(self, r: int, value: int) -> int:
+        """Keyed round function mapping a half-block to a half-block."""
+        digest = hashlib.shake_256(
+            self._key + bytes([r]) + value.to_bytes(self._half_bytes, "little")
+        ).digest(self._half_bytes)
+        return int.from_bytes(digest, "little") & self._mask
+
+
+# SplitMix64 constants. The Weyl increment spaces out successive counters
+# and the two multipliers drive the finalizer's avalanche.
+_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+_MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX2 = np.uint64(0x94D049BB133111EB)
+
+_MASK64 = (1 << 64) - 1
+_GAMMA_INT = int(_GAMMA)
+_MIX1_INT = int(_MIX1)
+_MIX2_INT = int(_MIX2)
+
+# Values produced per refill of a CounterRNG's block. A short sentence
+# needs only a few values, so the first _SCALAR_VALUES are made a few at a
+# time in plain Python; NumPy's fixed cost only pays off for long streams.
+_COUNTER_BLOCK = 256
+_SCALAR_BLOCK = 4
+_SCALAR_VALUES = 64
+
+
+class CounterRNG:
+    """Counter-based random stream keyed by (seed, stream).
+
+    Value i of the stream is the SplitMix64 finalizer applied to
+    key + i * gamma, where key is a hash of (seed, stream). There is no
+    sequential state beyond the counter, so any stream can be regenerated
+    in isolation and streams never depend on each other. Values are made
+    a block at a time: small blocks in plain Python at first, so a stream
+    that is only read briefly stays cheap, then with vectorized NumPy
+    arithmetic.
+
+    Implements the subset of the random.Random interface the generation
+    engines use: random(), randrange() and getrandbits().
+    """
+
+    def __init__(self, seed: int, stream: int = 0) -> None:
+        digest = hashlib.blake2b(
+            f"{seed}:{stream}".encode(), digest_size=8
+        ).digest()
+        self._key = int.from_bytes(digest, "little")
+        self._counter = 0
+        self._block: list[int] = []
+        self._pos = 0
+
+    def random(self) -> float:
+        """Return the next float in [0, 1)."""
+        if self._pos == len(self._block):
+            self._refill()
+        word = self._block[self._pos]
+        self._pos += 1
+        # Top 53 bits, the precision of a double.
+        return (word >> 11) * (1.0 / 9007199254740992)
+
+    def getrandbits(self, k: int) -> int:
+        """Return a non-negative int with k random bits."""
+        value = 0
+        bits = 0
+        while bits < k:
+            if self._pos == len(self._block):
+                self._refill()
+            value |= self._block[self._pos] << bits
+            self._pos += 1
+            bits += 64
+        return value & ((1 << k) - 1)
+
+    def randrange(self, n: int) -> int:
+        """Return a uniform int in [0, n), exact for arbitrarily large n."""
+        if n <= 0:
+            raise ValueError("randrange() needs a positive bound.")
+        # Rejection sampling on the smallest covering power of two accepts
+        # with probability > 1/2, so this loops about twice at most.
+        k = n.bit_length()
+        while True:
+            value = self.getrandbits(k)
+            if value < n:
+                return value
+
+    def _refill(self) -> None:
+        """Compute the next block of raw 64-bit values."""
+        if self._counter < _SCALAR_VALUES:
+            self._block = [
+                _splitmix64(self._key, i)
+                for i in range(self._counter, self._counter + _SCALAR_BLOCK)
+            ]
+            self._pos = 0
+            self._counter += _SCALAR_BLOCK
+            return
+        counters = np.arange(
+            self._counter, self._counter + _COUNTER_BLOCK, dtype=np.uint64
+        )
+        # uint64 array arithmetic wraps modulo 2^64, as SplitMix64 expects.
+        z = np.uint64(self._key) + (counters + np.uint64(1)) * _GAMMA
+        z = (z ^ (z >> np.uint64(30))) * _MIX1
+        z = (z ^ (z >> np.uint64(27))) * _MIX2
+        z ^= z >> np.uint64(31)
+        self._block = z.tolist()
+        self._pos = 0
+        self._counter += _COUNTER_BLOCK
+
+
+def _splitmix64(key: int, counter: int) -> int:
+    """Value number counter of the stream keyed by key, in plain Python."""
+    z = (key + (counter + 1) * _GAMMA_INT) & _MASK64
+    z = ((z ^ (z >> 30)) * _MIX1_INT) & _MASK64
+    z = ((z ^ (z >> 27)) * _MIX2_INT) & _MASK64
+    return z ^ (z >> 31)
@@ -0,0 +1,316 @@
+# Exact sentence statistics under a production distribution.
+#
+# Sizing buffers and context windows used to mean sampling thousands of
+# sentences and measuring them. For an acyclic grammar every statistic of
+# the sampler's output follows from the production probabilities by the
+# same children-first recurrence as the derivation counts:
+#
+#   length distribution  mixture over productions of the convolution of
+#                        the children's distributions
+#   mean and variance    sums over children inside a production (lengths
+#                        of independent children add), mixed over
+#                        productions by the law of total variance
+#   terminal counts      expected occurrences of each terminal, the
+#                        probability-weighted sum over children
+#
+# and expected expansion counts of each nonterminal run the same recurrence
+# top-down from the root. One sweep over GrammarAnalysis.order covers every
+# symbol. With Fraction probabilities all results are exact rationals.
+#
+# k-gram counts need one more piece of state. A k-gram either lies inside
+# one child's output or crosses a boundary between children, and a
+# crossing k-gram is determined by the last k - 1 terminals before the
+# boundary and the first k - 1 after it. So each symbol also carries the
+# joint distribution of its output's (first k - 1, last k - 1) terminals;
+# children expand independently, so a production's distribution and its
+# expected crossings follow by scanning its children left to right.
+#
+# The entropy of the derivation distribution obeys the same recurrence
+# too: the entropy of the production choice plus the children's entropies.
+
+import math
+from fractions import Fraction
+
+
+class SentenceStatistics:
+    """Per-symbol output statistics of an acyclic grammar's sampler.
+
+    Indexed by symbol id. Entries of recursive symbols (and symbols that
+    reach them) are None; see cfg_partition for their expected lengths.
+
+    Attributes:
+        means: expected output length.
+        variances: variance of the output length.
+        terminal_counts: expected number of occurrences of each terminal
+            id, as a list of length num_terminals.
+        entropies: entropy in bits of the distribution over derivations,
+            as floats. For an unambiguous grammar this is the entropy of
+            the output string; ambiguity only adds to it.
+    """
+
+    def __init__(self, compiled, probabilities: list) -> None:
+        """Compute means, variances and terminal counts in one sweep.
+
+        Args:
+            compiled: the CompiledGrammar.
+            probabilities: probability of each production id given its
+                nonterminal, as floats or Fractions. Fractions make every
+                statistic exact.
+        """
+        self.compiled = compiled
+        self.probabilities = probabilities
+        T = compiled.num_terminals
+        analysis = compiled.analysis
+        zero = probabilities[0] * 0 if probabilities else 0
+        self._zero = zero
+
+        means: list = [zero + 1] * T + [None] * compiled.num_nonterminals
+        variances: list = [zero] * T + [None] * compiled.num_nonterminals
+        terminal_counts: list = [
+            [zero + (t == u) for u in range(T)] for t in range(T)
+        ] + [None] * compiled.num_nonterminals
+        entropies: list = [0.0] * T + [None] * compiled.num_nonterminals
+
+        for sym in analysis.order:
+            if analysis.max_lengths[sym] is None:
+                continue
+            mean = zero
+            second = zero
+            counts = [zero] * T
+            entropy = 0.0
+            for p in self._productions(sym):
+                q = probabilities[p]
+                if q:
+                    entropy += float(q) * (
+                        -math.log2(q)
+                        + sum(entropies[child] for child in compiled.rhs(p))
+                    )
+                # Independent children: means and variances add.
+                p_mean = zero
+                p_variance = zero
+                for child in compiled.rhs(p):
+                    p_mean += means[child]
+                    p_variance += variances[child]
+                    for t, c in enumerate(terminal_counts[child]):
+                        counts[t] += q * c
+                mean += q * p_mean
+                second += q * (p_variance + p_mean * p_mean)
+            means[sym] = mean
+            # Rounding can push a float variance just below zero.
+            variances[sym] = max(second - mean * mean, zero)
+            terminal_counts[sym] = counts
+            entropies[sym] = entropy
+
+        self.means = tuple(means)
+        self.variances = tuple(variances)
+        self.terminal_counts = tuple(terminal_counts)
+        self.entropies = tuple(entropies)
+        self._distributions: dict[int, tuple] = {}
+        # Per k: symbol id -> (expected k-gram counts, boundary summaries).
+        self._kgrams: dict[int, dict[int, tuple[dict, dict]]] = {}
+
+    def distribution(self, symbol_id: int) -> tuple:
+        """Probability of each output length of a symbol.
+
+        Entry L is the probability that the sampler's output has exactly L
+        terminals; the last entry is at the symbol's maximum length.
+        Tables are built children first and cached.
+        """
+        compiled = self.compiled
+        T = compiled.num_terminals
+        analysis = compiled.analysis
+        if analysis.max_lengths[symbol_id] is None:
+            raise ValueError(
+                f"{compiled.symbols[symbol_id]!r} reaches a recursive rule; "
+                "its length distribution is unbounded."
+            )
+        zero = self._zero
+        dists = self._distributions
+
+        # Iterative post-order DFS so children are built before parents.
+        stack = [symbol_id]
+        while stack:
+            sym = stack[-1]
+            if sym in dists:
+                stack.pop()
+                continue
+            if sym < T:
+                dists[sym] = (zero, zero + 1)
+                stack.pop()
+                continue
+            missing = [
+                child
+                for p in self._productions(sym)
+                for child in compiled.rhs(p)
+                if child not in dists
+            ]
+            if missing:
+                stack.extend(missing)
+                continue
+
+            stack.pop()
+            total = [zero] * (analysis.max_lengths[sym] + 1)
+            for p in self._productions(sym):
+                poly = [self.probabilities[p]]
+                for child in compiled.rhs(p):
+                    poly = _convolve(poly, dists[child], zero)
+                for length, x in enumerate(poly):
+                    total[length] += x
+            dists[sym] = tuple(total)
+        return dists[symbol_id]
+
+    def expansions(self, symbol_id: int) -> list:
+        """Expected number of times each nonterminal is expanded.
+
+        Args:
+            symbol_id: the root of the derivation.
+
+        Returns:
+            A list indexed by symbol id. Entries of terminals are their
+            expected occurrences in the output.
+        """
+        compiled = self.compiled
+        analysis = compiled.analysis
+        if analysis.max_lengths[symbol_id] is None:
+            raise ValueError(
+                f"{compiled.symbols[symbol_id]!r} reaches a recursive rule."
+            )
+        zero = self._zero
+        expected = [zero] * len(compiled.symbols)
+        expected[symbol_id] = zero + 1
+        # Parents before children: reversed order. Nothing below the root
+        # is recursive, so every symbol comes after all of its parents, and
+        # terminals collect their counts from the parents.
+        for sym in reversed(analysis.order):
+            visits = expected[sym]
+            if not visits:
+                continue
+            for p in self._productions(sym):
+                share = visits * self.probabilities[p]
+                for child in compiled.rhs(p):
+                    expected[child] += share
+        return expected
+
+    def kgram_counts(self, symbol_id: int, k: int) -> dict:
+        """Expected number of occurrences of each k-gram in a symbol's output.
+
+        Args:
+            symbol_id: the symbol to derive from.
+            k: the k-gram length, at least 1.
+
+        Returns:
+            A dict from tuples of k terminal ids to their expected count.
+            k-grams that can't occur are absent.
+        """
+        compiled = self.compiled
+        T = compiled.num_terminals
+        if k < 1:
+            raise ValueError("k must be at least 1.")
+        if compiled.analysis.max_lengths[symbol_id] is None:
+            raise ValueError(
+                f"{compiled.symbols[symbol_id]!r} reaches a recursive rule."
+            )
+        zero = self._zero
+        tables = self._kgrams.setdefault(k, {})
+
+        # Iterative post-order DFS so children are built before parents.
+        stack = [symbol_id]
+        while stack:
+            sym = stack[-1]
+            if sym in tables:
+                stack.pop()
+                continue
+            if sym < T:
+                counts = {(sym,): zero + 1} if k == 1 else {}
+                edge = (sym,)[:k - 1]
+                tables[sym] = (counts, {(edge, edge): zero + 1})
+                stack.pop()
+                continue
+            missing = [
+                child
+                for p in self._productions(sym)
+                for child in compiled.rhs(p)
+                if child not in tables
+            ]
+            if missing:
+                stack.extend(missing)
+                continue
+
+            stack.pop()
+            counts: dict = {}
+            summaries: dict = {}
+            for p in self._productions(sym):
+                q = self.probabilities[p]
+                if not q:
+                    continue
+                # Scan the children, tracking the (first, last) summary
+                # distribution of the output so far.
+                partial = {((), ()): zero + 1}
+                for child in compiled.rhs(p):
+                    child_counts, child_summaries = tables[child]
+                    for gram, c in child_counts.items():
+                        counts[gram] = counts.get(gram, zero) + q * c
+                    combined: dict = {}
+                    for (first, last), pp in partial.items():
+                        for (c_first, c_last), pc in child_summaries.items():
+                            weight = pp * pc
+                            # Crossing k-grams of the boundary.
+                            window = last + c_first
+                            for i in range(max(0, len(last) - k + 1), len(last)):
+                                if i + k <= len(window):
+                                    gram = window[i:i + k]
+                                    counts[gram] = counts.get(gram, zero) + q * weight
+                            tail = last + c_last
+                            key = ((first + c_first)[:k - 1], tail[max(0, len(tail) - k + 1):])
+                            combined[key] = combined.get(key, zero) + weight
+                    partial = combined
+                for key, pp in partial.items():
+                    summaries[key] = summaries.get(key, zero) + q * pp
+            tables[sym] = (counts, summaries)
+        return tables[symbol_id][0]
+
+    # ── Private helpers ─────────────────────────────────────────────────
+
+    def _productions(self, sym: int) -> range:
+        """Production ids of nonterminal symbol id sym."""
+        nt_index = sym - self.compiled.num_terminals
+        return range(
+            self.compiled.prod_offsets[nt_index],
+            self.compiled.prod_offsets[nt_index + 1],
+        )
+
+
+def _convolve(a: list, b: tuple, zero) -> list:
+    """Convolve two coefficient lists, skipping zero coefficients."""
+    out = [zero] * (len(a) + len(b) - 1)
+    nonzero_b = [(j, y) for j, y in enumerate(b) if y]
+    for i, x in enumerate(a):
+        if x:
+            for j, y in nonzero_b:
+                out[i + j] += x * y
+    return out
+
+
+def production_probabilities(compiled, weights: dict | None, exact: bool) -> list:
+    """Normalize a weights dict into per-production-id probabilities.
+
+    Args:
+        compiled: the CompiledGrammar.
+        weights: nonterminal -> list of non-negative weights, as for
+            CFGrammar.generate; missing nonterminals (or None) mean equal
+            weights.
+        exact: return Fractions (exact for int and float weights) instead
+            of floats.
+    """
+    T = compiled.num_terminals
+    probs = []
+    for nt_index in range(compiled.num_nonterminals):
+        k = compiled.prod_offsets[nt_index + 1] - compiled.prod_offsets[nt_index]
+        nt_weights = None if weights is None else weights.get(compiled.symbols[T + nt_index])
+        if nt_weights is None:
+            nt_weights = [1] * k
+        if exact:
+            nt_weights = [Fraction(w) for w in nt_weights]
+        total = sum(nt_weights)
+        probs.extend(w / total for w in nt_weights)
+    return probs
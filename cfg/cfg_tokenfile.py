@@ -0,0 +1,478 @@
+# On-disk format for token datasets.
+#
+# The original format is a bare stream of big-endian int32 token ids (struct
+# format "!i"), one window after another. A character-level cfg3 vocabulary
+# has a handful of tokens, so three of every four bytes are zero, the byte
+# order can't be memory-mapped on common hardware, and nothing in the file
+# says which grammar, tokenizer or window length produced it.
+#
+# Version 2 files start with a self-describing header:
+#
+#   magic        8 bytes, b"CFGTOK\x00\x02"
+#   header size  uint32, little-endian: bytes of JSON that follow
+#   header       UTF-8 JSON, space-padded so the tokens start on a
+#                64-byte boundary
+#   tokens       little-endian uint8, uint16 or uint32, whichever is the
+#                narrowest to hold the vocabulary, window after window
+#
+# The JSON header records the format version, dtype, window length, the
+# tokenizer's vocabulary (or its size and name when the vocabulary is too
+# large to be worth storing) and BOS/EOS ids, the grammar's name and
+# digest, and the seed. Files without the magic are read as the legacy
+# format.
+#
+# Windows cut sentences at arbitrary points, so per-sentence access needs
+# to know where sentences are. The sentence index is a sidecar file,
+# filename + ".idx", holding a (num_sentences, 2) array of the stream
+# positions of each sentence's BOS and EOS tokens in .npy format, as
+# uint32 when positions fit and uint64 otherwise. The writer builds it
+# while writing; build_index makes one for an existing file.
+#
+# Large datasets are split into shards: a directory of version 2 files plus
+# a JSON manifest, manifest.json, holding the header the shards share and
+# each shard's file name and window count. The manifest is all a reader
+# needs to index every window without opening a shard. A directory without
+# a manifest is scanned, so shards written independently (say, one prefix
+# per generating machine) can be collected by write_manifest afterwards.
+
+import json
+import os
+
+import numpy as np
+
+MAGIC = b"CFGTOK\x00\x02"
+VERSION = 2
+
+# Tokens start at a multiple of this offset.
+_ALIGNMENT = 64
+
+# Vocabularies up to this size are stored in the header.
+_MAX_STORED_VOCAB = 4096
+
+# Suffix of the sentence index sidecar.
+INDEX_SUFFIX = ".idx"
+
+# Name of the manifest in a shard directory.
+MANIFEST_NAME = "manifest.json"
+
+# Header fields every shard of a dataset must agree on.
+_SHARED_FIELDS = ("version", "dtype", "window_length", "tokenizer", "grammar_digest")
+
+# Tokens scanned per step by build_index.
+_SCAN_CHUNK = 1 << 22
+
+_DTYPES = {"uint8": np.dtype("<u1"), "uint16": np.dtype("<u2"), "uint32": np.dtype("<u4")}
+
+
+def dtype_for_vocab(vocab_size: int) -> str:
+    """Name of the narrowest unsigned dtype that holds every token id."""
+    for name, dtype in _DTYPES.items():
+        if vocab_size <= np.iinfo(dtype).max + 1:
+            return name
+    raise ValueError(f"Vocabulary of {vocab_size} tokens is too large.")
+
+
+def tokenizer_header(tokenizer) -> dict:
+    """Describe a tokenizer for a file header.
+
+    Small vocabularies (such as CFGCharacterTokenizer's) are stored in full,
+    token id order; others are recorded by size and name.
+    """
+    vocab_size = len(tokenizer)
+    vocab = None
+    decode_vocab = getattr(tokenizer, "decode_vocab", None)
+    if decode_vocab is not None and vocab_size <= _MAX_STORED_VOCAB:
+        vocab = [decode_vocab[i] for i in range(vocab_size)]
+    return {
+        "name": getattr(tokenizer, "name_or_path", type(tokenizer).__name__),
+        "vocab_size": vocab_size,
+        "vocab": vocab,
+        "bos_id": _special_id(tokenizer, "bos"),
+        "eos_id": _special_id(tokenizer, "eos"),
+    }
+
+
+def _special_id(tokenizer, kind: str) -> int | None:
+    """Id of the BOS or EOS token, for character and HuggingFace tokenizers."""
+    token_id = getattr(tokenizer, f"{kind}_token_id", None)
+    if token_id is None:
+        token = getattr(tokenizer, f"{kind}_token", None)
+        # CFGCharacterTokenizer stores the encoded token as a list.
+        if isinstance(token, list) and len(token) == 1:
+            token_id = token[0]
+    return token_id
+
+
+class TokenFileWriter:
+    """Writes a version 2 token file, one window at a time.
+
+    Use as a context manager:
+
+        with TokenFileWriter(path, window_length, tokenizer) as writer:
+            for window in windows:
+                writer.write(window)
+
+    Unless index is False, the sentence index is written next to the file
+    on close, from the BOS and EOS positions seen in the windows.
+    """
+
+    def __init__(
+        self,
+        path,
+        window_length: int,
+        tokenizer,
+        grammar=None,
+        seed: int | None = None,
+        index: bool = True,
+    ) -> None:
+        """Open the file and write the header.
+
+        Args:
+            path: output file path.
+            window_length: number of tokens in every window.
+            tokenizer: the tokenizer the ids come from; its length picks
+                the dtype.
+            grammar: optional CFGrammar the windows were generated from.
+            seed: optional seed the generation used.
+            index: whether to write the sentence index. Needs a tokenizer
+                with BOS and EOS tokens.
+        """
+        tokenizer_info = tokenizer_header(tokenizer)
+        self.dtype_name = dtype_for_vocab(tokenizer_info["vocab_size"])
+        self.dtype = _DTYPES[self.dtype_name]
+        self.window_length = window_length
+        self.header = {
+            "version": VERSION,
+            "dtype": self.dtype_name,
+            "window_length": window_length,
+            "tokenizer": tokenizer_info,
+            "grammar": None if grammar is None else grammar.name,
+            "grammar_digest": None if grammar is None else grammar.digest,
+            "seed": seed,
+        }
+        self.num_windows = 0
+        self.path = path
+        self._bos_id = tokenizer_info["bos_id"]
+        self._eos_id = tokenizer_info["eos_id"]
+        self._index = index and self._bos_id is not None and self._eos_id is not None
+        # Stream positions of BOS and EOS tokens, one array per window.
+        self._bos_positions: list[np.ndarray] = []
+        self._eos_positions: list[np.ndarray] = []
+        self._file = open(path, "wb")
+        self._file.write(encode_header(self.header))
+
+    def write(self, tokens) -> None:
+        """Append one window of token ids (a list, array or tensor)."""
+        array = np.asarray(tokens)
+        if array.shape != (self.window_length,):
+            raise ValueError(
+                f"Expected a window of {self.window_length} tokens, got shape "
+                f"{array.shape}."
+            )
+        if array.size and (array.min() < 0 or array.max() > np.iinfo(self.dtype).max):
+            raise ValueError(f"Token ids don't fit in {self.dtype_name}.")
+        self._file.write(array.astype(self.dtype).tobytes())
+        if self._index:
+            start = self.num_windows * self.window_length
+            self._bos_positions.append(np.flatnonzero(array == self._bos_id) + start)
+            self._eos_positions.append(np.flatnonzero(array == self._eos_id) + start)
+        self.num_windows += 1
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        self._file.close()
+        if self._index:
+            save_index(
+                self.path,
+                pair_sentences(
+                    np.concatenate(self._bos_positions or [np.zeros(0, np.int64)]),
+                    np.concatenate(self._eos_positions or [np.zeros(0, np.int64)]),
+                ),
+                self.num_windows * self.window_length,
+            )
+
+    def __enter__(self) -> "TokenFileWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class ShardedTokenWriter:
+    """Writes windows into a directory of version 2 shards and a manifest.
+
+    Use as a context manager, like TokenFileWriter:
+
+        with ShardedTokenWriter(directory, window_length, tokenizer) as writer:
+            for window in windows:
+                writer.write(window)
+
+    A new shard, prefix + "-00000.tok" and so on, is started every
+    shard_windows windows, each with its own sentence index. On close the
+    manifest is written, unless manifest is False: several writers sharing
+    a directory should each use their own prefix and leave the manifest to
+    a single write_manifest call once they are all done.
+    """
+
+    def __init__(
+        self,
+        directory,
+        window_length: int,
+        tokenizer,
+        grammar=None,
+        seed: int | None = None,
+        shard_windows: int = 1 << 16,
+        prefix: str = "shard",
+        index: bool = True,
+        manifest: bool = True,
+    ) -> None:
+        """Create the directory; shards are opened as windows arrive.
+
+        Args:
+            directory: output directory, created if missing.
+            window_length: number of tokens in every window.
+            tokenizer: the tokenizer the ids come from.
+            grammar: optional CFGrammar the windows were generated from.
+            seed: optional seed the generation used.
+            shard_windows: number of windows per shard.
+            prefix: file name prefix of the shards.
+            index: whether to write each shard's sentence index.
+            manifest: whether to write the manifest on close.
+        """
+        if shard_windows < 1:
+            raise ValueError("shard_windows must be at least 1.")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.window_length = window_length
+        self.shard_windows = shard_windows
+        self.prefix = prefix
+        self.num_windows = 0
+        # (file name, window count) of every finished shard.
+        self.shards: list[tuple[str, int]] = []
+        self._writer_args = (window_length, tokenizer, grammar, seed, index)
+        self._writer: TokenFileWriter | None = None
+        self._manifest = manifest
+        self._closed = False
+
+    def write(self, tokens) -> None:
+        """Append one window of token ids, starting a new shard if full."""
+        if self._writer is not None and self._writer.num_windows == self.shard_windows:
+            self._finish_shard()
+        if self._writer is None:
+            name = f"{self.prefix}-{len(self.shards):05d}.tok"
+            self._writer = TokenFileWriter(
+                os.path.join(self.directory, name), *self._writer_args
+            )
+        self._writer.write(tokens)
+        self.num_windows += 1
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        if self._writer is not None:
+            self._finish_shard()
+        if self._manifest:
+            write_manifest(self.directory)
+
+    def __enter__(self) -> "ShardedTokenWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _finish_shard(self) -> None:
+        self._writer.close()
+        self.shards.append(
+            (os.path.basename(self._writer.path), self._writer.num_windows)
+        )
+        self._writer = None
+
+
+def scan_shards(directory) -> dict:
+    """Build the manifest of a shard directory from the shards' headers.
+
+    Every version 2 file in the directory is a shard, in file name order;
+    other files (sentence indexes, an old manifest) are ignored.
+
+    Raises:
+        ValueError: if shards disagree on dtype, window length, tokenizer
+            or grammar, or a shard holds a partial window.
+    """
+    manifest = None
+    shards = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if name.endswith(INDEX_SUFFIX) or not os.path.isfile(path):
+            continue
+        info = read_header(path)
+        if info is None:
+            continue
+        header, offset = info
+        if manifest is None:
+            manifest = dict(header)
+        for field in _SHARED_FIELDS:
+            if header.get(field) != manifest.get(field):
+                raise ValueError(
+                    f"Shard {path!r} has a different {field} from {shards[0]['path']!r}."
+                )
+        # Shards generated separately may use different seeds.
+        if header.get("seed") != manifest.get("seed"):
+            manifest["seed"] = None
+        window_bytes = header["window_length"] * header_dtype(header).itemsize
+        size = os.path.getsize(path) - offset
+        if size % window_bytes:
+            raise ValueError(f"Shard {path!r} ends in a partial window.")
+        shards.append({"path": name, "num_windows": size // window_bytes})
+    if manifest is None:
+        raise ValueError(f"No version 2 token files in {os.fspath(directory)!r}.")
+    manifest["shards"] = shards
+    manifest["num_windows"] = sum(shard["num_windows"] for shard in shards)
+    return manifest
+
+
+def write_manifest(directory) -> dict:
+    """Scan a shard directory and write its manifest; return the manifest.
+
+    The manifest is written to a temporary name and renamed into place, so
+    a concurrent reader never sees a half-written one.
+    """
+    manifest = scan_shards(directory)
+    path = os.path.join(directory, MANIFEST_NAME)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, path)
+    return manifest
+
+
+def read_manifest(path) -> dict:
+    """Load the manifest of a sharded dataset.
+
+    Args:
+        path: a manifest file, or a shard directory. A directory without a
+            manifest is scanned (see scan_shards).
+
+    Returns:
+        The manifest dict: the shared header fields, "num_windows", and
+        "shards", a list of {"path", "num_windows"} dicts whose paths are
+        resolved against the manifest's directory.
+    """
+    if os.path.isdir(path):
+        directory = path
+        manifest_path = os.path.join(path, MANIFEST_NAME)
+        if not os.path.exists(manifest_path):
+            manifest = scan_shards(directory)
+            manifest_path = None
+    else:
+        directory = os.path.dirname(os.fspath(path))
+        manifest_path = path
+    if manifest_path is not None:
+        with open(manifest_path) as f:
+            try:
+                manifest = json.load(f)
+            except ValueError as e:
+                raise ValueError(f"Corrupted manifest {os.fspath(manifest_path)!r}.") from e
+    for shard in manifest["shards"]:
+        shard["path"] = os.path.join(directory, shard["path"])
+    return manifest
+
+
+def encode_header(header: dict) -> bytes:
+    """Magic, size and padded JSON of a header, ending on an aligned offset."""
+    body = json.dumps(header).encode()
+    prefix = len(MAGIC) + 4
+    padded = -(prefix + len(body)) % _ALIGNMENT
+    body += b" " * padded
+    return MAGIC + len(body).to_bytes(4, "little") + body
+
+
+def read_header(path) -> tuple[dict, int] | None:
+    """Return (header, data offset) of a version 2 file, or None if legacy.
+
+    Raises:
+        ValueError: if the file has the magic but an unreadable header.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            return None
+        size = int.from_bytes(f.read(4), "little")
+        raw = f.read(size)
+    try:
+        header = json.loads(raw)
+    except ValueError as e:
+        raise ValueError(f"Corrupted token file header in {os.fspath(path)!r}.") from e
+    if header.get("version") != VERSION or header.get("dtype") not in _DTYPES:
+        raise ValueError(
+            f"Unsupported token file version {header.get('version')!r} or dtype "
+            f"{header.get('dtype')!r}."
+        )
+    return header, len(MAGIC) + 4 + size
+
+
+def header_dtype(header: dict) -> np.dtype:
+    """The NumPy dtype of a version 2 file's tokens."""
+    return _DTYPES[header["dtype"]]
+
+
+def pair_sentences(bos: np.ndarray, eos: np.ndarray) -> np.ndarray:
+    """Match sorted BOS and EOS positions into (start, end) sentence pairs.
+
+    Each BOS is paired with the first EOS after it, provided no other BOS
+    comes in between; sentences cut off by the end of the file (or
+    otherwise malformed) are dropped.
+    """
+    following = np.searchsorted(eos, bos)
+    has_end = following < len(eos)
+    ends = eos[np.minimum(following, len(eos) - 1)] if len(eos) else bos
+    next_bos = np.append(bos[1:], np.iinfo(np.int64).max)
+    keep = has_end & (ends < next_bos)
+    return np.stack([bos[keep], ends[keep]], axis=1)
+
+
+def save_index(path, sentences: np.ndarray, num_tokens: int) -> None:
+    """Write the sentence index sidecar of a token file."""
+    dtype = np.uint32 if num_tokens <= np.iinfo(np.uint32).max else np.uint64
+    with open(os.fspath(path) + INDEX_SUFFIX, "wb") as f:
+        np.save(f, sentences.astype(dtype).reshape(-1, 2))
+
+
+def load_index(path) -> np.ndarray:
+    """Memory-map the sentence index of a token file.
+
+    Raises:
+        FileNotFoundError: if the file has no index; see build_index.
+    """
+    index_path = os.fspath(path) + INDEX_SUFFIX
+    if not os.path.exists(index_path):
+        raise FileNotFoundError(
+            f"No sentence index {index_path!r}; create one with build_index()."
+        )
+    return np.load(index_path, mmap_mode="r")
+
+
+def build_index(path, tokens: np.ndarray, bos_id: int, eos_id: int) -> np.ndarray:
+    """Scan an existing token stream once and write its sentence index.
+
+    Args:
+        path: the token file the index belongs to.
+        tokens: the file's tokens as a flat array (e.g. a memory map).
+        bos_id: id of the BOS token.
+        eos_id: id of the EOS token.
+
+    Returns:
+        The (num_sentences, 2) array that was written.
+    """
+    bos = []
+    eos = []
+    for start in range(0, len(tokens), _SCAN_CHUNK):
+        chunk = np.asarray(tokens[start:start + _SCAN_CHUNK])
+        bos.append(np.flatnonzero(chunk == bos_id) + start)
+        eos.append(np.flatnonzero(chunk == eos_id) + start)
+    sentences = pair_sentences(
+        np.concatenate(bos or [np.zeros(0, np.int64)]),
+        np.concatenate(eos or [np.zeros(0, np.int64)]),
+    )
+    save_index(path, sentences, len(tokens))
+    return sentences
@@ -151,6 +151,8 @@ def uniform_sentence_weights(cfg_rules):
     Returns:
         A dict mapping each nonterminal to a list of weights (one per production
         rule). random.choices normalizes these internally, so raw counts work
-        as weights — no need to convert to probabilities.
+        as weights — no need to convert to probabilities. CFGrammar.generate
+        accepts the same dict and converts it once into cached alias tables
+        (see cfg_sampling), so the big-int counts are not re-summed per draw.
     """
     return _count_per_production(cfg_rules)
@@ -5,8 +5,8 @@ import sys
 
 from cfg import cfg_datasets, cfg_defines
 from cfg.cfg_grammar import CFGrammar
-
-import transformers
+from cfg.cfg_tokenfile import ShardedTokenWriter, TokenFileWriter
+from cfg.cfg_tokenizers import CFGCharacterTokenizer
 
 parser = argparse.ArgumentParser(
     prog="generate dataset",
@@ -18,26 +18,72 @@ parser.add_argument("--overwrite", type=bool, default=False)
 parser.add_argument("--cfg", default="cfg3b")
 parser.add_argument("--context_length", default=512, type=int)
 parser.add_argument("--num_generations", default=100, type=int)
+parser.add_argument(
+    "--tokenizer",
+    choices=["char", "gpt2"],
+    default="char",
+    help="char: one token per terminal (CFGCharacterTokenizer); gpt2: GPT-2 BPE.",
+)
+parser.add_argument("--seed", default=None, type=int)
+parser.add_argument(
+    "--format",
+    choices=[1, 2],
+    default=2,
+    type=int,
+    help="2: compact self-describing format; 1: legacy big-endian int32.",
+)
+parser.add_argument(
+    "--shard_windows",
+    default=None,
+    type=int,
+    help="Format 2 only: write a directory of shards with this many windows each.",
+)
+parser.add_argument(
+    "--shard_prefix",
+    default="shard",
+    help="File name prefix of the shards, distinct per concurrent writer.",
+)
 
 args = parser.parse_args()
 
 
-def generate_dataset_from_cfg(cfg, output_file_path, context_length, num_generations, tokenizer):
+def generate_dataset_from_cfg(
+    cfg, output_file_path, context_length, num_generations, tokenizer,
+    seed=None, file_format=2, shard_windows=None, shard_prefix="shard",
+):
 
     new_dataset = cfg_datasets.CFGRandomGenerationDataset(
         cfg,
         num_generations=num_generations * 96 * 512,
         tokenizer=tokenizer,
         window_length=context_length,
+        seed=seed,
     )
 
-    with open(output_file_path, "wb") as f:
+    if file_format == 1:
+        with open(output_file_path, "wb") as f:
+            for i, sample in enumerate(new_dataset):
+                token_list = sample.cpu().detach().numpy().tolist()
+                format_string = "!" + "i" * len(token_list)
+                binary_data = struct.pack(format_string, *token_list)
+
+                f.write(binary_data)
+                sys.stdout.write("\rDoing thing %i" % i)
+                sys.stdout.flush()
+        return
+
+    if shard_windows is not None:
+        writer = ShardedTokenWriter(
+            output_file_path, context_length, tokenizer, grammar=cfg, seed=seed,
+            shard_windows=shard_windows, prefix=shard_prefix,
+        )
+    else:
+        writer = TokenFileWriter(
+            output_file_path, context_length, tokenizer, grammar=cfg, seed=seed
+        )
+    with writer:
         for i, sample in enumerate(new_dataset):
-            token_list = sample.cpu().detach().numpy().tolist()
-            format_string = "!" + "i" * len(token_list)
-            binary_data = struct.pack(format_string, *token_list)
-
-            f.write(binary_data)
+            writer.write(sample.cpu().numpy())
             sys.stdout.write("\rDoing thing %i" % i)
             sys.stdout.flush()
 
@@ -51,15 +97,24 @@ if __name__ == "__main__":
 
     cfg = CFGrammar.from_name(args.cfg)
 
-    tokenizer = transformers.GPTNeoXTokenizerFast.from_pretrained(
-        "openai-community/gpt2"
-    )
+    if args.tokenizer == "char":
+        tokenizer = CFGCharacterTokenizer(cfg.terminal_symbols)
+    else:
+        import transformers
+
+        tokenizer = transformers.GPTNeoXTokenizerFast.from_pretrained(
+            "openai-community/gpt2"
+        )
 
     generate_dataset_from_cfg(
         cfg=cfg,
         output_file_path=args.output_path,
         context_length=args.context_length,
         num_generations=args.num_generations,
-        tokenizer=tokenizer
+        tokenizer=tokenizer,
+        seed=args.seed,
+        file_format=args.format,
+        shard_windows=args.shard_windows,
+        shard_prefix=args.shard_prefix,
     )
     print("COMPLETE")
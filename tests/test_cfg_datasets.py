@@ -0,0 +1,197 @@
+# Tests for the dataset classes in cfg_datasets.py.
+
+import pickle
+import random
+import struct
+
+import numpy as np
+import pytest
+import torch
+
+from cfg.cfg_datasets import (
+    CFGFileDataset,
+    CFGRandomGenerationDataset,
+    CFGSentenceDataset,
+)
+from cfg.cfg_grammar import CFGrammar
+from cfg.cfg_tokenfile import (
+    MANIFEST_NAME,
+    ShardedTokenWriter,
+    TokenFileWriter,
+    build_index,
+    read_header,
+    read_manifest,
+)
+from cfg.cfg_tokenizers import CFGCharacterTokenizer
+
+
+def _write_tokens(path, tokens):
+    with open(path, "wb") as f:
+        f.write(struct.pack("!" + "i" * len(tokens), *tokens))
+
+
+def test_file_dataset_mmap_matches_list_mode(tmp_path):
+    """Memory-mapped windows hold the same tokens as the parsed lists."""
+    path = tmp_path / "tokens.bin"
+    _write_tokens(path, list(range(-7, 4 * 16 - 7)))
+
+    parsed = CFGFileDataset(path, "cpu", window_length=16)
+    mapped = CFGFileDataset(path, "cpu", window_length=16, mmap=True)
+    swapped = CFGFileDataset(path, "cpu", window_length=16, mmap=True, native_copy=False)
+    assert len(parsed) == len(mapped) == len(swapped) == 3
+    for i in range(len(parsed)):
+        assert torch.equal(mapped[i], parsed[i].to(torch.int32))
+        assert torch.equal(swapped[i], parsed[i].to(torch.int32))
+
+    # Native mode returns views of the mapping, and pickles without it.
+    assert mapped[1].data_ptr() == mapped[1].data_ptr()
+    restored = pickle.loads(pickle.dumps(mapped))
+    assert torch.equal(restored[2], mapped[2])
+
+
+def test_file_dataset_rejects_partial_window(tmp_path):
+    """A file that doesn't hold whole windows is reported in both modes."""
+    path = tmp_path / "tokens.bin"
+    _write_tokens(path, list(range(20)))
+    for mmap in (False, True):
+        with pytest.raises(ValueError):
+            CFGFileDataset(path, "cpu", window_length=16, mmap=mmap)
+
+
+def test_token_file_v2_round_trip(tmp_path):
+    """Version 2 files are narrow, self-describing and validated on load."""
+    grammar = CFGrammar.from_name("cfg3b")
+    tokenizer = CFGCharacterTokenizer(grammar.terminal_symbols)
+    windows = list(CFGRandomGenerationDataset(grammar, 4 * 32, tokenizer, window_length=32))
+    path = tmp_path / "tokens.v2"
+    with TokenFileWriter(path, 32, tokenizer, grammar=grammar, seed=7) as writer:
+        for window in windows:
+            writer.write(window)
+
+    header, offset = read_header(path)
+    assert header["dtype"] == "uint8" and header["seed"] == 7
+    assert header["tokenizer"]["vocab"] == ["1", "2", "3", "E", "B"]
+    assert offset % 64 == 0
+    assert path.stat().st_size == offset + 4 * 32
+
+    dataset = CFGFileDataset(path, "cpu", grammar=grammar)
+    assert dataset.window_length == 32 and len(dataset) == 4
+    for i in range(len(dataset)):
+        assert torch.equal(dataset[i], windows[i].to(torch.int32))
+
+    with pytest.raises(ValueError):
+        CFGFileDataset(path, "cpu", window_length=64)
+    with pytest.raises(ValueError):
+        CFGFileDataset(path, "cpu", grammar=CFGrammar.from_name("cfg3f"))
+
+
+def test_sentence_dataset_uses_index(tmp_path):
+    """Sentences and sentence-aligned windows come straight from the index."""
+    grammar = CFGrammar({"S": [["a", "S2"], ["b"]], "S2": [["a"], ["b", "b"]]})
+    tokenizer = CFGCharacterTokenizer(grammar.terminal_symbols)
+    bos, eos = tokenizer.bos_token[0], tokenizer.eos_token[0]
+    rng = random.Random(0)
+    sentences = [grammar.generate("S", rng=rng) for _ in range(30)]
+    stream = [t for s in sentences for t in [bos, *tokenizer.encode(s), eos]]
+    stream = stream[:len(stream) // 8 * 8]
+    path = tmp_path / "tokens.v2"
+    with TokenFileWriter(path, 8, tokenizer) as writer:
+        for i in range(0, len(stream), 8):
+            writer.write(stream[i:i + 8])
+
+    dataset = CFGSentenceDataset(path, "cpu", include_special=False)
+    # Sentences cut off by the final window are left out.
+    complete = stream.count(eos)
+    assert len(dataset) == complete
+    for i in range(len(dataset)):
+        assert tokenizer.decode(dataset[i].tolist()) == sentences[i]
+    assert CFGSentenceDataset(path, "cpu")[0][0] == bos
+
+    windows = CFGSentenceDataset(path, "cpu", mode="window")
+    for i in range(len(windows)):
+        assert windows[i][0] == bos and len(windows[i]) == 8
+
+    # Rebuilding the index from the tokens gives the same sentences.
+    rebuilt = build_index(tmp_path / "copy", dataset.tokens, bos, eos)
+    assert (rebuilt == dataset.sentences).all()
+
+
+def _window_id(window, vocab_size):
+    return int(window[0]) * vocab_size + int(window[1])
+
+
+def test_sharded_dataset_indexes_and_partitions(tmp_path):
+    """Shards read as one dataset, mapped lazily and split across ranks."""
+    grammar = CFGrammar.from_name("cfg3b")
+    tokenizer = CFGCharacterTokenizer(grammar.terminal_symbols)
+    # The first two tokens of window i spell i in base vocab_size.
+    vocab_size = len(tokenizer)
+    windows = [np.array([i // vocab_size, i % vocab_size] + [0] * 6) for i in range(10)]
+    directory = tmp_path / "shards"
+    with ShardedTokenWriter(
+        directory, 8, tokenizer, grammar=grammar, shard_windows=4
+    ) as writer:
+        for window in windows:
+            writer.write(window)
+    assert [n for _, n in writer.shards] == [4, 4, 2]
+
+    for source in (directory, directory / MANIFEST_NAME):
+        dataset = CFGFileDataset(source, "cpu", grammar=grammar)
+        assert len(dataset) == 10
+        assert dataset[9].tolist() == windows[9].tolist()
+        assert dataset[-1].tolist() == windows[9].tolist()
+        assert list(dataset._shard_windows) == [2]
+
+    # A single file with the same windows has the same length.
+    single = tmp_path / "single.tok"
+    with TokenFileWriter(single, 8, tokenizer) as writer:
+        for window in windows:
+            writer.write(window)
+    assert len(CFGFileDataset(single, "cpu")) == 10
+
+    # Without a manifest the directory is scanned.
+    (directory / MANIFEST_NAME).unlink()
+    assert read_manifest(directory)["num_windows"] == 10
+
+    # Ranks get disjoint, equal parts covering all but the remainder.
+    def window_ids(rank, **kwargs):
+        dataset = CFGFileDataset(directory, "cpu", rank=rank, world_size=3, **kwargs)
+        return [_window_id(dataset[i], vocab_size) for i in range(len(dataset))]
+
+    parts = [window_ids(rank) for rank in range(3)]
+    assert parts == [[0, 1, 2], [3, 4, 5], [6, 7, 8]]
+    shuffled = [window_ids(rank, shuffle=True, seed=1) for rank in range(3)]
+    seen = [i for part in shuffled for i in part]
+    assert len(set(seen)) == 9
+    assert shuffled == [window_ids(rank, shuffle=True, seed=1) for rank in range(3)]
+
+    dataset = CFGFileDataset(directory, "cpu", shuffle=True, seed=1)
+    orders = []
+    for epoch in range(3):
+        dataset.set_epoch(epoch)
+        orders.append([_window_id(dataset[i], vocab_size) for i in range(len(dataset))])
+    assert all(sorted(order) == list(range(10)) for order in orders)
+    assert len({tuple(order) for order in orders}) > 1
+
+
+def test_random_generation_dataset_splits_across_workers():
+    """DataLoader workers share the budget and draw independent streams."""
+    grammar = CFGrammar.from_name("cfg3b")
+    tokenizer = CFGCharacterTokenizer(grammar.terminal_symbols)
+
+    def windows(num_workers, seed=3):
+        dataset = CFGRandomGenerationDataset(
+            grammar, 7 * 64 - 10, tokenizer, window_length=64, seed=seed
+        )
+        loader = torch.utils.data.DataLoader(
+            dataset, batch_size=None, num_workers=num_workers
+        )
+        return [tuple(window.tolist()) for window in loader]
+
+    split = windows(2)
+    assert len(split) == 7
+    assert len(set(split)) == 7
+    assert sorted(split) == sorted(windows(2))
+    # A seeded dataset iterated in the main process matches one worker.
+    assert windows(0) == windows(1)
+    assert windows(0) != windows(0, seed=4)
@@ -2,9 +2,28 @@
 # These verify that the class produces the same results as the free
 # functions it consolidates, and that cached state is correct.
 
+import math
+import pickle
+import random
+from collections import Counter
+from fractions import Fraction
+from itertools import product
+
+import numpy as np
+import pytest
+
 from cfg.cfg_grammar import CFGrammar
+from cfg.cfg_frozen import FrozenWeights
 from cfg.cfg_defines import cfg_by_name
-from cfg import cfg_generator, cfg_utils
+from cfg import cfg_generator, cfg_parallel, cfg_utils
+from cfg.cfg_decoding import ROOT_STATE, GrammarMask
+from cfg.cfg_sampling import (
+    CounterRNG,
+    IndexPermutation,
+    _splitmix64,
+    build_alias_table,
+)
+from cfg.cfg_tokenizers import CFGCharacterTokenizer
 
 
 def test_construction_from_dict():
@@ -119,3 +138,743 @@ def test_repr():
     assert "cfg3b" in r
     assert "terminals=" in r
     assert "nonterminals=" in r
+
+
+def test_compiled_layout():
+    """The compiled grammar interns symbols and packs productions flat."""
+    grammar = CFGrammar.from_name("cfg3b")
+    compiled = grammar.compiled
+    assert compiled.symbols[:compiled.num_terminals] == tuple(
+        grammar.terminal_symbols
+    )
+    for nt, productions in grammar.rules.items():
+        nt_index = compiled.symbol_id(nt) - compiled.num_terminals
+        first = compiled.prod_offsets[nt_index]
+        decoded = [
+            [compiled.symbols[i] for i in compiled.rhs(p)]
+            for p in range(first, compiled.prod_offsets[nt_index + 1])
+        ]
+        assert decoded == productions
+
+
+def test_generate_deep_grammar():
+    """Generation does not recurse, so very deep grammars still work."""
+    depth = 5000
+    rules = {str(i): [[str(i + 1), "a"]] for i in range(depth)}
+    rules[str(depth)] = [["b"]]
+    grammar = CFGrammar(rules)
+    assert grammar.generate("0") == "b" + "a" * depth
+
+
+def test_generate_respects_weights():
+    """Zero-weight productions are never chosen."""
+    grammar = CFGrammar({"S": [["a"], ["b"], ["c"]]})
+    weights = {"S": [0, 1, 0]}
+    assert {grammar.generate("S", weights) for _ in range(100)} == {"b"}
+
+
+def test_generate_batch_produces_valid_strings():
+    """Every string in a batch validates, with or without weights."""
+    grammar = CFGrammar.from_name("cfg3b")
+    for weights in (None, grammar.uniform_weights):
+        tokens, offsets = grammar.generate_batch(50, weights=weights, rng=0)
+        assert len(offsets) == 51
+        assert offsets[-1] == len(tokens)
+        for i in range(50):
+            s = grammar.compiled.decode(tokens[offsets[i]:offsets[i + 1]].tolist())
+            assert grammar.validate(s), f"Batch string failed validation: {s}"
+
+
+def test_generate_batch_weighted_distribution():
+    """Batched weighted sampling follows the production weights."""
+    grammar = CFGrammar({"S": [["A", "B"], ["C"]], "A": [["1"], ["2"]],
+                         "B": [["3"], ["4"]], "C": [["5"]]})
+    n = 50_000
+    tokens, offsets = grammar.generate_batch(
+        n, weights=grammar.uniform_weights, rng=0
+    )
+    counts = Counter(
+        grammar.compiled.decode(tokens[offsets[i]:offsets[i + 1]].tolist())
+        for i in range(n)
+    )
+    assert set(counts) == {"13", "14", "23", "24", "5"}
+    for count in counts.values():
+        assert abs(count - n / 5) / (n / 5) < 0.1
+
+
+def test_alias_table_matches_weights():
+    """Alias tables reproduce the weight distribution, even for huge ints."""
+    for weights in ([1, 2, 3, 4], [10**40, 3 * 10**40, 0], [0.5, 0.25, 0.25]):
+        prob, alias = build_alias_table(weights)
+        n = len(weights)
+        implied = [0.0] * n
+        for i in range(n):
+            implied[i] += prob[i] / n
+            implied[alias[i]] += (1.0 - prob[i]) / n
+        total = sum(weights)
+        for got, w in zip(implied, weights):
+            assert abs(got - w / total) < 1e-12
+
+
+def test_sampling_tables_invalidate_on_change():
+    """Mutating a weights dict rebuilds its cached sampling tables."""
+    grammar = CFGrammar({"S": [["a"], ["b"]]})
+    weights = {"S": [1, 0]}
+    assert {grammar.generate("S", weights) for _ in range(50)} == {"a"}
+    weights["S"] = [0, 1]
+    assert {grammar.generate("S", weights) for _ in range(50)} == {"b"}
+    weights["S"][0] = 1
+    weights["S"][1] = 0
+    assert {grammar.generate("S", weights, max_len=1) for _ in range(50)} == {"a"}
+    # Equal weights share tables, however they are passed.
+    frozen = FrozenWeights(weights)
+    assert grammar._sampling_tables(frozen) is grammar._sampling_tables(dict(weights))
+
+
+def test_sentence_at_enumerates_language():
+    """sentence_at walks every derivation in order; index_of inverts it."""
+    grammar = CFGrammar({"S": [["A", "B"], ["C"]], "A": [["1"], ["2"]],
+                         "B": [["3"], ["4"]], "C": [["5"]]})
+    sentences = [grammar.sentence_at(i) for i in range(5)]
+    assert sentences == ["13", "14", "23", "24", "5"]
+    assert [grammar.index_of(s) for s in sentences] == list(range(5))
+
+
+def test_sentence_at_round_trip():
+    """Random derivation indices survive a sentence_at/index_of round trip."""
+    grammar = CFGrammar.from_name("cfg3b")
+    count = grammar.count_generations()
+    rng = random.Random(0)
+    for _ in range(5):
+        index = rng.randrange(count)
+        sentence = grammar.sentence_at(index)
+        assert grammar.validate(sentence)
+        assert grammar.sentence_at(grammar.index_of(sentence)) == sentence
+
+
+def test_index_of_ambiguous_returns_smallest():
+    """Ambiguous strings map to their smallest derivation index."""
+    grammar = CFGrammar({"S": [["A"], ["B"]], "A": [["x"]], "B": [["x"]]})
+    assert grammar.index_of("x") == 0
+
+
+def test_ranking_rejects_bad_input():
+    """Out-of-range indices and non-members raise."""
+    grammar = CFGrammar.from_name("cfg3b")
+    with pytest.raises(IndexError):
+        grammar.sentence_at(grammar.count_generations())
+    with pytest.raises(ValueError):
+        grammar.index_of("123")
+
+
+def test_index_permutation_is_bijection():
+    """The keyed permutation hits every index exactly once."""
+    for n in (1, 2, 7, 64, 1000):
+        permutation = IndexPermutation(n, seed=3)
+        assert sorted(permutation[i] for i in range(n)) == list(range(n))
+    assert [IndexPermutation(100, 1)[i] for i in range(10)] != [
+        IndexPermutation(100, 2)[i] for i in range(10)
+    ]
+
+
+def test_sample_without_replacement_splits():
+    """Disjoint offset ranges give disjoint, reproducible samples."""
+    grammar = CFGrammar.from_name("cfg3b")
+    train = list(grammar.sample_without_replacement(20, seed=7))
+    held_out = list(grammar.sample_without_replacement(20, seed=7, offset=20))
+    assert train == list(grammar.sample_without_replacement(20, seed=7))
+    assert len(set(train) | set(held_out)) == 40
+    assert all(grammar.validate(s) for s in train[:5])
+
+
+def test_count_by_length_matches_totals():
+    """Per-length counts sum to count_generations and end at the longest."""
+    for name, rules in cfg_by_name.items():
+        grammar = CFGrammar(rules, name=name)
+        table = grammar.count_by_length()
+        assert sum(table) == grammar.count_generations()
+        assert len(table) - 1 == grammar.get_longest_sequence()
+
+
+def test_generate_exact_length_is_uniform():
+    """Length-conditioned sampling is uniform over derivations of that length."""
+    grammar = CFGrammar({"S": [["A", "B"], ["c", "c", "c"]],
+                         "A": [["a"], ["a", "a"]], "B": [["b"], ["b", "b"]]})
+    assert grammar.count_by_length("S") == (0, 0, 1, 3, 1)
+
+    rng = random.Random(0)
+    n = 30_000
+    counts = Counter(grammar.generate("S", rng=rng, length=3) for _ in range(n))
+    assert set(counts) == {"aab", "abb", "ccc"}
+    for count in counts.values():
+        assert abs(count - n / 3) / (n / 3) < 0.05
+
+    ranged = {grammar.generate("S", rng=rng, min_len=4) for _ in range(20)}
+    assert ranged == {"aabb"}
+
+
+def test_generate_rule_uniform_conditions_plain_distribution():
+    """rule_uniform=True conditions plain generate() on the length."""
+    grammar = CFGrammar({"S": [["A", "B"], ["c", "c", "c"]],
+                         "A": [["a"], ["a", "a"]], "B": [["b"], ["b", "b"]]})
+    n = 20_000
+    rng = random.Random(1)
+    plain = Counter(grammar.generate("S", rng=rng) for _ in range(n))
+    bounded = Counter(
+        grammar.generate("S", rng=rng, max_len=100, rule_uniform=True)
+        for _ in range(n)
+    )
+    # Rule-uniform: P(ccc) = 1/2 and each A B string 1/8.
+    for sentence, p in [("ccc", 1 / 2), ("ab", 1 / 8), ("aabb", 1 / 8)]:
+        assert abs(plain[sentence] / n - p) < 0.02
+        assert abs(bounded[sentence] / n - p) < 0.02
+    # Conditioned on length 3: ccc has probability 1/2 / (1/2 + 2/8).
+    exact = Counter(
+        grammar.generate("S", rng=rng, length=3, rule_uniform=True)
+        for _ in range(n)
+    )
+    assert abs(exact["ccc"] / n - 2 / 3) < 0.02
+    # By default a length bound samples the five derivations uniformly.
+    derivations = Counter(grammar.generate("S", rng=rng, max_len=100) for _ in range(n))
+    assert abs(derivations["ccc"] / n - 1 / 5) < 0.02
+    with pytest.raises(ValueError):
+        grammar.generate("S", {"S": [1, 1]}, max_len=3, rule_uniform=True)
+
+
+def test_counter_rng_streams_are_reproducible():
+    """A (seed, stream) pair always yields the same values."""
+    a = CounterRNG(1, 5)
+    b = CounterRNG(1, 5)
+    values = [a.random() for _ in range(600)]
+    assert values == [b.random() for _ in range(600)]
+    assert all(0.0 <= v < 1.0 for v in values)
+    assert values[:10] != [CounterRNG(1, 6).random() for _ in range(10)]
+    assert 0 <= CounterRNG(2).randrange(10**50) < 10**50
+
+    # The Python blocks at the start of a stream and the NumPy blocks
+    # after them compute the same function of the counter.
+    c = CounterRNG(1, 5)
+    raw = [c.getrandbits(64) for _ in range(600)]
+    assert raw == [_splitmix64(c._key, i) for i in range(600)]
+
+
+def test_generate_parallel_independent_of_workers():
+    """Parallel output is identical for any worker count and any shard."""
+    grammar = CFGrammar.from_name("cfg3b")
+    serial = grammar.generate_parallel(40, seed=11, workers=1)
+    parallel = cfg_parallel.generate_parallel(
+        grammar, 40, seed=11, workers=2, chunk_size=7
+    )
+    assert parallel == serial
+    assert grammar.generate_parallel(10, seed=11, workers=1, offset=30) == serial[30:]
+    assert all(grammar.validate(s) for s in serial[:5])
+
+    # Weights reach the workers through the pool initializer.
+    weights = grammar.uniform_probabilities
+    serial = grammar.generate_parallel(20, seed=3, workers=1, weights=weights)
+    parallel = cfg_parallel.generate_parallel(
+        grammar, 20, seed=3, workers=2, chunk_size=6, weights=weights
+    )
+    assert parallel == serial
+
+
+def test_validate_shared_right_hand_sides():
+    """Nonterminals that share a production are both recognized."""
+    grammar = CFGrammar({"S": [["A", "b"], ["B", "c"]],
+                         "A": [["x"]], "B": [["x"]]})
+    assert grammar.validate("xb")
+    assert grammar.validate("xc")
+    assert not grammar.validate("xx")
+
+
+def test_validate_nullable_and_recursive():
+    """The chart parser handles empty productions and left recursion."""
+    grammar = CFGrammar({"S": [["S", "a"], ["A"]], "A": [[], ["b"]]})
+    for s in ("", "a", "aaa", "b", "baa"):
+        assert grammar.validate(s, "S"), s
+    assert not grammar.validate("ab", "S")
+
+    # Highly ambiguous grammar; backtracking would blow up here.
+    grammar = CFGrammar({"S": [["S", "S"], ["a"]]})
+    assert grammar.validate("a" * 60, "S")
+    assert not grammar.validate("a" * 60 + "b", "S")
+
+
+def test_validate_agrees_with_ranking():
+    """validate accepts exactly the strings index_of can rank."""
+    grammar = CFGrammar.from_name("cfg3b")
+    rng = random.Random(1)
+    for _ in range(20):
+        s = list(grammar.generate(rng=rng))
+        i = rng.randrange(len(s))
+        s[i] = rng.choice("123")
+        s = "".join(s)
+        try:
+            grammar.index_of(s)
+            derivable = True
+        except ValueError:
+            derivable = False
+        assert grammar.validate(s) == derivable
+
+
+def test_validate_many_matches_validate():
+    """Batch validation agrees with validate, in order, for any worker count."""
+    grammar = CFGrammar.from_name("cfg3b")
+    strings = [grammar.generate() for _ in range(20)]
+    strings += [s[:-1] for s in strings[:5]] + ["", "4"]
+    expected = [grammar.validate(s) for s in strings]
+
+    result = grammar.validate_many(strings)
+    assert result.dtype == bool
+    assert result.tolist() == expected
+
+    assert cfg_parallel.validate_many(
+        grammar, iter(strings), workers=2, chunk_size=4
+    ).tolist() == expected
+    assert list(grammar.validate_iter(iter(strings))) == expected
+
+
+def test_validate_string_uses_cached_grammar():
+    """The free function reuses its grammar until the rules dict changes."""
+    rules = {"S": [["a"]]}
+    assert cfg_generator.validate_string("a", "S", rules)
+    first = cfg_generator._cached_grammar(rules)
+    assert cfg_generator._cached_grammar(rules) is first
+    rules["S"].append(["b"])
+    assert cfg_generator.validate_string("b", "S", rules)
+    assert cfg_generator._cached_grammar(rules) is not first
+    # Keyed by content: an equal dict shares the grammar.
+    assert cfg_generator._cached_grammar({"S": [["a"]]}) is first
+    assert cfg_generator._cached_grammar(first) is first
+
+
+def test_recognizer_tracks_prefixes():
+    """The incremental recognizer agrees with validate on every prefix."""
+    grammar = CFGrammar.from_name("cfg3b")
+    sentence = grammar.generate()
+    recognizer = grammar.recognizer()
+    assert recognizer.is_viable() and not recognizer.is_complete()
+    for i, ch in enumerate(sentence):
+        assert ch in recognizer.allowed_next()
+        assert recognizer.feed(ch)
+        assert recognizer.is_complete() == grammar.validate(sentence[: i + 1])
+    assert recognizer.is_complete()
+
+    # Every allowed terminal keeps the prefix viable; others kill it.
+    probe = grammar.recognizer()
+    probe.feed(sentence[0])
+    for t in grammar.terminal_symbols:
+        branch = probe.copy()
+        assert branch.feed(t) == (t in probe.allowed_next())
+    assert probe.position == 1
+
+    assert not recognizer.feed("4")
+    assert not recognizer.is_viable()
+    assert recognizer.error_position == len(sentence)
+    assert recognizer.allowed_next() == set()
+
+
+def test_first_error():
+    """first_error reports the offset of the first bad terminal."""
+    grammar = CFGrammar({"R": [["S"]], "S": [["a", "S", "b"], ["a", "b"]]})
+    assert grammar.first_error("aabb") is None
+    assert grammar.first_error("aab") == 3
+    assert grammar.first_error("abb") == 2
+    assert grammar.first_error("axb") == 1
+    assert grammar.first_error("") == 0
+
+
+def test_grammar_mask_matches_recognizer():
+    """Batched masks agree with the per-row recognizer at every step."""
+    grammar = CFGrammar.from_name("cfg3b")
+    tokenizer = CFGCharacterTokenizer("0123")
+    masker = GrammarMask(grammar, tokenizer)
+    sentences = [grammar.generate() for _ in range(4)]
+    mask = masker.reset(len(sentences))
+    recognizers = [grammar.recognizer() for _ in sentences]
+
+    for step in range(max(len(s) for s in sentences) + 1):
+        tokens = []
+        for row, (s, r) in enumerate(zip(sentences, recognizers)):
+            expected = np.zeros(len(tokenizer), dtype=bool)
+            expected[tokenizer.encode(sorted(r.allowed_next()))] = True
+            if r.is_complete():
+                expected[tokenizer.eos_token] = True
+            if step > len(s):
+                expected[:] = False
+                expected[tokenizer.eos_token] = True
+            assert (mask[row] == expected).all()
+            if step < len(s):
+                r.feed(s[step])
+                tokens.append(tokenizer.encode(s[step])[0])
+            else:
+                tokens.append(tokenizer.eos_token[0])
+        mask = masker.step(tokens)
+    assert masker.finished.all()
+
+    # An illegal token kills the row and is reported as not viable.
+    masker.reset(1)
+    masker.step(tokenizer.encode("0"))
+    assert not masker.viable[0] and not masker.mask().any()
+
+
+def test_grammar_mask_shares_equivalent_prefixes():
+    """Prefixes with the same parser configuration share one state."""
+    grammar = CFGrammar({"S": [["A", "A"]], "A": [["a", "b"], ["b", "a"]]})
+    tokenizer = CFGCharacterTokenizer("ab")
+    masker = GrammarMask(grammar, tokenizer, max_states=4)
+    masker.reset(2)
+    masker.step(tokenizer.encode("ab"))
+    assert masker.states[0] != masker.states[1]
+    masker.step(tokenizer.encode("ba"))
+    assert masker.states[0] == masker.states[1]
+    for token in "ab":
+        masker.step(tokenizer.encode(token * 2))
+    masker.step(tokenizer.eos_token * 2)
+    assert masker.finished.all()
+
+    # Past max_states the tables start over at the next batch.
+    assert masker.num_states > 4
+    masker.reset(1)
+    assert masker.num_states == ROOT_STATE + 1
+
+
+def test_validate_overlapping_terminals():
+    """Terminals that prefix each other are segmented by the parser."""
+    grammar = CFGrammar({"S": [["A", "B"]], "A": [["1"], ["11"]], "B": [["12"]]})
+    assert not grammar.lexer.prefix_free
+    assert grammar.validate("112")
+    assert grammar.validate("1112")
+    assert not grammar.validate("11112")
+    assert not grammar.validate("12")
+    assert grammar.index_of("1112") == 1
+    assert grammar.first_error("1112") is None
+    one, eleven, twelve = (grammar.compiled.symbol_id(t) for t in ("1", "11", "12"))
+    assert sorted(grammar.lexer.segmentations("1112")) == sorted(
+        [[one, one, twelve], [eleven, twelve]]
+    )
+
+    # index_of ranks the lattice, not each of its 2^n segmentations.
+    n = 60
+    grammar = CFGrammar({"S": [["A"] * n], "A": [["a"], ["aa"]]})
+    for length in (n, n + 7, 2 * n):
+        index = grammar.index_of("a" * length)
+        assert grammar.sentence_at(index) == "a" * length
+    assert grammar.index_of("a" * n) == 0
+
+    # Multi-character terminals that don't overlap take the one-pass path.
+    grammar = CFGrammar({"S": [["ab", "S"], ["c"]]})
+    assert grammar.lexer.prefix_free
+    assert grammar.lexer.segment("ababc") == [0, 0, 1]
+    assert grammar.validate("ababc", "S")
+    assert not grammar.validate("abac", "S")
+
+
+def test_count_distinct_ambiguous():
+    """count_distinct counts strings once however many derivations they have."""
+    grammar = CFGrammar({"R": [["S"]], "S": [["A", "A"]], "A": [["a"], ["a", "a"]]})
+    assert grammar.count_generations() == 4
+    assert grammar.count_distinct() == 3
+    automaton = grammar.compile_automata()
+    tokens = grammar.lexer.segment
+    assert [automaton.accepts(tokens(s)) for s in ["a", "aa", "aaa", "aaaa", "aaaaa"]] == [
+        False, True, True, True, False
+    ]
+
+
+def test_validate_with_automata():
+    """Automaton-accelerated validation agrees with the parser."""
+    rng = random.Random(0)
+    for name, max_states in [("cfg3b", 100_000), ("cfg3f", 2_000)]:
+        grammar = CFGrammar.from_name(name)
+        strings = [grammar.generate(rng=rng) for _ in range(10)]
+        for s in strings[:5]:
+            i = rng.randrange(len(s))
+            strings.append(s[:i] + rng.choice("123") + s[i + 1:])
+        expected = [grammar.validate(s) for s in strings]
+        automaton = grammar.compile_automata(max_states=max_states)
+        # cfg3b fits whole; cfg3f only compiles its lower layers.
+        assert (automaton is not None) == (name == "cfg3b")
+        assert grammar._automata
+        assert [grammar.validate(s) for s in strings] == expected
+
+
+def test_leaf_cache_preserves_distribution():
+    """Generating through cached leaf tables keeps sentence probabilities."""
+    rules = {"S": [["A", "A"], ["b"]], "A": [["a"], ["c", "A2"]], "A2": [["a"], ["b"]]}
+    weights = {"S": [3.0, 1.0], "A": [1.0, 3.0]}
+    # P(S -> A A) = 3/4; P(A = "a") = 1/4, P(A = "ca") = P(A = "cb") = 3/8.
+    p_a = {"a": 1 / 4, "ca": 3 / 8, "cb": 3 / 8}
+    expected = {"b": 1 / 4}
+    for x, px in p_a.items():
+        for y, py in p_a.items():
+            expected[x + y] = expected.get(x + y, 0) + 3 / 4 * px * py
+
+    grammar = CFGrammar(rules)
+    rng = random.Random(1)
+    n = 40_000
+    counts = Counter(grammar.generate("S", weights, rng=rng) for _ in range(n))
+    assert grammar._leaf_cache(grammar._sampling_tables(weights)).num_tokens > 0
+    for s, p in expected.items():
+        assert abs(counts[s] / n - p) < 0.01
+
+    # With a tiny budget entries are evicted, and generation still works.
+    grammar.configure_leaf_cache(max_strings=16, max_tokens=4)
+    for _ in range(100):
+        assert grammar.generate("S", weights, rng=rng) in expected
+    assert grammar._leaf_cache(grammar._sampling_tables(weights)).num_tokens <= 4
+
+
+def test_analysis_statistics():
+    """One analysis pass fills every per-symbol statistic."""
+    grammar = CFGrammar({
+        "R": [["S", "X"]],
+        "S": [["A"], ["b"]],
+        "A": [["S", "a"], []],
+        "X": [["c", "d"], ["c"]],
+    })
+    stats = grammar.symbol_stats("X")
+    assert stats == {
+        "count": 2, "min_length": 1, "max_length": 2, "depth": 1,
+        "terminals": ["c", "d"], "nullable": False, "recursive": False,
+    }
+    stats = grammar.symbol_stats("S")
+    assert stats["recursive"] and stats["nullable"]
+    assert stats["count"] is None and stats["max_length"] is None
+    assert stats["terminals"] == ["a", "b"]
+    assert grammar.symbol_stats()["min_length"] == 1
+    assert grammar.count_generations() is None
+
+    # A recursive grammar raises instead of looping forever.
+    with pytest.raises(ValueError):
+        cfg_generator.get_longest_sequence("R", grammar.rules)
+
+
+def test_analysis_deep_chain():
+    """Thousands of layered nonterminals are analysed without recursion."""
+    depth = 5000
+    rules = {f"N{i}": [[f"N{i + 1}", "a"], ["b"]] for i in range(depth)}
+    rules[f"N{depth}"] = [["a"], ["b"]]
+    grammar = CFGrammar(rules)
+    assert grammar.get_longest_sequence("N0") == depth + 1
+    assert grammar.count_generations("N0") == depth + 2
+    assert grammar.symbol_stats("N0")["depth"] == depth + 1
+    assert grammar.analysis.order[-1] == grammar.compiled.symbol_id("N0")
+
+
+def test_recursive_length_counts_and_sampling():
+    """Recursive grammars count and sample up to a bound, without rejection."""
+    # Balanced parentheses: the counts are the Catalan numbers.
+    grammar = CFGrammar({"R": [["S"]], "S": [["(", "S", ")", "S"], []]})
+    assert grammar.count_by_length("R", max_length=10) == (
+        1, 0, 1, 0, 2, 0, 5, 0, 14, 0, 42,
+    )
+    with pytest.raises(ValueError):
+        grammar.count_by_length("R")
+    with pytest.raises(ValueError):
+        grammar.uniform_weights
+
+    rng = random.Random(0)
+    counts = Counter(grammar.generate("R", rng=rng, length=6) for _ in range(5000))
+    assert set(counts) == {"()()()", "()(())", "(())()", "(()())", "((()))"}
+    assert min(counts.values()) > 900
+    for _ in range(200):
+        assert len(grammar.generate("R", rng=rng, max_len=7)) <= 7
+    with pytest.raises(ValueError):
+        grammar.generate("R", rng=rng, min_len=2)
+
+    # Weighted: P(S -> ( S ) S) = 1/4, so strings are short on average.
+    weights = {"R": [1.0], "S": [1.0, 3.0]}
+    lengths = [
+        len(grammar.generate("R", weights, rng=rng, max_len=4)) for _ in range(4000)
+    ]
+    # Conditioned on length <= 4: P(0) : P(2) : P(4) = 1 : 3/16 : 2 * 9/256.
+    z = 1 + 3 / 16 + 18 / 256
+    assert abs(lengths.count(0) / 4000 - 1 / z) < 0.03
+
+    # Unit cycles make some length infinitely ambiguous.
+    cyclic = CFGrammar({"R": [["A"]], "A": [["B"], ["a"]], "B": [["A"]]})
+    with pytest.raises(ValueError):
+        cyclic.count_by_length(max_length=3)
+
+    # A cycle elsewhere in the grammar doesn't affect R.
+    grammar = CFGrammar({"R": [["S"]], "S": [["b", "b"], []],
+                         "A": [["A"], ["B"]], "B": [[], ["A", "b"], []]})
+    assert grammar.generate("R", rng=rng, length=2) == "bb"
+    assert grammar.generate("R", rng=rng, length=2, rule_uniform=True) == "bb"
+    assert grammar.generate("R", {"S": [1, 0]}, rng=rng, max_len=2) == "bb"
+    with pytest.raises(ValueError, match="'B' uses 'A'"):
+        grammar.generate("B", rng=rng, max_len=2)
+
+
+def test_partition_function_and_expected_length():
+    """Newton iteration finds termination probabilities and mean lengths."""
+    grammar = CFGrammar({"R": [["E"]], "E": [["E", "+", "E"], ["x"]]})
+    # E = p E^2 + (1 - p): terminates surely iff p <= 1/2.
+    for p, z, mean in [(0.3, 1.0, 2.5), (0.7, 3 / 7, 2.5)]:
+        weights = {"R": [1.0], "E": [p, 1 - p]}
+        assert math.isclose(grammar.partition_function(weights=weights), z)
+        assert math.isclose(grammar.expected_length(weights=weights), mean)
+    # Uniform productions are critical: the mean length diverges.
+    assert abs(grammar.partition_function() - 1) < 1e-6
+    assert grammar.expected_length() == math.inf
+
+    # Acyclic grammars always terminate; the mean matches the definition.
+    small = CFGrammar({"S": [["a", "b"], ["c"]]})
+    assert small.partition_function() == 1.0
+    assert small.expected_length(weights={"S": [3, 1]}) == 1.75
+
+
+def test_uniform_probabilities_match_exact_weights():
+    """Float probabilities agree with the exact big-int weights."""
+    grammar = CFGrammar(cfg_by_name["cfg3b"])
+    weights = grammar.uniform_weights
+    probs = grammar.uniform_probabilities
+    for nt, counts in weights.items():
+        total = sum(counts)
+        for count, p in zip(counts, probs[nt]):
+            assert math.isclose(p, count / total, rel_tol=1e-12)
+    start = grammar.start_symbols[0]
+    assert math.isclose(
+        grammar.analysis.log_counts[grammar.compiled.symbol_id(start)],
+        math.log2(grammar.count_generations()),
+    )
+
+    # Counts with ~2^2000 digits: no big ints, and sampling still works.
+    depth = 2000
+    rules = {f"N{i}": [[f"N{i + 1}", f"N{i + 1}"], ["a"]] for i in range(depth)}
+    rules[f"N{depth}"] = [["a"], ["b"]]
+    deep = CFGrammar(rules)
+    for nt, p in deep.uniform_probabilities.items():
+        assert math.isclose(sum(p), 1.0)
+    assert deep.analysis.log_counts[deep.compiled.symbol_id("N0")] == math.inf
+    assert set(deep.generate_uniform(f"N{depth - 3}")) <= {"a", "b"}
+
+
+def test_uniform_weights_skip_unproductive_and_unused_symbols():
+    """Only cycles a start symbol can actually derive through are infinite."""
+    # X only reaches an unproductive cycle, so S has exactly one sentence.
+    grammar = CFGrammar({"S": [["a"], ["X"]], "X": [["X", "a"]]})
+    assert grammar.uniform_weights == {"S": [1, 0]}
+    assert grammar.uniform_probabilities == {"S": [1.0, 0.0]}
+    assert grammar.generate_uniform("S") == "a"
+
+    # L is recursive but no start symbol reaches it.
+    grammar = CFGrammar({"S": [["a"], ["b", "C"]], "C": [["c"], ["d"]],
+                         "L": [["L", "a"], ["b"]]})
+    assert grammar.uniform_weights == {"S": [1, 2], "C": [1, 1]}
+    assert grammar.generate_uniform("S") in {"a", "bc", "bd"}
+
+    with pytest.raises(ValueError, match="'S' derives infinitely many"):
+        CFGrammar({"R": [["S"]], "S": [["a"], ["S", "a"], ["X"]],
+                   "X": [["X"]]}).uniform_probabilities
+
+
+def test_sentence_stats_are_exact():
+    """Analytic statistics match the definitions for both samplers."""
+    grammar = CFGrammar({"S": [["A", "A"], ["b"]], "A": [["a"], ["c", "a"], ["c", "b"]]})
+    # Uniform over rules: S -> A A half the time, each A is 1 or 2 long.
+    dist = grammar.length_distribution("S", exact=True)
+    assert dist == (0, Fraction(1, 2), Fraction(1, 18), Fraction(2, 9), Fraction(2, 9))
+    stats = grammar.sentence_stats("S", exact=True)
+    mean = sum(length * p for length, p in enumerate(dist))
+    assert stats["mean"] == mean
+    assert stats["variance"] == sum((l - mean) ** 2 * p for l, p in enumerate(dist))
+    assert stats["terminal_counts"] == {
+        "a": Fraction(2, 3), "b": Fraction(1, 2) + Fraction(1, 3), "c": Fraction(2, 3),
+    }
+    assert stats["expansions"] == {"S": 1, "A": 1}
+
+    # Uniform over sentences: the distribution is count_by_length normalized.
+    counts = grammar.count_by_length("S")
+    total = sum(counts)
+    assert grammar.length_distribution("S", uniform=True, exact=True) == tuple(
+        Fraction(c, total) for c in counts
+    )
+    assert abs(grammar.sentence_stats("S", uniform=True)["mean"] - 3.1) < 1e-12
+
+    recursive = CFGrammar({"R": [["E"]], "E": [["E", "+", "E"], ["x"]]})
+    with pytest.raises(ValueError):
+        recursive.sentence_stats("R")
+
+
+def test_kgram_distribution_and_entropy():
+    """k-gram frequencies and entropies match enumeration of the language."""
+    grammar = CFGrammar({
+        "S": [["A", "A", "B"], ["b"]],
+        "A": [["a"], ["c", "a"], []],
+        "B": [["A", "A"], ["c"]],
+    })
+    stats = grammar._sentence_statistics(None, False, True)
+    for k in (1, 2, 3):
+        counts = stats.kgram_counts(grammar.compiled.symbol_id("S"), k)
+        brute = Counter()
+        for sentence, p in _derivations(grammar, "S"):
+            for i in range(len(sentence) - k + 1):
+                brute[tuple(sentence[i:i + k])] += p
+        assert {g: c for g, c in counts.items() if c} == {
+            tuple(grammar.compiled.symbol_id(t) for t in g): c for g, c in brute.items()
+        }
+        dist = grammar.kgram_distribution(k, "S", exact=True)
+        assert sum(dist.values()) == 1
+
+    entropy = -sum(p * math.log2(p) for _, p in _derivations(grammar, "S"))
+    stats = grammar.sentence_stats("S")
+    assert math.isclose(stats["entropy"], entropy)
+    assert math.isclose(grammar.entropy_rate("S"), entropy / stats["mean"])
+    # Uniform over sentences of an unambiguous grammar: log2 of the count.
+    uniform = CFGrammar(cfg_by_name["cfg3b"])
+    start = uniform.start_symbols[0]
+    assert math.isclose(
+        uniform.sentence_stats(start, uniform=True)["entropy"],
+        math.log2(uniform.count_generations(start)),
+    )
+
+
+def _derivations(grammar, symbol):
+    """Every (terminal list, probability) derivation under uniform rules."""
+    if symbol not in grammar.rules:
+        return [([symbol], Fraction(1))]
+    productions = grammar.rules[symbol]
+    out = []
+    for production in productions:
+        parts = [_derivations(grammar, child) for child in production]
+        for combo in product(*parts):
+            sentence = [t for part, _ in combo for t in part]
+            p = Fraction(1, len(productions))
+            for _, q in combo:
+                p *= q
+            out.append((sentence, p))
+    return out
+
+
+def test_freeze_normalizes_and_shares_compiled_form():
+    """freeze() prunes, deduplicates and returns a hashable grammar."""
+    rules = {
+        "S": [["A", "b"], ["A", "b"], ["U"], ["c"]],
+        "A": [["a"], ["a"]],
+        "U": [["U", "a"]],           # unproductive
+        "D": [["E"]], "E": [["D"], ["x"]],  # unreachable cycle
+    }
+    grammar = CFGrammar(rules)
+    frozen = grammar.freeze()
+    assert dict(frozen.rules) == {"S": (("A", "b"), ("c",)), "A": (("a",),)}
+    assert frozen.sources == {"S": [[0, 1], [3]], "A": [[0, 1]]}
+    assert frozen.translate_weights({"S": [1, 2, 3, 4]}) == {"S": [3, 4], "A": [2]}
+    assert frozen.translate_weights(None) == {"S": [2, 1], "A": [2]}
+    with pytest.raises(TypeError):
+        frozen.rules["S"] = ()
+
+    # Equal rules: equal, same hash, one shared compiled grammar.
+    again = grammar.freeze()
+    assert frozen == again and hash(frozen) == hash(again)
+    assert frozen.compiled is again.compiled
+    assert len({frozen, again}) == 1
+    assert grammar != CFGrammar(rules)
+
+    restored = pickle.loads(pickle.dumps(frozen))
+    assert restored == frozen and restored.validate("ab")
+
+    # Pruning keeps the language of real grammars intact.
+    cfg3b = CFGrammar(cfg_by_name["cfg3b"])
+    assert cfg3b.freeze().count_generations() == cfg3b.count_generations()